@@ -9,13 +9,17 @@ from cadash import inventory
 from cadash import public
 from cadash import redunlive
 from cadash.assets import assets
-from cadash.extensions import bcrypt
+from cadash.extensions import ca_stats
 from cadash.extensions import cache
 from cadash.extensions import db
-from cadash.extensions import debug_toolbar
 from cadash.extensions import ldap_cli
+from cadash.extensions import ldap_groups
 from cadash.extensions import login_manager
-from cadash.extensions import migrate
+from cadash.extensions import pearl_clients
+from cadash.extensions import redunlive_jobs
+from cadash.extensions import redunlive_poller
+from cadash.extensions import request_timer
+from cadash.extensions import user_sessions
 from cadash.inventory.resources import register_resources
 from cadash.settings import Config
 from cadash.utils import setup_logging
@@ -44,16 +48,30 @@ def create_app(config_object=None, app_name=__name__):
 
 def register_extensions(app):
     """Register Flask extensions."""
+    # first, so request timing covers other extensions' hooks
+    request_timer.init_app(app)
+
     assets.init_app(app)
-    bcrypt.init_app(app)
     cache.init_app(app)
     db.init_app(app)
     login_manager.init_app(app)
-    debug_toolbar.init_app(app)
-    migrate.init_app(app, db)
 
-    # ldap cli for authentication/authorization
+    # dev-only; imported here, as it is slow to import and set up
+    if app.config['ENV'] == 'dev' and app.config['DEBUG_TB_ENABLED']:
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+
+    # ldap cli for authentication/authorization, and cached groups of users
     ldap_cli.init_app(app)
+    ldap_groups.init_app(app)
+    user_sessions.init_app(app)
+
+    # cached ca_stats, long-lived clients to capture agents, live status
+    # poller, and background jobs for switch-over
+    ca_stats.init_app(app)
+    pearl_clients.init_app(app)
+    redunlive_poller.init_app(app)
+    redunlive_jobs.init_app(app)
 
     # flask-restful initialization
     api = Api(app)
@@ -1,9 +1,19 @@
 # -*- coding: utf-8 -*-
 """Database module, including the SQLAlchemy database object and DB-related utilities."""
+from functools import wraps
+import uuid
+
+from flask import current_app
+from flask import has_app_context
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import event
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import relationship
 from sqlalchemy.orm import validates
 
 from cadash.compat import basestring
+from cadash.extensions import cache
 from cadash.extensions import db
 import cadash.utils as utils
 
@@ -16,12 +26,46 @@ validates = validates
 class CRUDMixin(object):
     """Mixin that adds convenience methods for CRUD (create, read, update, delete) operations."""
 
+    # unique columns, as tuples of (column name, error class, message format);
+    # checked by `check_unique`, and used to explain IntegrityError on save
+    unique_fields = ()
+
+    @classmethod
+    def check_unique(cls, values, exclude_id=None):
+        """
+        raise error of first unique field in `values` taken by another record.
+
+        all unique fields are checked in a single query; `exclude_id` is the
+        id of the record being updated, if any.
+        """
+        fields = [f for f in cls.unique_fields if values.get(f[0]) is not None]
+        if not fields:
+            return True
+
+        columns = [getattr(cls, name) for name, error, message in fields]
+        query = cls.query.with_entities(*columns).filter(
+                or_(*[c == values[f[0]] for c, f in zip(columns, fields)]))
+        if exclude_id is not None:
+            query = query.filter(cls.id != exclude_id)
+        # unique columns: at most one record per field
+        taken = query.limit(len(fields)).all()
+
+        for i, (name, error, message) in enumerate(fields):
+            if any([_same_value(row[i], values[name]) for row in taken]):
+                raise error(message % values[name])
+        return True
+
     @classmethod
     def create(cls, **kwargs):
         """Create a new record and save it the database."""
         instance = cls(**kwargs)
         return instance.save()
 
+    def _changed(self, values):
+        """subset of `values` that differ from current attributes."""
+        return dict([(k, v) for k, v in values.items()
+                     if v != getattr(self, k, None)])
+
     def update(self, commit=True, **kwargs):
         """Update specific fields of a record."""
         for attr, value in kwargs.items():
@@ -32,7 +76,16 @@ class CRUDMixin(object):
         """Save the record."""
         db.session.add(self)
         if commit:
-            db.session.commit()
+            # attributes are expired on rollback; keep values to explain error
+            values = dict([(f[0], getattr(self, f[0])) for f in self.unique_fields])
+            record_id = getattr(self, 'id', None)
+            try:
+                db.session.commit()
+            except IntegrityError:
+                db.session.rollback()
+                # unique value taken by a concurrent write, after checks
+                self.check_unique(values, exclude_id=record_id)
+                raise
         return self
 
     def delete(self, commit=True):
@@ -46,6 +99,14 @@ class Model(CRUDMixin, db.Model):
 
     __abstract__ = True
 
+    # named eager-loading strategies: profile name -> tuple of loader options
+    loading_profiles = {}
+
+    @classmethod
+    def query_for(cls, profile):
+        """query with loader options of named `profile`; plain query if none."""
+        return cls.query.options(*cls.loading_profiles.get(profile, ()))
+
 
 # From Mike Bayer's "Building the app" talk
 # https://speakerdeck.com/zzzeek/building-the-app
@@ -82,6 +143,82 @@ class NameIdMixin(object):
         return self.name
 
 
+def cached_lookup(name, models):
+    """
+    cache result of lookup function in app cache, per version of `models`.
+
+    each table has a version in the cache, replaced when a session that
+    wrote to the table commits; so cached lookups are never stale, in all
+    workers that share the cache (redis in prod).
+    """
+    tables = [m.__table__.name for m in models]
+
+    def decorator(fn):
+        @wraps(fn)
+        def wrapped(*args, **kwargs):
+            # versions read before query: a concurrent write only makes the
+            # result newer than its key
+            key = 'lookup:%s:%s:%r:%r' % (
+                    name, ':'.join(table_versions(tables)),
+                    args, sorted(kwargs.items()))
+            value = cache.get(key)
+            if value is None:
+                value = fn(*args, **kwargs)
+                cache.set(
+                        key, value,
+                        timeout=current_app.config['LOOKUP_CACHE_TIMEOUT'])
+            return value
+        return wrapped
+    return decorator
+
+
+def table_versions(tables):
+    """current version of each table in `tables`, from app cache."""
+    keys = ['table_version:%s' % t for t in tables]
+    versions = cache.get_many(*keys)
+    for i, version in enumerate(versions):
+        if version is None:
+            # new or evicted: start a version never used before
+            cache.add(keys[i], uuid.uuid4().hex, timeout=0)
+            versions[i] = cache.get(keys[i])
+    return [str(v) for v in versions]
+
+
+def mark_changed(session, tables):
+    """mark `tables` as written by `session`; versions replaced on commit."""
+    session.info.setdefault('changed_tables', set()).update(tables)
+
+
+@event.listens_for(SignallingSession, 'after_flush')
+def _mark_flushed(session, flush_context):
+    mark_changed(session, set([
+        o.__table__.name for o in
+        list(session.new) + list(session.dirty) + list(session.deleted)
+        if hasattr(o, '__table__')]))
+
+
+@event.listens_for(SignallingSession, 'after_commit')
+def _replace_table_versions(session):
+    tables = session.info.pop('changed_tables', None)
+    if tables and has_app_context():
+        cache.set_many(
+                dict([('table_version:%s' % t, uuid.uuid4().hex)
+                      for t in tables]),
+                timeout=0)
+
+
+@event.listens_for(SignallingSession, 'after_rollback')
+def _forget_changed(session):
+    session.info.pop('changed_tables', None)
+
+
+def _same_value(a, b):
+    """compare as the db might: strings are case insensitive in mysql."""
+    if isinstance(a, basestring) and isinstance(b, basestring):
+        return a.lower() == b.lower()
+    return a == b
+
+
 def reference_col(tablename, nullable=False, pk_name='id', **kwargs):
     """Column that adds primary key foreign key reference.
 
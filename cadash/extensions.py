@@ -1,17 +1,29 @@
 # -*- coding: utf-8 -*-
-"""Extensions module. Each extension is initialized in the app factory located in app.py."""
-from flask_bcrypt import Bcrypt
+"""Extensions module. Each extension is initialized in the app factory located in app.py.
+
+dev-only extensions (debug toolbar) are imported by the app factory, in dev
+only; migrations are set up by manage.py.
+"""
 from flask_cache import Cache
-from flask_debugtoolbar import DebugToolbarExtension
 from flask_login import LoginManager
-from flask_migrate import Migrate
 from flask_sqlalchemy import SQLAlchemy
 from cadash.ldap import LdapClient
+from cadash.ldap import LdapGroupCache
+from cadash.redunlive.client import PearlClientRegistry
+from cadash.redunlive.jobs import JobRunner
+from cadash.redunlive.poller import LiveStatusPoller
+from cadash.timing import RequestTimer
+from cadash.user.sessions import UserSessionStore
+from cadash.utils import CachedFetcher
 
-bcrypt = Bcrypt()
 login_manager = LoginManager()
 db = SQLAlchemy()
-migrate = Migrate()
 cache = Cache()
-debug_toolbar = DebugToolbarExtension()
+request_timer = RequestTimer()
 ldap_cli = LdapClient()
+ldap_groups = LdapGroupCache(ldap_cli, cache)
+user_sessions = UserSessionStore(cache, ldap_groups)
+ca_stats = CachedFetcher()
+pearl_clients = PearlClientRegistry()
+redunlive_poller = LiveStatusPoller()
+redunlive_jobs = JobRunner(cache)
@@ -0,0 +1,479 @@
+# -*- coding: utf-8 -*-
+"""bulk import (upsert) of inventory records.
+
+a batch is a dict with a list of rows per kind of record, e.g.
+
+    {'vendors': [{'name': 'epiphan', 'model': 'pearl2'}],
+     'locations': [{'name': 'room 1'}],
+     'clusters': [{'name': 'prod', 'admin_host': 'admin.fake', 'env': 'prod'}],
+     'cas': [{'name': 'ca1', 'address': 'ca1.fake',
+              'serial_number': 'ABC', 'vendor': 'epiphan_pearl2'}],
+     'roles': [{'ca': 'ca1', 'location': 'room 1',
+                'cluster': 'prod', 'name': 'primary'}]}
+
+rows are matched to records by name (name_id for vendors): new records
+are inserted, existing ones updated. cas refer to vendors by `vendor`
+(name_id) or `vendor_id`; roles to cas, locations and clusters by name or
+by `ca_id`, `location_id`, `cluster_id`.
+
+constraints are checked with a few set-based queries per kind, instead of
+a few queries per row; inserts go in batches, and the whole import is a
+single transaction. rows that violate constraints are skipped and
+reported, the other rows are imported.
+"""
+import csv
+import logging
+
+from cadash.compat import string_types
+from cadash.compat import text_type
+from cadash.database import db
+from cadash.database import mark_changed
+from cadash.inventory.errors import InvalidImportDataError
+from cadash.inventory.models import CA_ROLES
+from cadash.inventory.models import MH_ENVS
+from cadash.inventory.models import Ca
+from cadash.inventory.models import Location
+from cadash.inventory.models import MhCluster
+from cadash.inventory.models import Role
+from cadash.inventory.models import Vendor
+
+# kinds of records, in import order
+KINDS = ('vendors', 'locations', 'clusters', 'cas', 'roles')
+
+# sqlite allows at most 999 params per statement
+IN_CHUNK_SIZE = 500
+INSERT_CHUNK_SIZE = 1000
+
+
+def import_inventory(batch, commit=True):
+    """
+    import (upsert) `batch` of inventory records, in a single transaction.
+
+    :param: batch: dict of lists of rows, per kind in KINDS
+    :param: commit: False to check and report only; changes rolled back
+    :return: dict, per kind in batch, with number of rows created, updated
+        and unchanged; and list of `errors` as {'row': index, 'message': ...}
+    """
+    if not isinstance(batch, dict):
+        raise InvalidImportDataError(
+                'import batch must be an object with lists of [%s]'
+                % ','.join(KINDS))
+    unknown = set(batch.keys()).difference(KINDS)
+    if unknown:
+        raise InvalidImportDataError(
+                'unknown kinds of records (%s); valid kinds: [%s]'
+                % (','.join(sorted(unknown)), ','.join(KINDS)))
+    for kind, rows in batch.items():
+        if not isinstance(rows, list):
+            raise InvalidImportDataError('`%s` must be a list of rows' % kind)
+
+    importers = {
+            'vendors': _import_vendors,
+            'locations': _import_locations,
+            'clusters': _import_clusters,
+            'cas': _import_cas,
+            'roles': _import_roles}
+
+    logger = logging.getLogger(__name__)
+    report = {}
+    try:
+        for kind in KINDS:
+            if kind in batch:
+                report[kind] = _report()
+                importers[kind](_rows(batch[kind], report[kind]), report[kind])
+        if commit:
+            db.session.commit()
+        else:
+            db.session.rollback()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    logger.info('inventory import (%s): %s' % (
+        'committed' if commit else 'dry run',
+        ', '.join(['%s %i/%i/%i/%i' % (
+            k, r['created'], r['updated'], r['unchanged'], len(r['errors']))
+            for k, r in sorted(report.items())])))
+    return report
+
+
+def rows_from_csv(text):
+    """list of rows (dicts) from csv `text` with a header line."""
+    if isinstance(text, text_type):
+        text = text.encode('utf-8')
+    reader = csv.DictReader(text.splitlines())
+    return [dict([(k.strip().decode('utf-8'), (v or '').decode('utf-8'))
+                  for k, v in row.items() if k])
+            for row in reader]
+
+
+def batch_from_ca_stats(data, cluster=None):
+    """
+    batch from ca_stats json `data`: vendors, locations, cas and roles.
+
+    ca_stats has no mh cluster info: roles are only in batch if `cluster`
+    (name of a cluster in inventory) is given.
+    """
+    if not isinstance(data, list):
+        raise InvalidImportDataError('ca_stats data must be a list')
+
+    batch = {'vendors': [], 'locations': [], 'cas': []}
+    if cluster:
+        batch['roles'] = []
+    vendors = set()
+    locations = set()
+    for ca_item in data:
+        if not isinstance(ca_item, dict):
+            continue
+        attributes = ca_item.get('ca_attributes') or {}
+        vendor = {
+                'name': ca_item.get('vendor') or 'unknown',
+                'model': attributes.get('product_name') or 'unknown'}
+        vendor_name_id = Vendor.computed_name_id(vendor['name'], vendor['model'])
+        if vendor_name_id not in vendors:
+            vendors.add(vendor_name_id)
+            batch['vendors'].append(vendor)
+
+        location = ca_item.get('location')
+        if location and location not in locations:
+            locations.add(location)
+            batch['locations'].append({'name': location})
+
+        batch['cas'].append({
+            'name': ca_item.get('name'),
+            'address': ca_item.get('address'),
+            'serial_number': attributes.get('serial_number'),
+            'vendor': vendor_name_id})
+
+        if cluster and location and ca_item.get('role'):
+            batch['roles'].append({
+                'ca': ca_item.get('name'),
+                'location': location,
+                'cluster': cluster,
+                'name': ca_item['role']})
+    return batch
+
+
+def _report():
+    return {'created': 0, 'updated': 0, 'unchanged': 0, 'errors': []}
+
+
+def _error(report, row_num, message):
+    report['errors'].append({'row': row_num, 'message': message})
+
+
+def _rows(rows, report):
+    """(index, row) for rows that are dicts; errors for the others."""
+    valid = []
+    for i, row in enumerate(rows):
+        if isinstance(row, dict):
+            valid.append((i, row))
+        else:
+            _error(report, i, 'row must be an object')
+    return valid
+
+
+def _text(row, key):
+    """stripped text value of `key` in `row`, or None if empty."""
+    value = row.get(key)
+    if value is None:
+        return None
+    if not isinstance(value, string_types):
+        value = text_type(value)
+    value = value.strip()
+    return value if value else None
+
+
+def _int(row, key):
+    """int value of `key` in `row`, or None if empty or not a number."""
+    value = _text(row, key)
+    try:
+        return int(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def _fetch_in(model, column, values):
+    """records of `model` with `column` in `values`; a query per chunk."""
+    values = list(set([v for v in values if v is not None]))
+    records = []
+    for i in range(0, len(values), IN_CHUNK_SIZE):
+        records.extend(model.query.filter(
+            column.in_(values[i:i + IN_CHUNK_SIZE])).all())
+    return records
+
+
+def _insert(model, mappings):
+    # bulk writes are not flushed through the session; mark for lookups
+    if mappings:
+        mark_changed(db.session, [model.__table__.name])
+    for i in range(0, len(mappings), INSERT_CHUNK_SIZE):
+        db.session.bulk_insert_mappings(
+                model, mappings[i:i + INSERT_CHUNK_SIZE])
+
+
+def _update(model, mappings):
+    if mappings:
+        mark_changed(db.session, [model.__table__.name])
+    for i in range(0, len(mappings), INSERT_CHUNK_SIZE):
+        db.session.bulk_update_mappings(
+                model, mappings[i:i + INSERT_CHUNK_SIZE])
+
+
+def _import_vendors(rows, report):
+    valid = {}
+    for i, row in rows:
+        name = _text(row, 'name')
+        model = _text(row, 'model')
+        if name is None or model is None:
+            _error(report, i, 'not allowed empty value for `name` or `model`')
+            continue
+        name_id = Vendor.computed_name_id(name, model)
+        if name_id in valid:
+            _error(report, i,
+                   'duplicate vendor name_model(%s) in batch' % name_id)
+            continue
+        valid[name_id] = {'name': name, 'model': model, 'name_id': name_id}
+
+    existing = set([v.name_id for v in
+                    _fetch_in(Vendor, Vendor.name_id, valid.keys())])
+    new = [m for k, m in valid.items() if k not in existing]
+    _insert(Vendor, new)
+    report['created'] += len(new)
+    report['unchanged'] += len(valid) - len(new)
+
+
+def _import_locations(rows, report):
+    valid = {}
+    for i, row in rows:
+        name = _text(row, 'name')
+        if name is None:
+            _error(report, i, 'not allowed empty value for `name`')
+            continue
+        if name in valid:
+            _error(report, i, 'duplicate location name(%s) in batch' % name)
+            continue
+        valid[name] = {'name': name}
+
+    existing = set([l.name for l in
+                    _fetch_in(Location, Location.name, valid.keys())])
+    new = [m for k, m in valid.items() if k not in existing]
+    _insert(Location, new)
+    report['created'] += len(new)
+    report['unchanged'] += len(valid) - len(new)
+
+
+def _import_clusters(rows, report):
+    valid = []
+    names = set()
+    hosts = set()
+    for i, row in rows:
+        name = _text(row, 'name')
+        admin_host = _text(row, 'admin_host')
+        env = (_text(row, 'env') or '').lower()
+        if name is None or admin_host is None:
+            _error(report, i,
+                   'not allowed empty value for `name` or `admin_host`')
+            continue
+        if env not in MH_ENVS:
+            _error(report, i, 'mh cluster env value not in [%s]: %s' % (
+                ','.join(list(MH_ENVS)), row.get('env')))
+            continue
+        if name in names:
+            _error(report, i, 'duplicate mh_cluster name(%s) in batch' % name)
+            continue
+        if admin_host in hosts:
+            _error(report, i,
+                   'duplicate mh_cluster admin host(%s) in batch' % admin_host)
+            continue
+        names.add(name)
+        hosts.add(admin_host)
+        valid.append((i, {'name': name, 'admin_host': admin_host, 'env': env}))
+
+    by_name = dict([(c.name, c) for c in _fetch_in(
+        MhCluster, MhCluster.name, names)])
+    by_host = dict([(c.admin_host, c) for c in _fetch_in(
+        MhCluster, MhCluster.admin_host, hosts)])
+
+    new = []
+    updates = []
+    for i, m in valid:
+        current = by_name.get(m['name'])
+        owner = by_host.get(m['admin_host'])
+        if owner is not None and owner is not current:
+            _error(report, i,
+                   'duplicate mh_cluster admin host(%s)' % m['admin_host'])
+        elif current is None:
+            new.append(m)
+        elif (current.admin_host, current.env) != (m['admin_host'], m['env']):
+            updates.append(dict(m, id=current.id))
+        else:
+            report['unchanged'] += 1
+
+    _insert(MhCluster, new)
+    _update(MhCluster, updates)
+    report['created'] += len(new)
+    report['updated'] += len(updates)
+
+
+def _import_cas(rows, report):
+    valid = []
+    seen = {'name': set(), 'address': set(), 'serial_number': set()}
+    vendor_name_ids = set()
+    vendor_ids = set()
+    for i, row in rows:
+        m = {
+            'name': _text(row, 'name'),
+            'address': _text(row, 'address'),
+            'serial_number': _text(row, 'serial_number'),
+            'vendor_id': _int(row, 'vendor_id'),
+            'vendor': _text(row, 'vendor')}
+        if m['name'] is None or m['address'] is None:
+            _error(report, i,
+                   'not allowed empty value for `name` or `address`')
+            continue
+        if m['vendor_id'] is None and m['vendor'] is None:
+            _error(report, i, 'not allowed empty value for `vendor_id`')
+            continue
+        duplicate = [k for k in ('name', 'address', 'serial_number')
+                     if m[k] is not None and m[k] in seen[k]]
+        if duplicate:
+            _error(report, i, 'duplicate ca %s(%s) in batch' % (
+                duplicate[0], m[duplicate[0]]))
+            continue
+        for k in seen:
+            seen[k].add(m[k])
+        if m['vendor_id'] is not None:
+            vendor_ids.add(m['vendor_id'])
+        else:
+            vendor_name_ids.add(m['vendor'])
+        valid.append((i, m))
+
+    vendors_by_id = set([v.id for v in _fetch_in(Vendor, Vendor.id, vendor_ids)])
+    vendors_by_name_id = dict([(v.name_id, v.id) for v in _fetch_in(
+        Vendor, Vendor.name_id, vendor_name_ids)])
+    owners = {}
+    for k in seen:
+        owners[k] = dict([(getattr(c, k), c) for c in _fetch_in(
+            Ca, getattr(Ca, k), seen[k])])
+
+    new = []
+    updates = []
+    for i, m in valid:
+        if m['vendor_id'] is None:
+            m['vendor_id'] = vendors_by_name_id.get(m['vendor'])
+            if m['vendor_id'] is None:
+                _error(report, i, 'not in inventory: vendor(%s)' % m['vendor'])
+                continue
+        elif m['vendor_id'] not in vendors_by_id:
+            _error(report, i,
+                   'not in inventory: vendor_id(%i)' % m['vendor_id'])
+            continue
+        del m['vendor']
+
+        current = owners['name'].get(m['name'])
+        conflict = [k for k in ('address', 'serial_number')
+                    if m[k] is not None and
+                    owners[k].get(m[k], current) is not current]
+        if conflict:
+            _error(report, i, 'duplicate ca %s(%s)' % (
+                conflict[0], m[conflict[0]]))
+        elif current is None:
+            new.append(m)
+        elif current.vendor_id != m['vendor_id']:
+            _error(report, i, 'not allowed to update ca fields: vendor_id')
+        elif (current.address, current.serial_number) != \
+                (m['address'], m['serial_number']):
+            updates.append({
+                'id': current.id,
+                'address': m['address'],
+                'serial_number': m['serial_number']})
+        else:
+            report['unchanged'] += 1
+
+    _insert(Ca, new)
+    _update(Ca, updates)
+    report['created'] += len(new)
+    report['updated'] += len(updates)
+
+
+def _import_roles(rows, report):
+    refs = {'ca': set(), 'location': set(), 'cluster': set()}
+    valid = []
+    for i, row in rows:
+        m = {'name': (_text(row, 'name') or '').lower()}
+        for k in refs:
+            # reference by id, if any; otherwise by name
+            ref_id = _int(row, '%s_id' % k)
+            m[k] = (ref_id, None if ref_id is not None else _text(row, k))
+        missing = [k for k in ('ca', 'location', 'cluster')
+                   if m[k] == (None, None)]
+        if missing:
+            _error(report, i, 'not allowed empty value for `%s`' % missing[0])
+            continue
+        if m['name'] not in CA_ROLES:
+            _error(report, i, 'invalid ca-role(%s) - valid values: [%s]' % (
+                m['name'], ','.join(list(CA_ROLES))))
+            continue
+        for k in refs:
+            refs[k].add(m[k])
+        valid.append((i, m))
+
+    # map (id, name) references to ids
+    models = {'ca': Ca, 'location': Location, 'cluster': MhCluster}
+    ids = {}
+    for k, model in models.items():
+        found = _fetch_in(model, model.id, [r[0] for r in refs[k]]) + \
+            _fetch_in(model, model.name, [r[1] for r in refs[k] if r[0] is None])
+        ids[k] = {}
+        for record in found:
+            ids[k][(record.id, None)] = record.id
+            ids[k][(None, record.name)] = record.id
+
+    resolved = []
+    for i, m in valid:
+        missing = [k for k in models if m[k] not in ids[k]]
+        if missing:
+            _error(report, i, 'not in inventory: %s(%s)' % (
+                missing[0], m[missing[0]][0] or m[missing[0]][1]))
+            continue
+        resolved.append((i, {
+            'ca_id': ids['ca'][m['ca']],
+            'location_id': ids['location'][m['location']],
+            'cluster_id': ids['cluster'][m['cluster']],
+            'name': m['name']}))
+
+    roles = dict([(r.ca_id, r) for r in _fetch_in(
+        Role, Role.ca_id, [m['ca_id'] for i, m in resolved])])
+    taken = dict([((r.location_id, r.name), r.ca_id) for r in _fetch_in(
+        Role, Role.location_id, [m['location_id'] for i, m in resolved])
+        if r.name != 'experimental'])
+
+    new = []
+    batch_cas = set()
+    for i, m in resolved:
+        current = roles.get(m['ca_id'])
+        if current is not None:
+            if (current.location_id, current.cluster_id, current.name) == \
+                    (m['location_id'], m['cluster_id'], m['name']):
+                report['unchanged'] += 1
+            else:
+                _error(report, i,
+                       'cannot associate ca(%i): already has a role(%s)'
+                       % (m['ca_id'], current.name))
+            continue
+
+        slot = (m['location_id'], m['name'])
+        if m['name'] != 'experimental' and slot in taken:
+            _error(report, i, 'cannot associate location(%i): '
+                   'already has ca with role(%s)' % slot)
+            continue
+        if m['ca_id'] in batch_cas:
+            _error(report, i, 'duplicate ca(%i) in batch' % m['ca_id'])
+            continue
+        taken[slot] = m['ca_id']
+        batch_cas.add(m['ca_id'])
+        new.append(m)
+
+    _insert(Role, new)
+    report['created'] += len(new)
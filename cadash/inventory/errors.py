@@ -24,6 +24,10 @@ class AssociationError(Error):
     """can't associate entities due to some constraint."""
 
 
+class InvalidImportDataError(Error):
+    """bulk import data is not a valid batch of records."""
+
+
 class MissingVendorError(Error):
     """vendor is not in inventory."""
 
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""inventory lookups for forms, cached per table version."""
+
+from cadash.database import cached_lookup
+from cadash.inventory.models import Ca
+from cadash.inventory.models import Location
+from cadash.inventory.models import MhCluster
+from cadash.inventory.models import Role
+from cadash.inventory.models import Vendor
+
+
+@cached_lookup('select_vendors', [Vendor])
+def get_select_list_for_vendors():
+    """return a list of vendor tuples (id, name_id)."""
+    v_list = Vendor.query.order_by(Vendor.name_id).all()
+    return [(v.id, v.name_id) for v in v_list]
+
+
+@cached_lookup('select_cas', [Ca, Role])
+def get_select_list_for_cas():
+    """return a list of ca tuples (id, name_id)."""
+    ca_list = Ca.query.filter(Ca.role is None).all()
+    return [(c.id, c.name_id) for c in ca_list]
+
+
+@cached_lookup('select_locations', [Location])
+def get_select_list_for_locations():
+    """return a list of location tuples (id, name_id)."""
+    r_list = Location.query.order_by(Location.name).all()
+    return [(r.id, r.name_id) for r in r_list]
+
+
+@cached_lookup('select_clusters', [MhCluster])
+def get_select_list_for_clusters():
+    """return a list of cluster tuples (id, name_id)."""
+    r_list = MhCluster.query.order_by(MhCluster.name).all()
+    return [(r.id, r.name_id) for r in r_list]
@@ -3,6 +3,8 @@
 
 import datetime as dt
 
+from sqlalchemy.orm import joinedload
+
 from cadash.database import Column
 from cadash.database import Model
 from cadash.database import NameIdMixin
@@ -37,9 +39,16 @@ class Location(SurrogatePK, NameIdMixin, Model):
 
     __tablename__ = 'location'
     created_at = Column(db.DateTime, nullable=False, default=dt.datetime.utcnow)
+    updated_at = Column(
+            db.DateTime, nullable=False, server_default=db.func.now(),
+            default=dt.datetime.utcnow, onupdate=dt.datetime.utcnow)
     name = Column(db.String(80), unique=True, nullable=False)
     capture_agents = relationship('Role', back_populates='location')
 
+    unique_fields = (
+            ('name', DuplicateLocationNameError, 'duplicate location name(%s)'),
+    )
+
     def __init__(self, name):
         """create instance."""
         if self._check_constraints(name=name):
@@ -73,17 +82,12 @@ class Location(SurrogatePK, NameIdMixin, Model):
 
     def _check_constraints(self, **kwargs):
         """raise an error if args violate location constraints."""
-        for k, value in kwargs.items():
-            if k == 'name':
-                if not value or not value.strip():
-                    raise InvalidEmptyValueError(
-                            'not allowed empty value for `name`')
-                if not value == self.name:
-                    l = Location.query.filter_by(name=value).first()
-                    if l is not None:
-                        raise DuplicateLocationNameError(
-                                'duplicate location name(%s)' % value)
-        return True
+        if 'name' in kwargs:
+            value = kwargs['name']
+            if not value or not value.strip():
+                raise InvalidEmptyValueError(
+                        'not allowed empty value for `name`')
+        return self.check_unique(self._changed(kwargs), exclude_id=self.id)
 
 
 class Role(Model):
@@ -100,6 +104,15 @@ class Role(Model):
     cluster = relationship(
             'MhCluster', back_populates='capture_agents', uselist=False)
     created_at = Column(db.DateTime, nullable=False, default=dt.datetime.utcnow)
+    updated_at = Column(
+            db.DateTime, nullable=False, server_default=db.func.now(),
+            default=dt.datetime.utcnow, onupdate=dt.datetime.utcnow)
+
+    # role list shows ca, location and cluster of each role
+    loading_profiles = {
+            'list': (
+                joinedload('ca'), joinedload('location'), joinedload('cluster')),
+    }
 
 
     def __init__(self, ca, location, cluster, name):
@@ -145,6 +158,9 @@ class Ca(SurrogatePK, NameIdMixin, Model):
 
     __tablename__ = 'ca'
     created_at = Column(db.DateTime, nullable=False, default=dt.datetime.utcnow)
+    updated_at = Column(
+            db.DateTime, nullable=False, server_default=db.func.now(),
+            default=dt.datetime.utcnow, onupdate=dt.datetime.utcnow)
     name = Column(db.String(80), unique=True, nullable=False)
     address = Column(db.String(128), unique=True, nullable=False)
     serial_number = Column(db.String(80), unique=True, nullable=True)
@@ -152,6 +168,20 @@ class Ca(SurrogatePK, NameIdMixin, Model):
     vendor = relationship('Vendor')
     role = relationship('Role', back_populates='ca', uselist=False)
 
+    unique_fields = (
+            ('name', DuplicateCaptureAgentNameError, 'duplicate ca name(%s)'),
+            ('address', DuplicateCaptureAgentAddressError,
+             'duplicate ca address(%s)'),
+            ('serial_number', DuplicateCaptureAgentSerialNumberError,
+             'duplicate ca serial_number(%s)'),
+    )
+
+    # ca list and rest marshal show vendor of each ca
+    loading_profiles = {
+            'list': (joinedload('vendor'),),
+            'api': (joinedload('vendor'),),
+    }
+
 
     def __init__(self, name, address, vendor_id, serial_number=None):
         """create instance."""
@@ -201,50 +231,27 @@ class Ca(SurrogatePK, NameIdMixin, Model):
 
     def _check_constraints(self, **kwargs):
         """raise an error if args violate ca constraints."""
-        for key, value in kwargs.items():
-            # fail if unknown vendor
-            if key == 'vendor_id':
-                if not value:
-                    raise InvalidEmptyValueError(
-                            'not allowed empty value for `vendor_id`')
-                if not value == self.vendor_id:
-                    v = Vendor.get_by_id(value)
-                    if v is None:
-                        raise MissingVendorError(
-                                'not in inventory: vendor_id(%i)' % value)
-                next
-
-            # fail if duplicate name
-            if key == 'name':
+        for key in ('name', 'address'):
+            if key in kwargs:
+                value = kwargs[key]
                 if not value or not value.strip():
                     raise InvalidEmptyValueError(
-                            'not allowed empty value for `name`')
-                if not value == self.name:
-                    c = Ca.query.filter_by(name=value).first()
-                    if c is not None:
-                        raise DuplicateCaptureAgentNameError(
-                                'duplicate ca name(%s)' % value)
-                next
-
-            # fail if duplicate address
-            if key == 'address':
-                if not value or not value.strip():
-                    raise InvalidEmptyValueError(
-                            'not allowed empty value for `address`')
-                if not value == self.address:
-                    c = Ca.query.filter_by(address=value).first()
-                    if c is not None:
-                        raise DuplicateCaptureAgentAddressError(
-                                'duplicate ca address(%s)' % value)
-                next
-
-            # fail if duplicate serial_number
-            if key == 'serial_number' and not value == self.serial_number:
-                c = Ca.query.filter_by(serial_number=value).first()
-                if c is not None:
-                    raise DuplicateCaptureAgentSerialNumberError(
-                            'duplicate ca serial_number(%s)' % value)
-        return True
+                            'not allowed empty value for `%s`' % key)
+
+        # fail if unknown vendor
+        if 'vendor_id' in kwargs:
+            value = kwargs['vendor_id']
+            if not value:
+                raise InvalidEmptyValueError(
+                        'not allowed empty value for `vendor_id`')
+            if not value == self.vendor_id:
+                v = Vendor.get_by_id(value)
+                if v is None:
+                    raise MissingVendorError(
+                            'not in inventory: vendor_id(%i)' % value)
+
+        # fail if duplicate name, address or serial_number
+        return self.check_unique(self._changed(kwargs), exclude_id=self.id)
 
 
 class Vendor(SurrogatePK, Model):
@@ -252,11 +259,19 @@ class Vendor(SurrogatePK, Model):
 
     __tablename__ = 'vendor'
     created_at = Column(db.DateTime, nullable=False, default=dt.datetime.utcnow)
+    updated_at = Column(
+            db.DateTime, nullable=False, server_default=db.func.now(),
+            default=dt.datetime.utcnow, onupdate=dt.datetime.utcnow)
     name = Column(db.String(64), unique=False, nullable=False)
     model = Column(db.String(64), unique=False, nullable=False)
     name_id = Column(db.String(128), unique=True, nullable=False)
     capture_agents = relationship('Ca', back_populates='vendor')
 
+    unique_fields = (
+            ('name_id', DuplicateVendorNameModelError,
+             'duplicate vendor name_model(%s)'),
+    )
+
     def __init__(self, name, model):
         """create instance."""
         if self._check_constraints(name=name, model=model):
@@ -291,12 +306,8 @@ class Vendor(SurrogatePK, Model):
         n = kwargs['name'] if 'name' in kwargs.keys() else self.name
         m = kwargs['model'] if 'model' in kwargs.keys() else self.model
         nm = Vendor.computed_name_id(n, m)
-        if not nm == self.name_id:
-            v = Vendor.query.filter_by(name_id=nm).first()
-            if v is not None:
-                raise DuplicateVendorNameModelError(
-                        'duplicate vendor name_model(%s)' % nm)
-        return True
+        return self.check_unique(
+                self._changed({'name_id': nm}), exclude_id=self.id)
 
     @classmethod
     def computed_name_id(cls, name, model):
@@ -308,11 +319,21 @@ class MhCluster(SurrogatePK, NameIdMixin, Model):
 
     __tablename__ = 'mhcluster'
     created_at = Column(db.DateTime, nullable=False, default=dt.datetime.utcnow)
+    updated_at = Column(
+            db.DateTime, nullable=False, server_default=db.func.now(),
+            default=dt.datetime.utcnow, onupdate=dt.datetime.utcnow)
     name = Column(db.String(80), unique=True, nullable=False)
     admin_host = Column(db.String(128), unique=True, nullable=False)
     env = Column(db.String(80), unique=False, nullable=False)
     capture_agents = relationship('Role', back_populates='cluster')
 
+    unique_fields = (
+            ('name', DuplicateMhClusterNameError,
+             'duplicate mh_cluster name(%s)'),
+            ('admin_host', DuplicateMhClusterAdminHostError,
+             'duplicate mh_cluster admin host(%s)'),
+    )
+
 
     def __init__(self, name, admin_host, env):
         """create instance."""
@@ -354,28 +375,13 @@ class MhCluster(SurrogatePK, NameIdMixin, Model):
 
     def _check_constraints(self, **kwargs):
         """raise an error if args violate mh cluster constraints."""
-        for k, value in kwargs.items():
-            if k == 'name':
-                if not value:
-                    raise InvalidEmptyValueError(
-                            'not allowed empty value for `name`')
-                if not value == self.name:
-                    c = MhCluster.query.filter_by(name=value).first()
-                    if c is not None:
-                        raise DuplicateMhClusterNameError(
-                                'duplicate mh_cluster name(%s)' % value)
-                next
-
-            if k == 'admin_host':
-                if not value:
-                    raise InvalidEmptyValueError(
-                            'not allowed empty value for `admin_host`')
-                if not value == self.admin_host:
-                    c = MhCluster.query.filter_by(admin_host=value).first()
-                    if c is not None:
-                        raise DuplicateMhClusterAdminHostError(
-                                'duplicate mh_cluster admin host(%s)' % value)
-        return True
+        for key in ('name', 'admin_host'):
+            if key in kwargs and not kwargs[key]:
+                raise InvalidEmptyValueError(
+                        'not allowed empty value for `%s`' % key)
+
+        # fail if duplicate name or admin_host
+        return self.check_unique(self._changed(kwargs), exclude_id=self.id)
 
     def _get_valid_env(self, env=None):
         """return valid env value: ['prod'|'dev'|'stage']."""
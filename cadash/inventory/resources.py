@@ -1,13 +1,29 @@
 # -*- coding: utf-8 -*-
 """rest resources inventory section."""
+from functools import wraps
+import hashlib
 
+from flask import current_app
+from flask import request
+from flask import Response
+from flask import url_for
 from flask_login import login_required
 from flask_restful import Resource
 from flask_restful import abort
 from flask_restful import fields
+from flask_restful import inputs
 from flask_restful import marshal
 from flask_restful import reqparse
-
+from flask_restful.utils import unpack
+from sqlalchemy import func
+from sqlalchemy import select
+from werkzeug.http import http_date
+from werkzeug.http import quote_etag
+
+from cadash.database import db
+from cadash.inventory.bulk import batch_from_ca_stats
+from cadash.inventory.bulk import import_inventory
+from cadash.inventory.bulk import rows_from_csv
 from cadash.inventory.errors import AssociationError
 from cadash.inventory.errors import DuplicateCaptureAgentNameError
 from cadash.inventory.errors import DuplicateCaptureAgentAddressError
@@ -18,6 +34,7 @@ from cadash.inventory.errors import DuplicateMhClusterNameError
 from cadash.inventory.errors import DuplicateVendorNameModelError
 from cadash.inventory.errors import InvalidCaRoleError
 from cadash.inventory.errors import InvalidEmptyValueError
+from cadash.inventory.errors import InvalidImportDataError
 from cadash.inventory.errors import InvalidMhClusterEnvironmentError
 from cadash.inventory.errors import InvalidOperationError
 from cadash.inventory.errors import MissingVendorError
@@ -98,6 +115,9 @@ def register_resources(api):
     api.add_resource(
             Role_ListAPI,
             '/api/inventory/roles', endpoint='api_rolelist')
+    api.add_resource(
+            Import_API,
+            '/api/inventory/import', endpoint='api_import')
 
 
 def abort_404_if_resource_none(resource, resource_id):
@@ -106,6 +126,131 @@ def abort_404_if_resource_none(resource, resource_id):
         abort(404, message='resource not found (%s)' % resource_id)
 
 
+def tables_state(models):
+    """
+    row count and latest `updated_at` of tables of `models`; single query.
+
+    a change in any record bumps latest `updated_at`; a delete drops count.
+    """
+    columns = []
+    for model in models:
+        table = model.__table__
+        columns.append(select([func.count()]).select_from(table).as_scalar())
+        columns.append(select([func.max(table.c.updated_at)]).as_scalar())
+    return db.session.execute(select(columns)).first()
+
+
+def conditional_get(get):
+    """
+    weak etag and last-modified headers for resource `get`; 304 if unchanged.
+
+    etag is a hash of the url and of state of tables in `self._etag_models`,
+    so an unchanged response costs a single aggregate query, and no
+    marshalling. `If-None-Match` is honored; `If-Modified-Since` is not,
+    since deleted records do not move last-modified.
+    """
+    @wraps(get)
+    def wrapped(self, *args, **kwargs):
+        state = tables_state(self._etag_models)
+        etag = hashlib.sha1((
+                '%s|%s' % (request.full_path, '|'.join([str(v) for v in state]))
+                ).encode('utf-8')).hexdigest()
+        headers = {'ETag': quote_etag(etag, weak=True)}
+        updated = [v for v in state[1::2] if v is not None]
+        if updated and all([hasattr(v, 'utctimetuple') for v in updated]):
+            headers['Last-Modified'] = http_date(max(updated))
+
+        if request.if_none_match.contains_weak(etag):
+            return Response(status=304, headers=headers)
+
+        data, code, result_headers = unpack(get(self, *args, **kwargs))
+        if code == 200:
+            result_headers = dict(result_headers or {}, **headers)
+        return data, code, result_headers
+    return wrapped
+
+
+def select_fields(resource_fields, fields_arg):
+    """
+    subset of `resource_fields` named in comma-separated `fields_arg`.
+
+    all fields if `fields_arg` is empty; 400 if any field is unknown.
+    """
+    if not fields_arg:
+        return resource_fields
+    names = [f.strip() for f in fields_arg.split(',') if f.strip()]
+    unknown = [f for f in names if f not in resource_fields]
+    if unknown:
+        abort(400, message='unknown fields (%s); valid fields: [%s]' % (
+            ','.join(unknown), ','.join(sorted(resource_fields.keys()))))
+    return dict([(f, resource_fields[f]) for f in names])
+
+
+class PagedListMixin(object):
+    """keyset pagination, filters and sparse fieldsets for list resources.
+
+    query args:
+    - `limit`: records per page, default API_PAGE_SIZE, max API_MAX_PAGE_SIZE
+    - `after`: key of last record of previous page
+    - `fields`: comma-separated fields to return, default all
+    - filters added by `_add_filter`
+
+    lists are always paged, so responses stay bounded however big the
+    tables get: a client that wants all records must follow the `Link`
+    header. a page is the json list of its records; if there are more
+    records, `Link` header has the url of next page, as rel="next".
+    """
+
+    def _init_list(self):
+        self._parser_list = reqparse.RequestParser()
+        self._parser_list.add_argument(
+                'limit', type=int, location='args', store_missing=False)
+        self._parser_list.add_argument(
+                'after', type=int, location='args', store_missing=False)
+        self._parser_list.add_argument(
+                'fields', type=str, location='args', store_missing=False)
+        # filter query arg name -> function(value) that returns criterion
+        self._filters = {}
+
+
+    def _add_filter(self, name, arg_type, criterion):
+        """query arg `name` filters list by `criterion(value)`."""
+        self._parser_list.add_argument(
+                name, type=arg_type, location='args', store_missing=False)
+        self._filters[name] = criterion
+
+
+    def _get_page(self, query, key, resource_fields):
+        """marshal a page of `query` records, in order of `key` column."""
+        args = self._parser_list.parse_args()
+
+        limit = args.get('limit', current_app.config['API_PAGE_SIZE'])
+        if limit < 1:
+            abort(400, message='`limit` must be a positive integer')
+        limit = min(limit, current_app.config['API_MAX_PAGE_SIZE'])
+
+        for name, criterion in self._filters.items():
+            if name in args:
+                query = query.filter(criterion(args[name]))
+        if 'after' in args:
+            query = query.filter(key > args['after'])
+
+        # one extra record tells whether there is a next page
+        records = query.order_by(key).limit(limit + 1).all()
+        headers = {}
+        if len(records) > limit:
+            records = records[:limit]
+            next_args = request.args.to_dict()
+            next_args.update(after=getattr(records[-1], key.key), limit=limit)
+            headers['Link'] = '<%s>; rel="next"' % url_for(
+                    request.endpoint, **next_args)
+
+        return marshal(
+                records,
+                select_fields(resource_fields, args.get('fields'))), \
+            200, headers
+
+
 class Resource_API(Resource):
     """base resource for rest api: get, put, delete."""
 
@@ -119,10 +264,13 @@ class Resource_API(Resource):
         self._resource_model_class = globals()[self._resource_model_class_name]
         # arg parser for updates - must be init'd by child class
         self._parser_update = reqparse.RequestParser()
+        # models whose tables responses are built from, for etags
+        self._etag_models = [self._resource_model_class]
         # decorators for authenticated rest-endpoints
         self.method_decorators = [login_required]
 
 
+    @conditional_get
     def get(self, r_id):
         resource = self._resource_model_class.get_by_id(r_id)
         abort_404_if_resource_none(
@@ -168,12 +316,13 @@ class Resource_API(Resource):
         return '', 204
 
 
-class Resource_ListAPI(Resource):
+class Resource_ListAPI(PagedListMixin, Resource):
     """base resource for rest api: get list, post."""
 
     def __init__(self):
         """create instance."""
         super(Resource_ListAPI, self).__init__()
+        self._init_list()
 
         # name of the model class this resource is based on
         self._resource_model_class_name = type(self).__name__.split('_')[0]
@@ -181,15 +330,18 @@ class Resource_ListAPI(Resource):
         self._resource_model_class = globals()[self._resource_model_class_name]
         # arg parser for creates - must be init'd by child class
         self._parser_create = reqparse.RequestParser()
+        # models whose tables responses are built from, for etags
+        self._etag_models = [self._resource_model_class]
         # decorators for authenticated rest-endpoints
         self.method_decorators = [login_required]
 
 
+    @conditional_get
     def get(self):
-        resource_list = self._resource_model_class.query.all()
-        return marshal(
-                resource_list,
-                RESOURCE_FIELDS[self._resource_model_class_name]), 200
+        return self._get_page(
+                self._resource_model_class.query_for('api'),
+                self._resource_model_class.id,
+                RESOURCE_FIELDS[self._resource_model_class_name])
 
     def post(self):
         args = self._parser_create.parse_args()
@@ -221,6 +373,7 @@ class Ca_API(Resource_API):
     def __init__(self):
         """create instance."""
         super(Ca_API, self).__init__()
+        self._etag_models = [Ca, Vendor]
         self._parser_update.add_argument(
                 'name', type=str,
                 location='json', store_missing=False)
@@ -238,6 +391,8 @@ class Ca_ListAPI(Resource_ListAPI):
     def __init__(self):
         """create instance."""
         super(Ca_ListAPI, self).__init__()
+        # vendor marshalled; roles and clusters in filters
+        self._etag_models = [Ca, Vendor, Role, MhCluster]
         self._parser_create.add_argument(
                 'name', type=str, required=True,
                 help='`name` cannot be blank', location='json')
@@ -251,6 +406,20 @@ class Ca_ListAPI(Resource_ListAPI):
                 'serial_number', type=str,
                 location='json', store_missing=False)
 
+        self._add_filter('vendor_id', int, lambda v: Ca.vendor_id == v)
+        self._add_filter(
+                'location_id', int,
+                lambda v: Ca.role.has(Role.location_id == v))
+        self._add_filter(
+                'cluster_id', int,
+                lambda v: Ca.role.has(Role.cluster_id == v))
+        self._add_filter(
+                'role', str, lambda v: Ca.role.has(Role.name == v.lower()))
+        self._add_filter(
+                'env', str,
+                lambda v: Ca.role.has(
+                    Role.cluster.has(MhCluster.env == v.lower())))
+
 
 class Location_API(Resource_API):
     """location resource for rest endpoints."""
@@ -335,6 +504,8 @@ class MhCluster_ListAPI(Resource_ListAPI):
                 'env', type=str, location='json',
                 help='`env` cannot be blank', required=True)
 
+        self._add_filter('env', str, lambda v: MhCluster.env == v.lower())
+
 
 class Role_API(Resource):
     """role resource for rest endpoints."""
@@ -344,8 +515,10 @@ class Role_API(Resource):
         super(Role_API, self).__init__()
 
         self._parser_update = reqparse.RequestParser()
+        self._etag_models = [Role]
 
 
+    @conditional_get
     def get(self, r_id):
         resource = Role.query.filter_by(ca_id=r_id).first()
         abort_404_if_resource_none(resource, 'Role[%i]' % r_id)
@@ -363,12 +536,19 @@ class Role_API(Resource):
         return '', 204
 
 
-class Role_ListAPI(Resource):
+class Role_ListAPI(PagedListMixin, Resource):
     """role resource for rest api: get list, post."""
 
     def __init__(self):
         """create instance."""
         super(Role_ListAPI, self).__init__()
+        self._init_list()
+        self._add_filter('name', str, lambda v: Role.name == v.lower())
+        self._add_filter('location_id', int, lambda v: Role.location_id == v)
+        self._add_filter('cluster_id', int, lambda v: Role.cluster_id == v)
+        self._add_filter(
+                'env', str, lambda v: Role.cluster.has(MhCluster.env == v.lower()))
+        self._etag_models = [Role, MhCluster]
 
         self._parser_create = reqparse.RequestParser()
         self._parser_create.add_argument(
@@ -389,9 +569,10 @@ class Role_ListAPI(Resource):
                 help='`cluster_id` cannot be blank')
 
 
+    @conditional_get
     def get(self):
-        resource_list = Role.query.all()
-        return marshal(resource_list, RESOURCE_FIELDS['Role']), 200
+        return self._get_page(
+                Role.query_for('api'), Role.ca_id, RESOURCE_FIELDS['Role'])
 
     def post(self):
         args = self._parser_create.parse_args()
@@ -404,3 +585,51 @@ class Role_ListAPI(Resource):
             abort(400, message=e.message)
         else:
             return marshal(resource, RESOURCE_FIELDS['Role']), 201
+
+
+class Import_API(Resource):
+    """bulk import (upsert) of inventory records.
+
+    body is one of:
+    - json object: batch, see cadash.inventory.bulk
+    - json list: ca_stats payload; roles are in mh cluster `cluster`
+    - csv (text/csv), with header line: rows of kind `kind`
+
+    query args: `kind`, `cluster`, and `dry_run` to check only.
+    """
+
+    def __init__(self):
+        """create instance."""
+        super(Import_API, self).__init__()
+
+        self._parser_import = reqparse.RequestParser()
+        self._parser_import.add_argument(
+                'kind', type=str, location='args', store_missing=False)
+        self._parser_import.add_argument(
+                'cluster', type=str, location='args', store_missing=False)
+        self._parser_import.add_argument(
+                'dry_run', type=inputs.boolean, location='args', default=False)
+        # decorators for authenticated rest-endpoints
+        self.method_decorators = [login_required]
+
+
+    def post(self):
+        args = self._parser_import.parse_args()
+        try:
+            if request.mimetype == 'text/csv':
+                if 'kind' not in args:
+                    abort(400, message='missing `kind` of csv rows')
+                batch = {args['kind']: rows_from_csv(
+                    request.get_data(as_text=True))}
+            else:
+                data = request.get_json(silent=True)
+                if isinstance(data, list):
+                    batch = batch_from_ca_stats(
+                            data, cluster=args.get('cluster'))
+                else:
+                    batch = data
+            report = import_inventory(batch, commit=not args['dry_run'])
+        except InvalidImportDataError as e:
+            abort(400, message=e.message)
+        else:
+            return report, 200
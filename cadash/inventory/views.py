@@ -25,6 +25,10 @@ from cadash.inventory.forms import MhClusterForm
 from cadash.inventory.forms import RoleDeleteForm
 from cadash.inventory.forms import RoleForm
 from cadash.inventory.forms import VendorForm
+from cadash.inventory.lookups import get_select_list_for_cas
+from cadash.inventory.lookups import get_select_list_for_clusters
+from cadash.inventory.lookups import get_select_list_for_locations
+from cadash.inventory.lookups import get_select_list_for_vendors
 from cadash.inventory.models import Ca
 from cadash.inventory.models import Location
 from cadash.inventory.models import MhCluster
@@ -53,7 +57,7 @@ def home():
 @requires_roles(AUTHORIZED_GROUPS)
 def ca_list():
     """capture agents list."""
-    ca_list = Ca.query.order_by(Ca.name).all()
+    ca_list = Ca.query_for('list').order_by(Ca.name).all()
     return render_template(
             'inventory/capture_agent_list.html',
             version=app_version, record_list=ca_list)
@@ -88,12 +92,6 @@ def ca_create():
             version=app_version, form=form, mode='create')
 
 
-def get_select_list_for_vendors():
-    """return a list of vendor tuples (id, name_id)."""
-    v_list = Vendor.query.order_by(Vendor.name_id).all()
-    return [(v.id, v.name_id) for v in v_list]
-
-
 @blueprint.route('/ca/<int:r_id>', methods=['GET', 'POST'])
 @login_required
 @requires_roles(AUTHORIZED_GROUPS)
@@ -315,7 +313,7 @@ def location_edit(r_id):
 def role_list():
     """role list."""
     form = RoleDeleteForm()
-    r_list = Role.query.all()
+    r_list = Role.query_for('list').all()
     return render_template(
             'inventory/role_list.html',
             version=app_version, record_list=r_list, form=form)
@@ -350,24 +348,6 @@ def role_create():
             version=app_version, form=form, mode='create')
 
 
-def get_select_list_for_cas():
-    """return a list of ca tuples (id, name_id)."""
-    ca_list = Ca.query.filter(Ca.role is None).all()
-    return [(c.id, c.name_id) for c in ca_list]
-
-
-def get_select_list_for_locations():
-    """return a list of location tuples (id, name_id)."""
-    r_list = Location.query.order_by(Location.name).all()
-    return [(r.id, r.name_id) for r in r_list]
-
-
-def get_select_list_for_clusters():
-    """return a list of cluster tuples (id, name_id)."""
-    r_list = MhCluster.query.order_by(MhCluster.name).all()
-    return [(r.id, r.name_id) for r in r_list]
-
-
 @blueprint.route('/role/delete/<int:r_id>', methods=['POST'])
 @login_required
 @requires_roles(AUTHORIZED_GROUPS)
@@ -388,7 +368,7 @@ def role_delete(r_id):
     else:
         flash_errors(form)
 
-    r_list = Role.query.all()
+    r_list = Role.query_for('list').all()
     return render_template(
             'inventory/role_list.html',
             version=app_version, form=form, record_list=r_list)
@@ -1,9 +1,158 @@
 # -*- coding: utf-8 -*-
-"""ldap module, for dce auth via ldap server."""
-from ldap3 import ALL_ATTRIBUTES
-from ldap3 import Connection
-from ldap3 import Server
+"""ldap module, for dce auth via ldap server.
+
+ldap3 is slow to import, and only needed at login; so it is imported on
+first use, not at app startup.
+"""
 import logging
+from multiprocessing.pool import ThreadPool
+import threading
+import time
+
+from cadash.metrics import registry
+
+
+connections_opened = registry.counter(
+        'ldap_connections_opened_total',
+        'ldap connections opened, tls started and bound as service user')
+
+
+class LdapConnectionPool(object):
+    """thread-safe pool of tls connections to ldap server.
+
+    idle connections are kept bound as the service user, at most `size` of
+    them and for at most `max_idle` secs. a connection idle for more than
+    `check_interval` secs is checked with a cheap search before reuse.
+    """
+
+    def __init__(self, host, bind_dn, bind_password, base_search,
+                 size=4, max_idle=300, check_interval=30):
+        """create instance."""
+        self._host = host
+        self._server = None
+        self._usr = bind_dn
+        self._pwd = bind_password
+        self._base_search = base_search
+        self._size = size
+        self._max_idle = max_idle
+        self._check_interval = check_interval
+        self._idle = []  # (last_used, conn), most recently used last
+        self._lock = threading.Lock()
+
+
+    def call(self, fn):
+        """
+        return fn(conn), for a pooled connection bound as service user.
+
+        `fn` must leave conn bound as service user. conn is dropped if `fn`
+        raises; if a reused conn fails with a communication error (e.g.
+        server closed it), call is retried once with a new connection. so it
+        is if a reused conn fails to bind: ldap3 rebind raises LDAPBindError
+        when the server closed the connection.
+        """
+        from ldap3.core.exceptions import LDAPBindError
+        from ldap3.core.exceptions import LDAPCommunicationError
+
+        while True:
+            (conn, reused) = self._checkout()
+            try:
+                result = fn(conn)
+            except (LDAPCommunicationError, LDAPBindError):
+                _close(conn)
+                if reused:
+                    logger = logging.getLogger(__name__)
+                    logger.warning(
+                            'pooled ldap connection broken; reconnecting')
+                    continue
+                raise
+            except Exception:
+                _close(conn)
+                raise
+            self._checkin(conn)
+            return result
+
+
+    def clear(self):
+        """close all idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for (last_used, conn) in idle:
+            _close(conn)
+
+
+    def __len__(self):
+        return len(self._idle)
+
+
+    def _checkout(self):
+        """return (conn, reused): an idle healthy conn, or a new one."""
+        now = time.time()
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                (last_used, conn) = self._idle.pop()
+            if conn.closed or now - last_used > self._max_idle:
+                _close(conn)
+            elif now - last_used > self._check_interval and \
+                    not self._is_healthy(conn):
+                _close(conn)
+            else:
+                return (conn, True)
+        return (self._open(), False)
+
+
+    def _checkin(self, conn):
+        now = time.time()
+        expired = []
+        with self._lock:
+            while self._idle and now - self._idle[0][0] > self._max_idle:
+                expired.append(self._idle.pop(0)[1])
+            if conn.closed or len(self._idle) >= self._size:
+                expired.append(conn)
+            else:
+                self._idle.append((now, conn))
+        for c in expired:
+            _close(c)
+
+
+    def _open(self):
+        from ldap3 import Connection
+        from ldap3 import Server
+        from ldap3.core.exceptions import LDAPBindError
+
+        if self._server is None:
+            self._server = Server(self._host, use_ssl=True)
+        conn = Connection(self._server, user=self._usr, password=self._pwd)
+        conn.open()
+        conn.start_tls()
+        if not conn.bind():
+            _close(conn)
+            raise LDAPBindError('bind usr(%s):pwd unknown' % self._usr)
+        connections_opened.inc()
+        return conn
+
+
+    def _is_healthy(self, conn):
+        from ldap3 import BASE
+        from ldap3.core.exceptions import LDAPException
+
+        try:
+            return conn.search(
+                    self._base_search, '(objectclass=*)', search_scope=BASE)
+        except LDAPException as e:
+            logger = logging.getLogger(__name__)
+            logger.info('dropping idle ldap connection: %s' % e)
+            return False
+
+
+def _close(conn):
+    from ldap3.core.exceptions import LDAPException
+
+    try:
+        conn.unbind()
+    except LDAPException:
+        pass
 
 
 class LdapClient(object):
@@ -11,6 +160,9 @@ class LdapClient(object):
 
     assumes that anonymous connection is _never_ done!
     assumes that init_app() is called before any search or other call to ldap server.
+
+    connections are pooled: tls is started once per connection, and user
+    binds reuse pooled connections, rebound as service user afterwards.
     """
 
     def __init__(self, server=None, bind_dn=None, bind_password=None):
@@ -18,46 +170,186 @@ class LdapClient(object):
         self._server = server
         self._usr = bind_dn
         self._pwd = bind_password
+        self._pool = None
 
 
     def init_app(self, app):
         """init ldap client instance, with configs from app."""
-        self._server = Server(app.config['LDAP_HOST'], use_ssl=True)
+        if self._pool is not None:
+            self._pool.clear()
+        self._host = app.config['LDAP_HOST']
         self._base_search = app.config['LDAP_BASE_SEARCH']
         self._usr = app.config['LDAP_BIND_DN']
         self._pwd = app.config['LDAP_BIND_PASSWD']
+        self._pool = LdapConnectionPool(
+                self._host, self._usr, self._pwd, self._base_search,
+                size=app.config['LDAP_POOL_SIZE'],
+                max_idle=app.config['LDAP_POOL_MAX_IDLE'],
+                check_interval=app.config['LDAP_POOL_CHECK_INTERVAL'])
+        app.extensions['ldap_cli'] = self
 
 
     def is_authenticated(self, username, password):
         """authenticate user with ldap server."""
+        from ldap3.core.exceptions import LDAPBindError
+        from ldap3.core.exceptions import LDAPPasswordIsMandatoryError
+
+        if not password:
+            # rebind would keep the service user password
+            raise LDAPPasswordIsMandatoryError(
+                    'password is mandatory in simple bind')
         u = ('uid=%s,ou=People,' % username) + self._base_search
-        conn = Connection(self._server, user=u, password=password)
-        conn.open()
-        conn.start_tls()
-        result = conn.bind()
-        conn.unbind()
-        return result
 
+        def bind_as_user(conn):
+            try:
+                return conn.rebind(
+                        user=u, password=password, read_server_info=False)
+            finally:
+                if not conn.rebind(
+                        user=self._usr, password=self._pwd,
+                        read_server_info=False):
+                    raise LDAPBindError(
+                            'rebind usr(%s):pwd unknown' % self._usr)
 
-    def fetch_groups(self, username):
-        """fetch all ldap groups `username` belongs to."""
-        result = []
-        conn = Connection(self._server, self._usr, self._pwd)
-        conn.open()
-        conn.start_tls()
-        # TODO: catch some exceptions
-        if conn.bind():
+        return self._pool.call(bind_as_user)
+
+
+    def fetch_groups(self, username, raise_errors=False):
+        """
+        fetch all ldap groups `username` belongs to.
+
+        if service user bind fails, error is logged and no groups returned;
+        unless `raise_errors`, then LDAPBindError is raised.
+        """
+        from ldap3.core.exceptions import LDAPBindError
+
+        def search_groups(conn):
             conn.search(
                     self._base_search,
                     '(&(objectclass=posixGroup)(memberUid=%s))' % username,
-                    attributes=ALL_ATTRIBUTES)
-            for entry in conn.entries:
-                e = entry.entry_get_attributes_dict()
-                group = e['cn'][0] if isinstance(e['cn'], list) else e['cn']
-                result.append(unicode(group))
-        else:
+                    attributes=['cn'])
+            return conn.entries
+
+        result = []
+        try:
+            entries = self._pool.call(search_groups)
+        except LDAPBindError:
+            if raise_errors:
+                raise
             logger = logging.getLogger(__name__)
             logger.error('bind usr(%s):pwd unknown' % self._usr)
+            return result
 
-        conn.unbind()
+        for entry in entries:
+            e = entry.entry_get_attributes_dict()
+            group = e['cn'][0] if isinstance(e['cn'], list) else e['cn']
+            result.append(unicode(group))
         return result
+
+
+class LdapGroupCache(object):
+    """ldap groups per uid, in app cache (shared by workers in prod).
+
+    groups fetched more than `ttl` secs ago are served stale, and refreshed
+    in a background thread; groups are only fetched while the caller waits
+    when not cached at all, or fetched more than `max_stale` secs ago. if a
+    refresh fails, the stale groups are kept.
+    """
+
+    def __init__(self, cli, cache, app=None):
+        """create instance.
+
+        `cli` is an LdapClient, `cache` a flask_cache.Cache.
+        """
+        self._cli = cli
+        self._cache = cache
+        self._app = None
+        self._ttl = 0
+        self._max_stale = 0
+        self._pool = None
+        self._refreshing = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+
+    def init_app(self, app):
+        """init cache with configs from app."""
+        self.shutdown()
+        self._app = app
+        self._ttl = app.config['LDAP_GROUPS_TTL']
+        self._max_stale = app.config['LDAP_GROUPS_MAX_STALE']
+        app.extensions['ldap_groups'] = self
+
+
+    def fetch_groups(self, username, block=True):
+        """
+        groups `username` belongs to, stale for at most `ttl` secs.
+
+        if not `block` and groups not cached, a fetch is started in the
+        background and None returned.
+        """
+        entry = self._cache.get(self._key(username))
+        now = time.time()
+        if entry is not None and now - entry['fetched_at'] < self._max_stale:
+            if now - entry['fetched_at'] >= self._ttl:
+                self.refresh_in_background(username)
+            return list(entry['groups'])
+        if not block:
+            self.refresh_in_background(username)
+            return None
+        return self.refresh(username)
+
+
+    def refresh(self, username):
+        """fetch groups of `username` from directory, and cache them."""
+        groups = self._cli.fetch_groups(username, raise_errors=True)
+        self._cache.set(
+                self._key(username),
+                {'groups': groups, 'fetched_at': time.time()},
+                timeout=self._max_stale)
+        return list(groups)
+
+
+    def refresh_in_background(self, username):
+        """start refresh of `username` groups, if not already refreshing."""
+        with self._lock:
+            if username in self._refreshing:
+                return self._refreshing[username]
+            if self._pool is None:
+                # thread only started on first refresh
+                self._pool = ThreadPool(processes=1)
+            result = self._pool.apply_async(self._run_refresh, (username,))
+            self._refreshing[username] = result
+            return result
+
+
+    def invalidate(self, username):
+        self._cache.delete(self._key(username))
+
+
+    def shutdown(self):
+        """stop refreshing; a running refresh finishes on its own."""
+        with self._lock:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool = None
+            self._refreshing = {}
+
+
+    def _run_refresh(self, username):
+        try:
+            with self._app.app_context():
+                self.refresh(username)
+        except Exception as e:
+            logger = logging.getLogger(__name__)
+            logger.warning(
+                    'failed to refresh ldap groups of user(%s); keeping '
+                    'stale groups. error: %s' % (username, e))
+        finally:
+            with self._lock:
+                self._refreshing.pop(username, None)
+
+
+    def _key(self, username):
+        return 'ldap_groups:%s' % username
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""in-process metrics registry, exposed as text for prometheus-like scrapers.
+
+metrics are per process; each gunicorn worker exposes its own, so a scrape
+through a load balancer gets a different worker's counters each time. scrape
+each worker on its own address (e.g. one gunicorn per port), and sum series
+across workers in the scraper.
+"""
+import bisect
+import threading
+
+DEFAULT_BUCKETS = (
+        0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class _Metric(object):
+    """base for metrics with labels; values are kept per label values."""
+
+    type_name = 'untyped'
+
+    def __init__(self, name, doc, labelnames=()):
+        """create instance."""
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                    'metric(%s) expects labels (%s); got (%s)'
+                    % (self.name, ', '.join(self.labelnames),
+                       ', '.join(sorted(labels))))
+        return tuple([str(labels[l]) for l in self.labelnames])
+
+
+    def get(self, **labels):
+        """current value for `labels`, or None."""
+        return self._values.get(self._key(labels))
+
+
+    def clear(self):
+        with self._lock:
+            self._values = {}
+
+
+    def render(self):
+        """lines of text exposition format for this metric."""
+        lines = [
+                '# HELP %s %s' % (self.name, self.doc),
+                '# TYPE %s %s' % (self.name, self.type_name)]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_value(key, value))
+        return lines
+
+
+    def _render_value(self, key, value):
+        return ['%s%s %s' % (self.name, self._labels_text(key), _number(value))]
+
+
+    def _labels_text(self, key, extra=None):
+        pairs = list(zip(self.labelnames, key))
+        if extra is not None:
+            pairs.append(extra)
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join(
+                ['%s="%s"' % (k, _escape(v)) for k, v in pairs])
+
+
+class Counter(_Metric):
+    """monotonically increasing count."""
+
+    type_name = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """value that goes up and down, e.g. a timestamp."""
+
+    type_name = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    """distribution of observed values, in cumulative buckets."""
+
+    type_name = 'histogram'
+
+    def __init__(self, name, doc, labelnames=(), buckets=DEFAULT_BUCKETS):
+        """create instance."""
+        super(Histogram, self).__init__(name, doc, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = {
+                        'counts': [0] * (len(self.buckets) + 1),
+                        'sum': 0.0,
+                        'count': 0}
+            h = self._values[key]
+            h['counts'][bisect.bisect_left(self.buckets, value)] += 1
+            h['sum'] += value
+            h['count'] += 1
+
+
+    def _render_value(self, key, value):
+        lines = []
+        cumulative = 0
+        bounds = [_number(b) for b in self.buckets] + ['+Inf']
+        for bound, count in zip(bounds, value['counts']):
+            cumulative += count
+            lines.append('%s_bucket%s %i' % (
+                self.name, self._labels_text(key, ('le', bound)), cumulative))
+        lines.append('%s_sum%s %s' % (
+            self.name, self._labels_text(key), _number(value['sum'])))
+        lines.append('%s_count%s %i' % (
+            self.name, self._labels_text(key), value['count']))
+        return lines
+
+
+class MetricsRegistry(object):
+    """named metrics of a process; same name returns same metric."""
+
+    def __init__(self):
+        """create instance."""
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+
+    def counter(self, name, doc, labelnames=()):
+        return self._get_or_create(Counter, name, doc, labelnames)
+
+
+    def gauge(self, name, doc, labelnames=()):
+        return self._get_or_create(Gauge, name, doc, labelnames)
+
+
+    def histogram(self, name, doc, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(
+                Histogram, name, doc, labelnames, buckets=buckets)
+
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+
+    def clear(self):
+        """reset values of all metrics; metrics stay registered."""
+        for metric in self._metrics.values():
+            metric.clear()
+
+
+    def render(self):
+        """all metrics, in text exposition format."""
+        lines = []
+        for name in sorted(self._metrics.keys()):
+            lines.extend(self._metrics[name].render())
+        return '\n'.join(lines) + '\n'
+
+
+    def _get_or_create(self, cls, name, doc, labelnames, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = cls(name, doc, labelnames, **kwargs)
+                self._metrics[name] = metric
+            elif not isinstance(metric, cls) or \
+                    metric.labelnames != tuple(labelnames):
+                raise ValueError(
+                        'metric(%s) already registered as a different metric'
+                        % name)
+            return metric
+
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# process-wide registry
+registry = MetricsRegistry()
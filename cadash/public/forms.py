@@ -6,6 +6,7 @@ from wtforms import StringField
 from wtforms.validators import DataRequired
 
 from cadash.extensions import ldap_cli
+from cadash.extensions import ldap_groups
 from cadash.utils import fetch_ldap_user
 
 
@@ -29,7 +30,8 @@ class LoginForm(Form):
         self.user = fetch_ldap_user(
                 usr=self.username.data,
                 pwd=self.password.data,
-                cli=ldap_cli)
+                cli=ldap_cli,
+                groups=ldap_groups)
         if not self.user:
             self.username.errors.append('Unknown username:password combination')
             return False
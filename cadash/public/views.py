@@ -1,13 +1,16 @@
 # -*- coding: utf-8 -*-
 """Public section, including homepage and signup."""
+import hmac
 import logging
 
 from flask import Blueprint
 from flask import current_app
 from flask import flash
+from flask import jsonify
 from flask import redirect
 from flask import render_template
 from flask import request
+from flask import Response
 from flask import url_for
 from flask_login import current_user
 from flask_login import login_required
@@ -15,8 +18,9 @@ from flask_login import login_user
 from flask_login import logout_user
 
 from cadash import __version__ as app_version
-from cadash.extensions import cache
+from cadash.extensions import user_sessions
 from cadash.extensions import login_manager
+from cadash.metrics import registry
 from cadash.public.forms import LoginForm
 from cadash.utils import flash_errors
 
@@ -26,7 +30,7 @@ blueprint = Blueprint('public', __name__, static_folder='../static')
 @login_manager.user_loader
 def load_user(user_id):
     """Load user by ID."""
-    return cache.get(user_id)
+    return user_sessions.load(user_id)
 
 
 @blueprint.route('/', methods=['GET', 'POST'])
@@ -41,7 +45,7 @@ def home():
     # Handle logging in
     if request.method == 'POST':
         if form.validate_on_submit():
-            cache.set(form.user.username, form.user, timeout=24 * 3600)
+            user_sessions.save(form.user)
             login_user(form.user)
             flash('You are logged in.', 'success')
             redirect_url = request.args.get('next') or url_for('public.home')
@@ -55,7 +59,7 @@ def home():
 @login_required
 def logout():
     """Logout."""
-    cache.delete(current_user.username)
+    user_sessions.revoke(current_user.get_id())
     logout_user()
     flash('You are logged out.', 'info')
     return redirect(url_for('public.home'))
@@ -66,3 +70,42 @@ def about():
     """About page."""
     form = LoginForm(request.form)
     return render_template('public/about.html', form=form, version=app_version)
+
+
+@blueprint.route('/metrics')
+def metrics():
+    """in-process metrics, in prometheus text exposition format."""
+    denied = _deny_metrics()
+    if denied:
+        return denied
+    return Response(
+            registry.render(), mimetype='text/plain; version=0.0.4')
+
+
+@blueprint.route('/metrics/slowest')
+def slowest_endpoints():
+    """rolling table of slowest endpoints, with time per phase."""
+    denied = _deny_metrics()
+    if denied:
+        return denied
+    timer = current_app.extensions['request_timer']
+    return jsonify({'endpoints': timer.slowest(
+        request.args.get('count', 10, type=int))})
+
+
+def _deny_metrics():
+    """error response if metrics disabled or caller not allowed; else None.
+
+    metrics are for logged in users, or for scrapers that send
+    app.config['METRICS_TOKEN'] as bearer token.
+    """
+    if not current_app.config['METRICS_ENABLED']:
+        return 'metrics disabled', 404
+    token = current_app.config['METRICS_TOKEN']
+    if token and hmac.compare_digest(
+            str(request.headers.get('Authorization', '')),
+            str('Bearer %s' % token)):
+        return None
+    if current_user.is_authenticated:
+        return None
+    return 'unauthorized', 401
@@ -0,0 +1,727 @@
+# -*- coding: utf-8 -*-
+"""non-blocking epipearl client, driven by a single poll() event loop.
+
+python 2.7 has no asyncio, so this module provides a minimal equivalent:
+an EventLoop that multiplexes many http requests over non-blocking
+sockets in a single thread, and runs generator-based tasks on top of it.
+host names are resolved in a few helper threads, so a slow dns lookup does
+not stall the loop; calls to a device go through its CircuitBreaker, and
+are instrumented with the same per-device metrics as PearlClient.
+
+a task is a generator that yields an Operation (or another task, or a list
+of them) and is resumed with its result when it is done. a task returns
+a value by raising Return(value), as in trollius::
+
+    def sync(ca):
+        live, lowbr = yield [cli.get_params('3', {'publish_type': ''}),
+                             cli.get_params('4', {'publish_type': ''})]
+        raise Return((live, lowbr))
+
+    loop = EventLoop()
+    cli = AsyncEpipearl('http://ca.example.edu', 'usr', 'pwd', loop=loop)
+    (live, lowbr) = loop.run_until_complete(sync(ca))
+"""
+import base64
+from collections import deque
+import errno
+import fcntl
+import heapq
+import logging
+from multiprocessing.pool import ThreadPool
+import os
+import select
+import socket
+import time
+import types
+
+try:
+    from urllib import urlencode
+    from urlparse import urljoin
+    from urlparse import urlsplit
+except ImportError:  # python 3
+    from urllib.parse import urlencode
+    from urllib.parse import urljoin
+    from urllib.parse import urlsplit
+
+from cadash import __version__
+from cadash.errors import Error
+from cadash.redunlive.client import call_errors
+from cadash.redunlive.client import call_latency
+from cadash.redunlive.client import CircuitBreaker
+from cadash.redunlive.client import CircuitOpenError
+from cadash.redunlive.client import last_success
+from cadash.redunlive.client import parse_params
+
+_default_timeout = 5
+_chunk_size = 8192
+# threads that resolve host names for an event loop
+_resolver_threads = 4
+
+
+class AsyncClientError(Error):
+    """non-blocking http request failed."""
+
+
+class HttpStatusError(AsyncClientError):
+    """http response status is 4xx or 5xx."""
+
+    def __init__(self, status_code, url):
+        """create instance."""
+        super(HttpStatusError, self).__init__(
+                'http status %s for url(%s)' % (status_code, url))
+        self.status_code = status_code
+
+
+class Return(Exception):
+    """raised by a task to return a value, like `return` in a coroutine."""
+
+    def __init__(self, value=None):
+        """create instance."""
+        super(Return, self).__init__(value)
+        self.value = value
+
+
+class Operation(object):
+    """result of an asynchronous operation, set once by the event loop."""
+
+    def __init__(self):
+        """create instance."""
+        self._done = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+
+    @property
+    def done(self):
+        return self._done
+
+
+    def result(self):
+        """return result, or raise exception, of a done operation."""
+        if not self._done:
+            raise AsyncClientError('operation not done')
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+
+    def exception(self):
+        return self._exception
+
+
+    def add_done_callback(self, fn):
+        """call fn(self) when operation is done; right away if already done."""
+        if self._done:
+            fn(self)
+        else:
+            self._callbacks.append(fn)
+
+
+    def set_result(self, result):
+        self._finish(result, None)
+
+
+    def set_exception(self, exception):
+        self._finish(None, exception)
+
+
+    def _finish(self, result, exception):
+        if self._done:
+            return
+        self._done = True
+        self._result = result
+        self._exception = exception
+        callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            fn(self)
+
+
+class Task(Operation):
+    """operation that drives a generator-based task until it returns."""
+
+    def __init__(self, loop, gen):
+        """create instance and schedule first step of `gen`."""
+        super(Task, self).__init__()
+        self._loop = loop
+        self._gen = gen
+        loop.call_soon(self._step, None, None)
+
+
+    def _step(self, value, exception):
+        try:
+            if exception is not None:
+                yielded = self._gen.throw(exception)
+            else:
+                yielded = self._gen.send(value)
+        except Return as r:
+            self.set_result(r.value)
+        except StopIteration:
+            self.set_result(None)
+        except Exception as e:
+            self.set_exception(e)
+        else:
+            op = self._loop.wrap(yielded)
+            op.add_done_callback(self._wakeup)
+
+
+    def _wakeup(self, op):
+        if op.exception() is not None:
+            self._loop.call_soon(self._step, None, op.exception())
+        else:
+            self._loop.call_soon(self._step, op.result(), None)
+
+
+class EventLoop(object):
+    """single-threaded poll() loop for non-blocking sockets and tasks.
+
+    blocking calls, e.g. dns lookups, run in helper threads with
+    `run_in_executor`; call `close()` when done with the loop, to stop them.
+    """
+
+    def __init__(self):
+        """create instance."""
+        self._ready = []
+        self._timers = []
+        self._timer_seq = 0
+        self._readers = {}
+        self._writers = {}
+        self._poll = select.poll()
+        # results of helper threads, and pipe to wake up loop for them
+        self._executor = None
+        self._done_in_executor = deque()
+        self._wakeup = None
+
+
+    def call_soon(self, fn, *args):
+        self._ready.append((fn, args))
+
+
+    def call_later(self, delay, fn, *args):
+        """schedule fn(*args) in `delay` secs; returns a handle to cancel it."""
+        self._timer_seq += 1
+        handle = [time.time() + delay, self._timer_seq, fn, args]
+        heapq.heappush(self._timers, handle)
+        return handle
+
+
+    def cancel_timer(self, handle):
+        handle[2] = None
+
+
+    def add_reader(self, fd, fn):
+        self._readers[fd] = fn
+        self._update_poll(fd)
+
+
+    def remove_reader(self, fd):
+        if self._readers.pop(fd, None) is not None:
+            self._update_poll(fd)
+
+
+    def add_writer(self, fd, fn):
+        self._writers[fd] = fn
+        self._update_poll(fd)
+
+
+    def remove_writer(self, fd):
+        if self._writers.pop(fd, None) is not None:
+            self._update_poll(fd)
+
+
+    def run_in_executor(self, fn, *args):
+        """operation that results in fn(*args), called in a helper thread."""
+        if self._executor is None:
+            (r, w) = os.pipe()
+            for fd in (r, w):
+                _set_nonblocking(fd)
+            self._wakeup = (r, w)
+            self.add_reader(r, self._on_wakeup)
+            self._executor = ThreadPool(processes=_resolver_threads)
+
+        op = Operation()
+        self._executor.apply_async(
+                _call_catching, (fn, args),
+                callback=lambda outcome: self._executor_done(op, outcome))
+        return op
+
+
+    def close(self):
+        """stop helper threads; loop can't run executor calls anymore."""
+        if self._executor is not None:
+            self._executor.terminate()
+            self._executor = None
+            self.remove_reader(self._wakeup[0])
+            for fd in self._wakeup:
+                os.close(fd)
+            self._wakeup = None
+
+
+    def wrap(self, obj):
+        """return an Operation for a task, an operation, or a list of them."""
+        if isinstance(obj, Operation):
+            return obj
+        if isinstance(obj, types.GeneratorType):
+            return Task(self, obj)
+        if isinstance(obj, (list, tuple)):
+            return self.gather(*obj)
+        raise TypeError('cannot wait for object of type %s' % type(obj))
+
+
+    def gather(self, *objs):
+        """operation that results in list of results of all `objs`.
+
+        fails with the first exception, after all of `objs` are done.
+        """
+        ops = [self.wrap(o) for o in objs]
+        outer = Operation()
+        pending = [len(ops)]
+
+        def _one_done(op):
+            pending[0] -= 1
+            if pending[0] == 0:
+                for o in ops:
+                    if o.exception() is not None:
+                        outer.set_exception(o.exception())
+                        return
+                outer.set_result([o.result() for o in ops])
+
+        if not ops:
+            outer.set_result([])
+        for op in ops:
+            op.add_done_callback(_one_done)
+        return outer
+
+
+    def run_until_complete(self, obj, timeout=None):
+        """run loop until `obj` is done; return its result."""
+        op = self.wrap(obj)
+        deadline = None if timeout is None else time.time() + timeout
+        while not op.done:
+            if deadline is not None and time.time() >= deadline:
+                raise socket.timeout('event loop deadline of %ss' % timeout)
+            self._run_once(deadline)
+        return op.result()
+
+
+    def _update_poll(self, fd):
+        mask = (select.POLLIN if fd in self._readers else 0) | \
+            (select.POLLOUT if fd in self._writers else 0)
+        if mask:
+            # registering again modifies events of fd
+            self._poll.register(fd, mask)
+        else:
+            try:
+                self._poll.unregister(fd)
+            except KeyError:
+                pass
+
+
+    def _executor_done(self, op, outcome):
+        # in helper thread: hand outcome to loop thread
+        self._done_in_executor.append((op, outcome))
+        try:
+            os.write(self._wakeup[1], b'x')
+        except (OSError, TypeError):
+            # pipe full: loop is waking up anyway; or loop closed
+            pass
+
+
+    def _on_wakeup(self):
+        try:
+            while os.read(self._wakeup[0], _chunk_size):
+                pass
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+        while self._done_in_executor:
+            (op, (result, exception)) = self._done_in_executor.popleft()
+            if exception is not None:
+                op.set_exception(exception)
+            else:
+                op.set_result(result)
+
+
+    def _run_once(self, deadline=None):
+        # wait for i/o, at most until next timer; don't wait if work to do
+        while self._timers and self._timers[0][2] is None:
+            heapq.heappop(self._timers)
+        if self._ready:
+            wait = 0
+        else:
+            wait = None
+            if self._timers:
+                wait = max(0, self._timers[0][0] - time.time())
+            if deadline is not None:
+                left = max(0, deadline - time.time())
+                wait = left if wait is None else min(wait, left)
+
+        if self._readers or self._writers:
+            try:
+                events = self._poll.poll(
+                        None if wait is None else int(wait * 1000))
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                events = []
+            for fd, event in events:
+                # errors and hangups are seen by whoever reads or writes next
+                if event & (select.POLLIN | select.POLLHUP | select.POLLERR) \
+                        and fd in self._readers:
+                    self._readers[fd]()
+                if event & (select.POLLOUT | select.POLLHUP | select.POLLERR) \
+                        and fd in self._writers:
+                    self._writers[fd]()
+        elif wait:
+            time.sleep(wait)
+
+        now = time.time()
+        while self._timers and self._timers[0][0] <= now:
+            handle = heapq.heappop(self._timers)
+            if handle[2] is not None:
+                handle[2](*handle[3])
+
+        # run callbacks scheduled so far; new ones wait for next iteration
+        ready, self._ready = self._ready, []
+        for fn, args in ready:
+            fn(*args)
+
+
+def _call_catching(fn, args):
+    """(fn(*args), None), or (None, exception) if it raises."""
+    try:
+        return (fn(*args), None)
+    except Exception as e:
+        return (None, e)
+
+
+def _set_nonblocking(fd):
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+
+class HttpPipeline(Operation):
+    """non-blocking http/1.1 GETs, pipelined on a single connection.
+
+    all `urls` must be on the same host; requests are written back-to-back
+    before reading any response, and the last one asks the server to close
+    the connection. results in list of (status_code, body), in order.
+    """
+
+    def __init__(self, loop, urls, headers, timeout):
+        """create instance and start connecting to host in `urls`."""
+        super(HttpPipeline, self).__init__()
+        self._loop = loop
+        self._urls = urls
+        parts = urlsplit(urls[0])
+        self._host = parts.hostname
+        self._port = parts.port or 80
+
+        out = []
+        for i, url in enumerate(urls):
+            u = urlsplit(url)
+            path = u.path or '/'
+            if u.query:
+                path = '%s?%s' % (path, u.query)
+            lines = ['GET %s HTTP/1.1' % path, 'Host: %s' % parts.netloc]
+            lines.extend(['%s: %s' % (k, v) for k, v in headers.items()])
+            lines.append('Connection: %s' % (
+                'close' if i == len(urls) - 1 else 'keep-alive'))
+            out.append('\r\n'.join(lines) + '\r\n\r\n')
+        self._out = ''.join(out).encode('latin-1')
+        self._in = []
+
+        self._sock = None
+        self._timer = loop.call_later(timeout, self._on_timeout)
+        if _is_ip_address(self._host):
+            self._connect(socket.getaddrinfo(
+                self._host, self._port, 0, socket.SOCK_STREAM,
+                0, socket.AI_NUMERICHOST))
+        else:
+            # dns lookup blocks; done in a helper thread
+            resolving = loop.run_in_executor(
+                    socket.getaddrinfo, self._host, self._port, 0,
+                    socket.SOCK_STREAM)
+            resolving.add_done_callback(self._on_resolved)
+
+
+    def _on_resolved(self, op):
+        if self.done:
+            return  # timed out while resolving
+        if op.exception() is not None:
+            return self._fail(op.exception())
+        self._connect(op.result())
+
+
+    def _connect(self, addrinfo):
+        try:
+            self._open(addrinfo)
+        except socket.error as e:
+            self._fail(e)
+
+
+    def _open(self, addrinfo):
+        family, socktype, proto, cname, addr = addrinfo[0]
+        self._sock = socket.socket(family, socktype, proto)
+        self._sock.setblocking(0)
+        err = self._sock.connect_ex(addr)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            raise socket.error(err, errno.errorcode.get(err, str(err)))
+        self._loop.add_writer(self._sock.fileno(), self._on_writable)
+
+
+    def _on_writable(self):
+        try:
+            err = self._sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                raise socket.error(err, errno.errorcode.get(err, str(err)))
+            sent = self._sock.send(self._out)
+            self._out = self._out[sent:]
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            return self._fail(e)
+        if not self._out:
+            self._loop.remove_writer(self._sock.fileno())
+            self._loop.add_reader(self._sock.fileno(), self._on_readable)
+
+
+    def _on_readable(self):
+        try:
+            data = self._sock.recv(_chunk_size)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            return self._fail(e)
+        if data:
+            self._in.append(data)
+            return
+
+        # connection closed by server: all responses are in
+        self._close()
+        try:
+            responses = parse_http_responses(b''.join(self._in), len(self._urls))
+        except ValueError as e:
+            return self.set_exception(AsyncClientError(
+                'malformed response from url(%s): %s' % (self._urls[0], e)))
+        for url, (status_code, body) in zip(self._urls, responses):
+            if status_code >= 400:
+                return self.set_exception(HttpStatusError(status_code, url))
+        self.set_result(responses)
+
+
+    def _on_timeout(self):
+        self._fail(socket.timeout('timed out for url(%s)' % self._urls[0]))
+
+
+    def _fail(self, exception):
+        self._close()
+        self.set_exception(exception)
+
+
+    def _close(self):
+        self._loop.cancel_timer(self._timer)
+        if self._sock is not None:
+            self._loop.remove_writer(self._sock.fileno())
+            self._loop.remove_reader(self._sock.fileno())
+            self._sock.close()
+            self._sock = None
+
+
+def _is_ip_address(host):
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, host)
+            return True
+        except (socket.error, ValueError):
+            pass
+    return False
+
+
+class HttpRequest(HttpPipeline):
+    """non-blocking http GET; results in (status_code, body)."""
+
+    def __init__(self, loop, url, headers, timeout):
+        """create instance and start connecting to host in `url`."""
+        super(HttpRequest, self).__init__(loop, [url], headers, timeout)
+
+
+    def set_result(self, result):
+        super(HttpRequest, self).set_result(result[0])
+
+
+def parse_http_responses(raw, count):
+    """return list of `count` (status_code, body_text) from raw http bytes.
+
+    body length is given by content-length or chunked transfer encoding;
+    otherwise body is all bytes up to connection close.
+    """
+    result = []
+    pos = 0
+    for i in range(count):
+        end = raw.find(b'\r\n\r\n', pos)
+        if end < 0:
+            raise ValueError('missing end of headers in response #%i' % i)
+        lines = raw[pos:end].decode('latin-1').split('\r\n')
+        pos = end + 4
+        try:
+            status_code = int(lines[0].split()[1])
+        except (IndexError, ValueError):
+            raise ValueError('invalid status line(%s)' % lines[0])
+        headers = {}
+        for line in lines[1:]:
+            (key, sep, value) = line.partition(':')
+            headers[key.strip().lower()] = value.strip()
+
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            (body, pos) = _read_chunked(raw, pos)
+        elif 'content-length' in headers:
+            length = int(headers['content-length'])
+            if len(raw) < pos + length:
+                raise ValueError('truncated body in response #%i' % i)
+            body = raw[pos:pos + length]
+            pos += length
+        elif status_code in (204, 304) or status_code < 200:
+            body = b''
+        else:
+            body = raw[pos:]
+            pos = len(raw)
+        result.append((status_code, body.decode('utf-8', 'replace')))
+    return result
+
+
+def _read_chunked(raw, pos):
+    chunks = []
+    while True:
+        eol = raw.find(b'\r\n', pos)
+        if eol < 0:
+            raise ValueError('truncated chunked body')
+        size = int(raw[pos:eol].split(b';')[0], 16)
+        pos = eol + 2
+        if size == 0:
+            # skip trailers
+            end = raw.find(b'\r\n', pos)
+            while end > pos:
+                pos = end + 2
+                end = raw.find(b'\r\n', pos)
+            return (b''.join(chunks), pos + 2)
+        chunks.append(raw[pos:pos + size])
+        pos += size + 2
+
+
+class AsyncEpipearl(object):
+    """non-blocking counterpart of epipearl.Epipearl get_params/set_params.
+
+    methods return Operation objects, to be yielded from a task or run with
+    `loop.run_until_complete()`. as with PearlClient, calls are cut short by
+    `breaker` while the device keeps failing; pass the breaker of the
+    device PearlClient to share its health.
+    """
+
+    def __init__(self, base_url, user, passwd, loop, timeout=None,
+                 breaker=None):
+        """create instance."""
+        self.url = base_url if base_url.endswith('/') else base_url + '/'
+        self.user = user
+        self.passwd = passwd
+        self.loop = loop
+        self.timeout = timeout or _default_timeout
+        self.breaker = breaker or CircuitBreaker(base_url)
+        # device label for metrics, e.g. host:port
+        self.device = urlsplit(base_url).netloc or base_url
+        creds = base64.b64encode(
+                ('%s:%s' % (user, passwd)).encode('utf-8')).decode('ascii')
+        self.default_headers = {
+                'User-Agent': '%s/%s' % (__name__, __version__),
+                'Accept': 'text/html, text/*',
+                'Authorization': 'Basic %s' % creds,
+                'X-REQUESTED-AUTH': 'Basic'}
+
+
+    def get(self, path, params=None):
+        """GET `path` relative to base url; results in (status, body)."""
+        url = urljoin(self.url, path)
+        if params:
+            url = '%s?%s' % (url, urlencode(sorted(params.items())))
+        return HttpRequest(self.loop, url, self.default_headers, self.timeout)
+
+
+    def get_batch(self, paths, params=None):
+        """GET all `paths` pipelined in one connection; results in list."""
+        query = '?%s' % urlencode(sorted(params.items())) if params else ''
+        urls = [urljoin(self.url, p) + query for p in paths]
+        return HttpPipeline(self.loop, urls, self.default_headers, self.timeout)
+
+
+    def get_params(self, channel, params=None):
+        """operation that results in dict of params, as Epipearl.get_params."""
+        op = self._instrumented('get_params', lambda: self.get(
+                'admin/channel%s/get_params.cgi' % channel, params=params))
+        return self._then(op, lambda r: parse_params(r[1]))
+
+
+    def get_params_batch(self, channels, params=None):
+        """operation that results in list of get_params dicts for `channels`.
+
+        all requests are pipelined in one connection, so reading many
+        channels of a device costs about one round trip.
+        """
+        op = self._instrumented('get_params_batch', lambda: self.get_batch(
+                ['admin/channel%s/get_params.cgi' % c for c in channels],
+                params=params))
+        return self._then(op, lambda rs: [parse_params(r[1]) for r in rs])
+
+
+    def set_params(self, channel, params):
+        """operation that results in True if params set, as Epipearl.set_params."""
+        op = self._instrumented('set_params', lambda: self.get(
+                'admin/channel%s/set_params.cgi' % channel, params=params))
+        return self._then(op, lambda r: 2 == (r[0] // 100))
+
+
+    def _instrumented(self, op_name, start_request):
+        """operation of `start_request()`, through breaker and metrics."""
+        if not self.breaker.allow():
+            e = CircuitOpenError(self.url, self.breaker.retry_at)
+            call_errors.inc(device=self.device, op=op_name, error=type(e).__name__)
+            op = Operation()
+            op.set_exception(e)
+            return op
+
+        start = time.time()
+        op = start_request()
+
+        def _done(o):
+            end = time.time()
+            call_latency.observe(end - start, device=self.device, op=op_name)
+            e = o.exception()
+            if e is None or isinstance(e, HttpStatusError):
+                # device answered, even if with an http error
+                self.breaker.record_success()
+            else:
+                self.breaker.record_failure()
+            if e is None:
+                last_success.set(end, device=self.device)
+            else:
+                call_errors.inc(
+                        device=self.device, op=op_name, error=type(e).__name__)
+
+        op.add_done_callback(_done)
+        return op
+
+
+    def _then(self, op, fn):
+        derived = Operation()
+
+        def _done(o):
+            if o.exception() is not None:
+                derived.set_exception(o.exception())
+            else:
+                try:
+                    derived.set_result(fn(o.result()))
+                except Exception as e:
+                    logger = logging.getLogger(__name__)
+                    logger.debug('failed to process response. error: %s' % e)
+                    derived.set_exception(e)
+
+        op.add_done_callback(_done)
+        return derived
@@ -0,0 +1,511 @@
+# -*- coding: utf-8 -*-
+"""epipearl client that keeps http connections alive, for redunlive."""
+from epipearl import Epipearl
+import logging
+import socket
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
+
+from cadash.metrics import registry
+from cadash.timing import record_phase
+
+try:
+    from httplib import HTTPException
+    from httplib import HTTPResponse
+    from urlparse import urljoin
+    from urlparse import urlsplit
+except ImportError:  # python 3
+    from http.client import HTTPException
+    from http.client import HTTPResponse
+    from urllib.parse import urljoin
+    from urllib.parse import urlsplit
+
+
+# per-device instrumentation of epipearl calls
+call_latency = registry.histogram(
+        'epipearl_call_duration_seconds',
+        'latency of epipearl calls, per device and operation',
+        labelnames=('device', 'op'))
+call_errors = registry.counter(
+        'epipearl_call_errors_total',
+        'failed epipearl calls, per device, operation and error type',
+        labelnames=('device', 'op', 'error'))
+last_success = registry.gauge(
+        'epipearl_last_success_timestamp_seconds',
+        'unix time of last successful epipearl call, per device',
+        labelnames=('device',))
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """device is known to be unreachable; call not even tried."""
+
+    def __init__(self, url, retry_at):
+        """create instance."""
+        super(CircuitOpenError, self).__init__(
+                'circuit open for (%s) until %s' % (url, time.ctime(retry_at)))
+        self.url = url
+        self.retry_at = retry_at
+
+
+class CircuitBreaker(object):
+    """health of a device, as seen by its client.
+
+    after `threshold` consecutive failures the circuit opens, and calls fail
+    right away for `backoff` secs; then one probe call is let through
+    (half-open): if ok, the circuit closes; if not, it opens again for twice
+    as long, up to `max_backoff` secs.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name, threshold=3, backoff=30, max_backoff=300):
+        """create instance."""
+        self.name = name
+        self.threshold = threshold
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._state = self.CLOSED
+        self._failures = 0
+        self._current_backoff = backoff
+        self._retry_at = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+
+    @property
+    def state(self):
+        return self._state
+
+
+    @property
+    def failures(self):
+        return self._failures
+
+
+    @property
+    def retry_at(self):
+        return self._retry_at
+
+
+    def allow(self):
+        """True if a call to device can be tried now."""
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN:
+                if time.time() < self._retry_at:
+                    return False
+                self._set_state(self.HALF_OPEN)
+            # half-open: a single probe at a time
+            if self._probing:
+                return False
+            self._probing = True
+            return True
+
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._probing = False
+            self._current_backoff = self.backoff
+            if self._state != self.CLOSED:
+                self._set_state(self.CLOSED)
+
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN:
+                self._probing = False
+                self._current_backoff = min(
+                        self._current_backoff * 2, self.max_backoff)
+                self._open()
+            elif self._state == self.CLOSED and \
+                    self._failures >= self.threshold:
+                self._open()
+
+
+    def _open(self):
+        self._retry_at = time.time() + self._current_backoff
+        self._set_state(self.OPEN)
+
+
+    def _set_state(self, state):
+        logger = logging.getLogger(__name__)
+        logger.warning(
+                'device(%s) circuit %s -> %s (failures: %i, backoff: %ss)'
+                % (self.name, self._state, state,
+                   self._failures, self._current_backoff))
+        self._state = state
+
+
+class PearlClient(Epipearl):
+    """epipearl client over a requests.Session.
+
+    consecutive calls to the same device reuse one kept-alive connection,
+    and pay tcp setup only once. batch reads are pipelined on a kept-alive
+    connection of their own. calls to a device that keeps failing are cut
+    short by a CircuitBreaker, and raise CircuitOpenError.
+    """
+
+    def __init__(self, base_url, user, passwd, timeout=None, pool_size=4,
+                 breaker=None):
+        """create instance.
+
+        `pool_size` is max number of kept-alive connections to the device,
+        for concurrent calls from different threads.
+        """
+        super(PearlClient, self).__init__(base_url, user, passwd, timeout)
+        self.session = requests.Session()
+        self.session.auth = HTTPBasicAuth(user, passwd)
+        self.session.headers.update(self.default_headers)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.breaker = breaker or CircuitBreaker(base_url)
+        # device label for metrics, e.g. host:port
+        self.device = urlsplit(base_url).netloc or base_url
+        self._pipeline = None
+        self._pipeline_lock = threading.Lock()
+
+
+    def get_params(self, channel, params=None):
+        return self._instrumented(
+                'get_params', super(PearlClient, self).get_params,
+                channel, params)
+
+
+    def set_params(self, channel, params):
+        return self._instrumented(
+                'set_params', super(PearlClient, self).set_params,
+                channel, params)
+
+
+    def get(self, path, params=None, extra_headers=None):
+        return self._request(
+                self.session.get, path,
+                params=params or {}, headers=extra_headers)
+
+
+    def post(self, path, data=None, extra_headers=None):
+        return self._request(
+                self.session.post, path,
+                data=data or {}, headers=extra_headers)
+
+
+    def _instrumented(self, op, call, *args):
+        start = time.time()
+        try:
+            result = call(*args)
+        except CircuitOpenError as e:
+            # device not even tried; no latency to record
+            call_errors.inc(device=self.device, op=op, error=type(e).__name__)
+            raise
+        except Exception as e:
+            elapsed = time.time() - start
+            call_latency.observe(elapsed, device=self.device, op=op)
+            call_errors.inc(device=self.device, op=op, error=type(e).__name__)
+            # only recorded if called from the request thread
+            record_phase('http', elapsed)
+            raise
+        end = time.time()
+        call_latency.observe(end - start, device=self.device, op=op)
+        record_phase('http', end - start)
+        last_success.set(end, device=self.device)
+        return result
+
+
+    def _request(self, method, path, **kwargs):
+        if not self.breaker.allow():
+            raise CircuitOpenError(self.url, self.breaker.retry_at)
+        try:
+            resp = method(
+                    urljoin(self.url, path), timeout=self.timeout, **kwargs)
+        except Exception:
+            self.breaker.record_failure()
+            raise
+        # device answered, even if with an http error
+        self.breaker.record_success()
+        resp.raise_for_status()
+        return resp
+
+
+    def get_params_batch(self, channels, params=None):
+        """get_params for each of `channels`, pipelined on one connection.
+
+        all requests are written before any response is read, so the batch
+        costs one round trip. channels left unanswered, e.g. if the device
+        closed the connection after the first response, are read one by one;
+        as is the whole batch if another thread is using the pipeline.
+
+        returns list of dicts, in the same order as `channels`.
+        """
+        if not self._pipeline_lock.acquire(False):
+            return [self.get_params(channel=c, params=params) for c in channels]
+        paths = ['admin/channel%s/get_params.cgi' % c for c in channels]
+        try:
+            responses = self._instrumented(
+                    'get_params_batch', self._pipelined, paths, params or {})
+        finally:
+            self._pipeline_lock.release()
+
+        results = []
+        for (channel, path, response) in zip(channels, paths, responses):
+            if response is None:
+                results.append(self.get_params(channel=channel, params=params))
+                continue
+            (status, text) = response
+            if status >= 400:
+                raise requests.HTTPError('%s error for url: %s' % (
+                    status, urljoin(self.url, path)))
+            results.append(parse_params(text))
+        return results
+
+
+    def close(self):
+        self.session.close()
+        with self._pipeline_lock:
+            self._close_pipeline()
+
+
+    def _pipelined(self, paths, params):
+        """
+        GET `paths` pipelined, on the kept-alive pipeline connection.
+
+        returns list of (status, text) per path; None if left unanswered. a
+        pipeline that the device closed while idle is reopened once.
+        """
+        payload = b''.join([self._raw_request(p, params) for p in paths])
+        if not self.breaker.allow():
+            raise CircuitOpenError(self.url, self.breaker.retry_at)
+        while True:
+            reused = self._pipeline is not None
+            try:
+                if not reused:
+                    self._open_pipeline()
+                self._pipeline.sendall(payload)
+                # buffered reads, shared by all responses of this batch
+                reader = _SharedReader(self._pipeline.makefile('rb'))
+                responses = [self._read_response(reader)]
+            except socket.timeout as e:
+                self._close_pipeline()
+                self.breaker.record_failure()
+                raise requests.ConnectionError(
+                        'pipeline to (%s) timed out: %s' % (self.device, e))
+            except (socket.error, HTTPException) as e:
+                connected = self._pipeline is not None
+                self._close_pipeline()
+                if reused:
+                    continue
+                if not connected:
+                    self.breaker.record_failure()
+                    raise requests.ConnectionError(
+                            'pipeline to (%s) failed: %s' % (self.device, e))
+                # device took the connection, but does not pipeline; it is
+                # up, and a half-open probe must not be left pending
+                self.breaker.record_success()
+                logger = logging.getLogger(__name__)
+                logger.info(
+                        'device(%s) closed pipeline unanswered; reading one '
+                        'by one: %s' % (self.device, e))
+                return [None] * len(paths)
+            break
+
+        # device answered
+        self.breaker.record_success()
+        for path in paths[1:]:
+            if self._pipeline is None:
+                responses.append(None)
+                continue
+            try:
+                responses.append(self._read_response(reader))
+            except (socket.error, HTTPException) as e:
+                logger = logging.getLogger(__name__)
+                logger.info(
+                        'device(%s) pipeline cut short; reading one by one: %s'
+                        % (self.device, e))
+                self._close_pipeline()
+                responses.append(None)
+        reader.close_file()
+        return responses
+
+
+    def _raw_request(self, path, params):
+        prepared = self.session.prepare_request(requests.Request(
+            'GET', urljoin(self.url, path), params=params,
+            # responses are read raw, so not compressed
+            headers={'Accept-Encoding': 'identity'}))
+        parts = urlsplit(prepared.url)
+        target = parts.path + ('?%s' % parts.query if parts.query else '')
+        lines = ['GET %s HTTP/1.1' % target, 'Host: %s' % parts.netloc]
+        lines.extend(['%s: %s' % h for h in prepared.headers.items()])
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+
+    def _read_response(self, reader):
+        resp = HTTPResponse(reader, method='GET')
+        resp.begin()
+        body = resp.read()
+        if resp.will_close:
+            self._close_pipeline()
+        return (resp.status, body.decode('utf-8', 'replace'))
+
+
+    def _open_pipeline(self):
+        parts = urlsplit(self.url)
+        self._pipeline = socket.create_connection(
+                (parts.hostname, parts.port or 80), timeout=self.timeout)
+
+
+    def _close_pipeline(self):
+        if self._pipeline is not None:
+            sock, self._pipeline = self._pipeline, None
+            try:
+                sock.close()
+            except socket.error:
+                pass
+
+
+class _SharedReader(object):
+    """buffered file of a pipelined connection, shared by its responses.
+
+    HTTPResponse closes its file when done; here that would throw away the
+    buffered bytes of the responses that follow.
+    """
+
+    def __init__(self, fp):
+        """create instance."""
+        self._fp = fp
+
+
+    def makefile(self, *args, **kwargs):
+        return self
+
+
+    def close(self):
+        pass
+
+
+    def close_file(self):
+        self._fp.close()
+
+
+    def __getattr__(self, name):
+        return getattr(self._fp, name)
+
+
+def parse_params(text):
+    """parse `key = value` lines of a get_params.cgi response into a dict."""
+    result = {}
+    for line in text.splitlines():
+        if '=' in line:
+            (key, value) = [x.strip() for x in line.split('=', 1)]
+            result[key] = value
+    return result
+
+
+class PearlClientRegistry(object):
+    """process-wide registry of long-lived PearlClient objects.
+
+    clients are keyed by capture agent serial_number and reused across
+    requests, so their kept-alive connections are too. a client is dropped
+    when idle for more than `max_idle` secs, or when the device address
+    changes.
+    """
+
+    def __init__(self, user=None, passwd=None, timeout=None,
+                 max_idle=300, pool_size=4, breaker_config=None):
+        """create instance.
+
+        `breaker_config` is dict of kwargs for each client CircuitBreaker.
+        """
+        self._user = user
+        self._passwd = passwd
+        self._timeout = timeout
+        self._max_idle = max_idle
+        self._pool_size = pool_size
+        self._breaker_config = breaker_config or {}
+        self._clients = {}
+        self._lock = threading.Lock()
+
+
+    def init_app(self, app):
+        """init registry with configs from app."""
+        self.clear()
+        self._user = app.config['EPIPEARL_USER']
+        self._passwd = app.config['EPIPEARL_PASSWD']
+        self._max_idle = app.config['EPIPEARL_CLIENT_MAX_IDLE']
+        self._pool_size = app.config['EPIPEARL_CLIENT_POOL_SIZE']
+        self._breaker_config = {
+                'threshold': app.config['EPIPEARL_BREAKER_THRESHOLD'],
+                'backoff': app.config['EPIPEARL_BREAKER_BACKOFF'],
+                'max_backoff': app.config['EPIPEARL_BREAKER_MAX_BACKOFF']}
+        app.extensions['pearl_clients'] = self
+
+
+    def get(self, serial_number, address):
+        """return client for device `serial_number` at `address`."""
+        now = time.time()
+        with self._lock:
+            self._evict_idle(now)
+            entry = self._clients.get(serial_number)
+            if entry is not None and entry['address'] != address:
+                logger = logging.getLogger(__name__)
+                logger.info(
+                        'CA(%s) address changed from (%s) to (%s); new client'
+                        % (serial_number, entry['address'], address))
+                entry['client'].close()
+                entry = None
+            if entry is None:
+                entry = {
+                        'address': address,
+                        'client': PearlClient(
+                            'http://%s' % address, self._user, self._passwd,
+                            timeout=self._timeout, pool_size=self._pool_size,
+                            breaker=CircuitBreaker(
+                                address, **self._breaker_config))}
+                self._clients[serial_number] = entry
+            entry['last_used'] = now
+            return entry['client']
+
+
+    def invalidate(self, serial_number):
+        """drop client for `serial_number`, if any."""
+        with self._lock:
+            entry = self._clients.pop(serial_number, None)
+        if entry is not None:
+            entry['client'].close()
+
+
+    def evict_idle(self):
+        """drop all clients idle for more than `max_idle` secs."""
+        with self._lock:
+            self._evict_idle(time.time())
+
+
+    def clear(self):
+        with self._lock:
+            clients, self._clients = self._clients, {}
+        for entry in clients.values():
+            entry['client'].close()
+
+
+    def __len__(self):
+        return len(self._clients)
+
+
+    def __contains__(self, serial_number):
+        return serial_number in self._clients
+
+
+    def _evict_idle(self, now):
+        idle = [k for k, v in self._clients.items()
+                if now - v['last_used'] > self._max_idle]
+        for k in idle:
+            self._clients.pop(k)['client'].close()
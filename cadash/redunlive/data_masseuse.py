@@ -1,90 +1,397 @@
 # -*- coding: utf-8 -*-
 
-from epipearl import Epipearl
+from collections import namedtuple
 import logging
+from multiprocessing.pool import ThreadPool
+import threading
+import time
 
 from flask import current_app
 
 from cadash.redunlive.models import CaptureAgent
 from cadash.redunlive.models import CaLocation
+from cadash.timing import phase
 
-__all__ = ('map_redunlive_ca_loc')
+__all__ = (
+        'bulk_switch_live_stream', 'map_redunlive_ca_loc',
+        'prep_redunlive_data', 'switch_live_stream')
 
 
-def map_redunlive_ca_loc(data):
+def prep_redunlive_data(loc_ids=None):
+    """read and parse data for redunlive.
+
+    :param: loc_ids: only map (and sync) these locations; default all
     """
-    massage json list of capture agents into list of locations.
+    # cached for CA_STATS_TTL secs, and shared: read-only!
+    with phase('ca_stats'):
+        (data, version) = current_app.extensions['ca_stats'].get_versioned_json(
+                current_app.config['CA_STATS_JSON_URL'],
+                creds={
+                    'user': current_app.config['CA_STATS_USER'],
+                    'pwd': current_app.config['CA_STATS_PASSWD']
+                    })
+    return map_redunlive_ca_loc(data, loc_ids=loc_ids, version=version)
 
-    :param: data: json string with list of dicts of CAs properties
+
+def switch_live_stream(loc_id, active_device):
+    """
+    switch live stream of location `loc_id` to `active_device`.
+
+    devices are read fresh from ca_stats, and the switch-over is skipped if
+    the location has no active live stream.
+
+    :return: location active_livestream, after switch-over
     """
-    all_locations = {}
-    all_cas = {}
+    data = prep_redunlive_data(loc_ids=[loc_id])
+    if loc_id not in data['all_locations']:
+        raise KeyError('unknown location (%s)' % loc_id)
+    location = data['all_locations'][loc_id]
 
-    for ca_item in data:
-        loc_id = CaLocation.clean_name(ca_item['location'])
+    if location.active_livestream is None:
+        return None  # do not start/stop if no active streaming!
 
-        # create location object if not in internal map of locations
-        if loc_id not in all_locations:
-            all_locations[loc_id] = CaLocation(ca_item['location'])
-        loc = all_locations[loc_id]
+    return location.switch_active_livestream(
+            active_device,
+            delay=current_app.config['REDUNLIVE_SWITCH_DELAY'],
+            pause=current_app.config['REDUNLIVE_SWITCH_PAUSE'])
 
-        # check required ca_item property "address"
-        logger = logging.getLogger(__name__)
-        if 'address' not in ca_item:
-            logger.warning(
-                    'missing "address" for capture agent in location(%s)'
-                    % ca_item['location'])
-            continue
 
-        # check required ca_item property "serial_number"
-        serial_number = None
-        if 'ca_attributes' in ca_item and \
-                'serial_number' in ca_item['ca_attributes']:
-            serial_number = ca_item['ca_attributes']['serial_number']
+def bulk_switch_live_stream(loc_ids, active_device, max_parallel=None):
+    """
+    switch live stream of all locations in `loc_ids` to `active_device`.
+
+    ca_stats is pulled once, and switch-overs run concurrently, one thread
+    per location with an active live stream, so the whole batch takes
+    about the time of a single switch-over. a switch-over only talks to the
+    devices of its own location, one request at a time, so it never needs
+    more than one connection per device; `max_parallel` only caps threads.
+
+    :param: max_parallel: default REDUNLIVE_BULK_MAX_PARALLEL
+    :return: list of dicts with per-location results, in `loc_ids` order;
+        status is one of 'switched', 'skipped' (no active live stream),
+        or 'failed'
+    """
+    if active_device not in ('primary', 'secondary'):
+        raise ValueError(
+                'active_device must be "primary" or "secondary"; got (%s)'
+                % active_device)
+    if max_parallel is None:
+        max_parallel = current_app.config['REDUNLIVE_BULK_MAX_PARALLEL']
+    delay = current_app.config['REDUNLIVE_SWITCH_DELAY']
+    pause = current_app.config['REDUNLIVE_SWITCH_PAUSE']
+
+    data = prep_redunlive_data(loc_ids=loc_ids)
+    logger = logging.getLogger(__name__)
+
+    results = []
+    to_switch = []
+    for loc_id in loc_ids:
+        result = {'loc_id': loc_id, 'active_livestream': None, 'error': None}
+        results.append(result)
+        location = data['all_locations'].get(loc_id)
+        if location is None:
+            result['status'] = 'failed'
+            result['error'] = 'unknown location (%s)' % loc_id
+        elif location.active_livestream is None:
+            result['status'] = 'skipped'
         else:
-            logger.warning(
-                    'missing "serial_number" for CA(%s) in location(%s)'
-                    % (ca_item['address'], ca_item['location']))
+            to_switch.append((location, result))
+
+    def switch_one(item):
+        (location, result) = item
+        try:
+            result['active_livestream'] = location.switch_active_livestream(
+                    active_device, delay=delay, pause=pause)
+        except Exception as e:
+            logger.error(
+                    'location(%s) failed to switch to %s. error: %s'
+                    % (result['loc_id'], active_device, e))
+            result['status'] = 'failed'
+            result['error'] = str(e)
+        else:
+            result['status'] = 'switched' \
+                    if result['active_livestream'] == active_device else 'failed'
+
+    if to_switch:
+        pool = ThreadPool(processes=max(1, min(max_parallel, len(to_switch))))
+        try:
+            pool.map(switch_one, to_switch)
+        finally:
+            pool.close()
+            pool.join()
+    return results
+
+
+class CaSpec(namedtuple('CaSpec', [
+        'loc_id', 'location', 'role', 'serial_number', 'address',
+        'live', 'lowBR'])):
+    """static info of a capture agent entry in ca_stats.
+
+    `live` and `lowBR` are (channel, publish_type) pairs, publish_type as
+    last reported by ca_stats; `serial_number` is None for entries missing
+    required info, which only count for their location.
+    """
+
+    __slots__ = ()
+
+
+class TopologyCache(object):
+    """
+    locations and capture agents built from a ca_stats payload.
+
+    the topology is kept across calls, and patched when ca_stats changes:
+    entries equal to the previous payload's keep their CaSpec, and only
+    locations whose specs changed are built again. `version`, the ca_stats
+    fetcher version of the payload, skips even the comparison while ca_stats
+    is not fetched again.
+
+    built objects are never handed out: each call gets shallow copies of
+    the locations it asks for, since syncing changes their live status.
+    """
+
+    def __init__(self):
+        """create instance."""
+        self._lock = threading.Lock()
+        self.clear()
+
+
+    def clear(self):
+        """forget topology; next call builds it from scratch."""
+        self._version = None
+        self._entries = []
+        self._specs = []
+        self._loc_specs = {}
+        self._loc_cas = {}
+        self._locations = {}
+        self._cas = {}
+
+
+    def get(self, data, version=None, loc_ids=None):
+        """
+        return (all_locations, all_cas) for payload `data`, as copies.
+
+        :param: version: ca_stats version of `data`, if known
+        :param: loc_ids: only these locations, and their capture agents
+        """
+        with self._lock:
+            if version is None or version != self._version:
+                if data != self._entries:
+                    self._patch(data)
+                self._version = version
+            (locations, cas) = (self._locations, self._cas)
+
+        copies = {}
+        all_locations = dict([
+            (loc_id, loc.copy(cas=copies)) for loc_id, loc in locations.items()
+            if loc_ids is None or loc_id in loc_ids])
+        all_cas = dict([
+            (serial_number, copies[id(ca)]) for serial_number, ca in cas.items()
+            if id(ca) in copies])
+        return (all_locations, all_cas)
+
+
+    def _patch(self, data):
+        """update topology to payload `data`; caller holds lock."""
+        specs = []
+        for i, ca_item in enumerate(data):
+            if i < len(self._entries) and ca_item == self._entries[i]:
+                specs.append(self._specs[i])
+            else:
+                specs.append(_parse_ca_item(ca_item))
+
+        # specs per location, in order of first appearance
+        loc_order = []
+        loc_specs = {}
+        for spec in specs:
+            if spec.loc_id not in loc_specs:
+                loc_order.append(spec.loc_id)
+                loc_specs[spec.loc_id] = []
+            loc_specs[spec.loc_id].append(spec)
+
+        locations = {}
+        loc_cas = {}
+        all_cas = {}
+        rebuilt = 0
+        for loc_id in loc_order:
+            loc_specs[loc_id] = tuple(loc_specs[loc_id])
+            if self._loc_specs.get(loc_id) == loc_specs[loc_id]:
+                locations[loc_id] = self._locations[loc_id]
+                loc_cas[loc_id] = self._loc_cas[loc_id]
+            else:
+                (locations[loc_id], loc_cas[loc_id]) = \
+                    _build_location(loc_specs[loc_id])
+                rebuilt += 1
+            for ca in loc_cas[loc_id]:
+                all_cas[ca.serial_number] = ca
+
+        logger = logging.getLogger(__name__)
+        logger.info(
+                'ca_stats topology changed: %i of %i locations rebuilt'
+                % (rebuilt, len(loc_order)))
+        self._entries = data
+        self._specs = specs
+        self._loc_specs = loc_specs
+        self._loc_cas = loc_cas
+        self._locations = locations
+        self._cas = all_cas
+
+
+# topology is keyed by ca_stats content, so it is shared process-wide
+_topology = TopologyCache()
+
+
+def _build_location(specs):
+    """(location, list of its capture agents) from its CaSpecs `specs`."""
+    loc = CaLocation(specs[0].location)
+    cas = []
+    for spec in specs:
+        # entry missing required info
+        if spec.serial_number is None:
             continue
 
-        ca = CaptureAgent(serial_number, ca_item['address'])
+        ca = CaptureAgent(spec.serial_number, spec.address)
 
-        if ca_item['role'] == 'Primary':
+        if spec.role == 'Primary':
             loc.primary_ca = ca
-        elif ca_item['role'] == 'Secondary':
+        elif spec.role == 'Secondary':
             loc.secondary_ca = ca
         else:
             # not too worried about 'experimental' capture agents right now
             loc.experimental_cas.append(ca)
 
-        # find the live streaming channel
-        if 'channels' in ca_item['ca_attributes'] and \
-                isinstance(ca_item['ca_attributes']['channels'], dict):
-            for chan, info in ca_item['ca_attributes']['channels'].iteritems():
-                if 'live' in info['name'].lower():
-                    if 'lowbr' not in info['name'].lower():
-                        ca.channels['live']['channel'] = chan if chan else 'not available'
-                        if 'publish_type' in info:
-                            ca.channels['live']['publish_type'] = info['publish_type']
-                    else:
-                        ca.channels['lowBR']['channel'] = chan if chan else 'not available'
-                        if 'publish_type' in info:
-                            ca.channels['lowBR']['publish_type'] = info['publish_type']
-
-        # add ca to internal list of ca's
-        all_cas[ca.serial_number] = ca
-
-        # sync capture agent object with actual device
-        set_epipearl_client(ca)
+        for name in ('live', 'lowBR'):
+            (ca.channels[name]['channel'],
+             ca.channels[name]['publish_type']) = getattr(spec, name)
+
+        cas.append(ca)
+    return (loc, cas)
+
+
+def _parse_ca_item(ca_item):
+    """parse ca_stats entry `ca_item` into a CaSpec."""
+    spec = {
+            'loc_id': CaLocation.clean_name(ca_item['location']),
+            'location': ca_item['location'],
+            'role': ca_item.get('role'),
+            'serial_number': None,
+            'address': None,
+            'live': ('not available', 'not available'),
+            'lowBR': ('not available', 'not available')}
+
+    # check required ca_item property "address"
+    logger = logging.getLogger(__name__)
+    if 'address' not in ca_item:
+        logger.warning(
+                'missing "address" for capture agent in location(%s)'
+                % ca_item['location'])
+        return CaSpec(**spec)
+
+    # check required ca_item property "serial_number"
+    if 'ca_attributes' in ca_item and \
+            'serial_number' in ca_item['ca_attributes']:
+        spec['serial_number'] = ca_item['ca_attributes']['serial_number']
+        spec['address'] = ca_item['address']
+    else:
+        logger.warning(
+                'missing "serial_number" for CA(%s) in location(%s)'
+                % (ca_item['address'], ca_item['location']))
+        return CaSpec(**spec)
+
+    # find the live streaming channel
+    if 'channels' in ca_item['ca_attributes'] and \
+            isinstance(ca_item['ca_attributes']['channels'], dict):
+        for chan, info in ca_item['ca_attributes']['channels'].iteritems():
+            if 'live' in info['name'].lower():
+                name = 'live' if 'lowbr' not in info['name'].lower() else 'lowBR'
+                spec[name] = (
+                        chan if chan else 'not available',
+                        info['publish_type'] if 'publish_type' in info
+                        else spec[name][1])
+    return CaSpec(**spec)
+
+
+def map_redunlive_ca_loc(data, loc_ids=None, version=None):
+    """
+    massage json list of capture agents into list of locations.
+
+    :param: data: json string with list of dicts of CAs properties
+    :param: loc_ids: only map (and sync) these locations; default all
+    :param: version: ca_stats version of `data`, if known
+    """
+    (all_locations, all_cas) = _topology.get(
+            data, version=version, loc_ids=loc_ids)
 
-    # end __for ca_item in data__
+    # sync capture agent objects with actual devices
+    sync_all_live_status([all_cas[k] for k in sorted(all_cas.keys())])
 
     return {'all_locations': all_locations, 'all_cas': all_cas}
 
 
+def sync_all_live_status(ca_list, workers=None, timeout=None):
+    """
+    sync live status of all capture agents in `ca_list` concurrently.
+
+    devices are queried in a pool of at most `workers` threads; devices that
+    do not answer within `timeout` seconds are left as they are, so the
+    total time is about the time of the slowest device, capped by `timeout`.
+    workers sync copies of the capture agents, and only status synced
+    before deadline is merged back: late devices never change `ca_list`.
+
+    :param: ca_list: list of CaptureAgent objects
+    :param: workers: max number of threads, default EPIPEARL_SYNC_WORKERS
+    :param: timeout: deadline in seconds, default EPIPEARL_SYNC_TIMEOUT
+    :return: list of CaptureAgent objects that did not sync before deadline
+    """
+    if not ca_list:
+        return []
+
+    logger = logging.getLogger(__name__)
+    if workers is None:
+        workers = current_app.config['EPIPEARL_SYNC_WORKERS']
+    if timeout is None:
+        timeout = current_app.config['EPIPEARL_SYNC_TIMEOUT']
+
+    # epipearl clients are set in request context, since worker threads
+    # do not have access to current_app
+    for ca in ca_list:
+        set_epipearl_client(ca)
+
+    pool = ThreadPool(processes=max(1, min(workers, len(ca_list))))
+    try:
+        with phase('devices'):
+            pending = [(ca, pool.apply_async(_synced_copy, (ca,)))
+                       for ca in ca_list]
+            deadline = time.time() + timeout
+            not_synced = []
+            for ca, result in pending:
+                result.wait(max(0, deadline - time.time()))
+                if not result.ready():
+                    not_synced.append(ca)
+                elif not result.successful():
+                    logger.warning(
+                            'CA(%s) failed to sync live status' % ca.name)
+                else:
+                    ca.merge_status(result.get())
+    finally:
+        # do not join: stragglers finish on their own, within epipearl
+        # timeout, and their results are dropped
+        pool.close()
+
+    if not_synced:
+        logger.warning(
+                'CAs(%s) did not sync live status within %ss' %
+                (', '.join([ca.name for ca in not_synced]), timeout))
+    return not_synced
+
+
+def _synced_copy(ca):
+    """sync a copy of `ca`, and return it."""
+    synced = ca.copy()
+    synced.sync_live_status()
+    return synced
+
+
 def set_epipearl_client(ca):
-    ca.client = Epipearl(
-            'http://%s' % ca.address,
-            current_app.config['EPIPEARL_USER'],
-            current_app.config['EPIPEARL_PASSWD'])
-    ca.sync_live_status()
+    """set long-lived client, shared by all requests, for capture agent."""
+    ca.client = current_app.extensions['pearl_clients'].get(
+            ca.serial_number, ca.address)
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""background jobs, for long-running redunlive actions like switch-over."""
+import logging
+from multiprocessing.pool import ThreadPool
+import threading
+import uuid
+
+import arrow
+
+
+class LocationBusyError(Exception):
+    """a location targeted by a job already has a job running."""
+
+    def __init__(self, location, job_id):
+        """create instance."""
+        super(LocationBusyError, self).__init__(
+                'location(%s) already has a job running (%s)'
+                % (location, job_id))
+        self.location = location
+        self.job_id = job_id
+
+
+class Job(object):
+    """state of a function call running in background.
+
+    `target` is an optional location id, or list of location ids, the job
+    acts upon.
+    """
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, description='', target=None):
+        """create instance."""
+        self.id = uuid.uuid4().hex
+        self.description = description
+        self.target = target
+        self.state = self.PENDING
+        self.result = None
+        self.error = None
+        self.created_at = arrow.utcnow()
+        self.finished_at = None
+        self._finished = threading.Event()
+
+
+    @property
+    def finished(self):
+        return self.state in (self.DONE, self.FAILED)
+
+
+    @property
+    def targets(self):
+        """list of location ids the job acts upon."""
+        if self.target is None:
+            return []
+        return self.target if isinstance(self.target, list) else [self.target]
+
+
+    def wait(self, timeout=None):
+        """block until job finished or `timeout` secs; True if finished.
+
+        only jobs submitted by this process can be waited on.
+        """
+        self._finished.wait(timeout)
+        return self.finished
+
+
+    def to_dict(self):
+        return {
+                'id': self.id,
+                'description': self.description,
+                'target': self.target,
+                'state': self.state,
+                'result': self.result,
+                'error': self.error,
+                'created_at': self.created_at.isoformat(),
+                'finished_at': self.finished_at.isoformat()
+                if self.finished_at else None}
+
+
+    @classmethod
+    def from_dict(cls, data):
+        """job as saved by another process; cannot be waited on."""
+        job = cls(description=data['description'], target=data['target'])
+        job.id = data['id']
+        job.state = data['state']
+        job.result = data['result']
+        job.error = data['error']
+        job.created_at = arrow.get(data['created_at'])
+        if data['finished_at']:
+            job.finished_at = arrow.get(data['finished_at'])
+            job._finished.set()
+        return job
+
+
+class JobRunner(object):
+    """run jobs in a pool of background threads, within app context.
+
+    job state is kept in app cache (redis in prod), so all processes see
+    it, for app.config['REDUNLIVE_JOB_TTL'] secs after the job finishes.
+    locations targeted by a job are locked in app cache while it runs, so a
+    location is never switched by two jobs at once; locks expire after
+    REDUNLIVE_JOB_TIMEOUT secs, in case the process running the job dies.
+    """
+
+    def __init__(self, cache, app=None):
+        """create instance.
+
+        `cache` is a flask_cache.Cache.
+        """
+        self._cache = cache
+        self._store = None
+        self._app = None
+        self._workers = 1
+        self._ttl = 0
+        self._timeout = 0
+        self._pool = None
+        self._jobs = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+
+    def init_app(self, app):
+        """init runner with configs from app; after cache init."""
+        self.shutdown()
+        self._app = app
+        # cache backend; jobs write to it from threads, outside app context
+        self._store = app.extensions['cache'][self._cache]
+        self._workers = app.config['REDUNLIVE_JOB_WORKERS']
+        self._ttl = app.config['REDUNLIVE_JOB_TTL']
+        self._timeout = app.config['REDUNLIVE_JOB_TIMEOUT']
+        self._jobs = {}
+        app.extensions['redunlive_jobs'] = self
+
+
+    @property
+    def last_finished_at(self):
+        """time the most recent job, of any process, finished; or None."""
+        finished_at = self._store.get('redunlive_jobs:last_finished_at')
+        return arrow.get(finished_at) if finished_at else None
+
+
+    def submit(self, fn, args=(), kwargs=None, description='', target=None):
+        """
+        queue call `fn(*args, **kwargs)`; return Job right away.
+
+        raises LocationBusyError if a location in `target` has a job
+        running; then nothing is queued.
+        """
+        job = Job(description=description, target=target)
+        self._lock_targets(job)
+        self._save(job)
+        with self._lock:
+            self._prune()
+            self._jobs[job.id] = job
+            if self._pool is None:
+                # threads only started on first job
+                self._pool = ThreadPool(processes=self._workers)
+            self._pool.apply_async(self._run, (job, fn, args, kwargs or {}))
+        return job
+
+
+    def get(self, job_id):
+        """return job with `job_id`, submitted by any process; or None."""
+        job = self._jobs.get(job_id)
+        if job is not None:
+            return job
+        data = self._store.get(self._job_key(job_id))
+        return Job.from_dict(data) if data else None
+
+
+    def running(self, locations):
+        """map of location id, of ids in `locations`, to its running job."""
+        locations = list(locations)
+        if not locations:
+            return {}
+        job_ids = self._store.get_many(
+                *[self._lock_key(l) for l in locations])
+        running = {}
+        for loc_id, job_id in zip(locations, job_ids):
+            if job_id:
+                job = self.get(job_id)
+                if job is not None and not job.finished:
+                    running[loc_id] = job
+        return running
+
+
+    def active(self):
+        """list of jobs of this process not finished yet, oldest first."""
+        return sorted(
+                [j for j in self._jobs.values() if not j.finished],
+                key=lambda j: j.created_at)
+
+
+    def shutdown(self):
+        """stop accepting jobs; running jobs finish on their own."""
+        with self._lock:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool = None
+
+
+    def _run(self, job, fn, args, kwargs):
+        logger = logging.getLogger(__name__)
+        job.state = Job.RUNNING
+        self._save(job)
+        state = Job.DONE
+        try:
+            with self._app.app_context():
+                job.result = fn(*args, **kwargs)
+        except Exception as e:
+            logger.error(
+                    'job(%s) "%s" failed. error: %s' % (job.id, job.description, e))
+            job.error = str(e)
+            state = Job.FAILED
+        else:
+            logger.info('job(%s) "%s" done' % (job.id, job.description))
+        finally:
+            job.finished_at = arrow.utcnow()
+            job.state = state
+            try:
+                self._save(job)
+                self._store.set(
+                        'redunlive_jobs:last_finished_at',
+                        job.finished_at.isoformat(), timeout=self._ttl)
+            finally:
+                self._unlock_targets(job)
+                job._finished.set()
+
+
+    def _lock_targets(self, job):
+        locked = []
+        for loc_id in job.targets:
+            if not self._store.add(
+                    self._lock_key(loc_id), job.id, timeout=self._timeout):
+                for l in locked:
+                    self._store.delete(self._lock_key(l))
+                raise LocationBusyError(
+                        loc_id, self._store.get(self._lock_key(loc_id)))
+            locked.append(loc_id)
+
+
+    def _unlock_targets(self, job):
+        for loc_id in job.targets:
+            key = self._lock_key(loc_id)
+            if self._store.get(key) == job.id:
+                self._store.delete(key)
+
+
+    def _save(self, job):
+        timeout = self._ttl if job.finished else self._timeout + self._ttl
+        self._store.set(self._job_key(job.id), job.to_dict(), timeout=timeout)
+
+
+    def _prune(self):
+        now = arrow.utcnow()
+        expired = [k for k, j in self._jobs.items() if j.finished and
+                   (now - j.finished_at).total_seconds() > self._ttl]
+        for k in expired:
+            del self._jobs[k]
+
+
+    def _job_key(self, job_id):
+        return 'redunlive_job:%s' % job_id
+
+
+    def _lock_key(self, loc_id):
+        return 'redunlive_lock:%s' % loc_id
@@ -2,8 +2,13 @@
 """models for redunlive module."""
 import arrow
 import logging
+import requests
+import time
 
 from cadash import utils
+from cadash.redunlive.async_client import HttpStatusError
+from cadash.redunlive.async_client import Return
+from cadash.redunlive.client import CircuitOpenError
 
 
 class CaptureAgent(object):
@@ -22,6 +27,7 @@ class CaptureAgent(object):
         self._name = self.clean_name(name)
 
         self.client = None
+        self.async_client = None
         self._last_update = arrow.get(2000, 1, 1)
 
         # for now, the livestream channel# must be set externally
@@ -40,6 +46,20 @@ class CaptureAgent(object):
         return utils.clean_name(name)
 
 
+    def copy(self):
+        """proxy of the same device, with its own copy of channels state."""
+        ca = object.__new__(self.__class__)
+        ca.__dict__.update(self.__dict__)
+        ca.channels = dict([(k, dict(v)) for k, v in self.channels.items()])
+        return ca
+
+
+    def merge_status(self, synced):
+        """take live status, and its time, from `synced` copy of self."""
+        self.channels = synced.channels
+        self._last_update = synced.last_update
+
+
     @property
     def serial_number(self):
         return self._serial_number
@@ -60,6 +80,13 @@ class CaptureAgent(object):
         return self._name
 
 
+    @property
+    def health(self):
+        """state of device circuit breaker, or 'unknown' if client has none."""
+        breaker = getattr(self.client, 'breaker', None)
+        return breaker.state if breaker is not None else 'unknown'
+
+
     def __get_channel_publish_type(self, chan_name):
         chan = self.channels[chan_name]
 
@@ -80,6 +107,9 @@ class CaptureAgent(object):
                     'device(%s) channel(%s)=(%s) publish_type=(%s)' %
                     (self.name, chan_name, chan['channel'], response))
 
+        except CircuitOpenError as e:
+            logger.debug('CA(%s) skipped: %s' % (self.name, e))
+            return 'not available'
         except Exception as e:
             logger.warning(
                     'CA(%s) unable to get channel(%s) publish_type. error: %s' %
@@ -102,6 +132,9 @@ class CaptureAgent(object):
                     channel=self.channels[chan_name]['channel'],
                     params={'publish_type': value})
             self._last_update = arrow.utcnow()
+        except CircuitOpenError as e:
+            logger.debug('CA(%s) skipped: %s' % (self.name, e))
+            return 'not available'
         except Exception as e:
             logger.warning(
                     'CA(%s) unable to set channel(%s) publish_type to %s. error: %s'
@@ -115,19 +148,56 @@ class CaptureAgent(object):
             return value
 
 
+    def __get_live_publish_types(self):
+        """
+        read publish_type of 'live' and 'lowBR' channels in a single batch.
+
+        falls back to one read per channel if client cannot batch, or if the
+        device answered the batch with an http error.
+        """
+        live = self.channels['live']['channel']
+        lowBR = self.channels['lowBR']['channel']
+        batch = getattr(self.client, 'get_params_batch', None)
+        if batch is None or 'not available' in (live, lowBR):
+            return (self.__get_channel_publish_type('live'),
+                    self.__get_channel_publish_type('lowBR'))
+
+        logger = logging.getLogger(__name__)
+        try:
+            response = batch(
+                    channels=[live, lowBR], params={'publish_type': ''})
+            self._last_update = arrow.utcnow()
+        except requests.HTTPError as e:
+            logger.warning(
+                    'CA(%s) unable to batch read live/lowBR publish_type; '
+                    'reading one by one. error: %s' % (self.name, e.message))
+            return (self.__get_channel_publish_type('live'),
+                    self.__get_channel_publish_type('lowBR'))
+        except CircuitOpenError as e:
+            logger.debug('CA(%s) skipped: %s' % (self.name, e))
+            return ('not available', 'not available')
+        except Exception as e:
+            logger.warning(
+                    'CA(%s) unable to get live/lowBR publish_type. error: %s' %
+                    (self.name, e.message))
+            return ('not available', 'not available')
+        else:
+            return tuple([r['publish_type'] if 'publish_type' in r
+                          else 'not available' for r in response])
+
+
     def sync_live_status(self):
         """
         refresh status of local object with info from capture agent.
 
-        read publish_type from capture agent, both 'live' and 'lowBR' channels,
-        and refresh status of local object
+        read publish_type from capture agent, both 'live' and 'lowBR' channels
+        in a single batch, and refresh status of local object
         if channels have diverging live status, try to set 'lowBR' publish_type
         as the same as 'live'
         """
         logger = logging.getLogger(__name__)
         logger.debug('in sync_live_status for device(%s)' % self.name)
-        live = self.__get_channel_publish_type('live')
-        lowBR = self.__get_channel_publish_type('lowBR')
+        (live, lowBR) = self.__get_live_publish_types()
 
         if live == lowBR:
             self.channels['live']['publish_type'] = live
@@ -152,6 +222,114 @@ class CaptureAgent(object):
             self.channels['lowBR']['publish_type'] = value
 
 
+    def __get_channel_publish_type_async(self, chan_name):
+        """task version of __get_channel_publish_type, for async_client."""
+        chan = self.channels[chan_name]
+        if chan['channel'] == 'not available' or self.async_client is None:
+            raise Return('not available')
+
+        logger = logging.getLogger(__name__)
+        try:
+            response = yield self.async_client.get_params(
+                    channel=chan['channel'], params={'publish_type': ''})
+            self._last_update = arrow.utcnow()
+        except Exception as e:
+            logger.warning(
+                    'CA(%s) unable to get channel(%s) publish_type. error: %s' %
+                    (self.name, chan_name, e))
+            raise Return('not available')
+        else:
+            raise Return(response['publish_type']
+                         if 'publish_type' in response else 'not available')
+
+
+    def __set_channel_publish_type_async(self, chan_name, value):
+        """task version of __set_channel_publish_type, for async_client."""
+        chan = self.channels[chan_name]
+        if chan['channel'] == 'not available' or self.async_client is None:
+            raise Return('not available')
+
+        logger = logging.getLogger(__name__)
+        try:
+            yield self.async_client.set_params(
+                    channel=chan['channel'], params={'publish_type': value})
+            self._last_update = arrow.utcnow()
+        except Exception as e:
+            logger.warning(
+                    'CA(%s) unable to set channel(%s) publish_type to %s. error: %s'
+                    % (self.name, chan_name, value, e))
+            raise Return('not available')
+        else:
+            logger.warning(
+                    'CA(%s) channel(%s) publish_type set to %s'
+                    % (self.name, chan_name, value))
+            raise Return(value)
+
+
+    def __get_live_publish_types_async(self):
+        """task version of __get_live_publish_types, for async_client."""
+        live = self.channels['live']['channel']
+        lowBR = self.channels['lowBR']['channel']
+        if self.async_client is None or 'not available' in (live, lowBR):
+            result = yield [
+                    self.__get_channel_publish_type_async('live'),
+                    self.__get_channel_publish_type_async('lowBR')]
+            raise Return(tuple(result))
+
+        logger = logging.getLogger(__name__)
+        try:
+            response = yield self.async_client.get_params_batch(
+                    channels=[live, lowBR], params={'publish_type': ''})
+            self._last_update = arrow.utcnow()
+        except HttpStatusError as e:
+            logger.warning(
+                    'CA(%s) unable to batch read live/lowBR publish_type; '
+                    'reading one by one. error: %s' % (self.name, e))
+            result = yield [
+                    self.__get_channel_publish_type_async('live'),
+                    self.__get_channel_publish_type_async('lowBR')]
+            raise Return(tuple(result))
+        except Exception as e:
+            logger.warning(
+                    'CA(%s) unable to get live/lowBR publish_type. error: %s' %
+                    (self.name, e))
+            raise Return(('not available', 'not available'))
+        else:
+            raise Return(tuple([r['publish_type'] if 'publish_type' in r
+                                else 'not available' for r in response]))
+
+
+    def sync_live_status_async(self):
+        """
+        task version of sync_live_status, using `async_client`.
+
+        'live' and 'lowBR' channels are read in one pipelined batch; to be
+        run in a cadash.redunlive.async_client.EventLoop.
+        """
+        (live, lowBR) = yield self.__get_live_publish_types_async()
+
+        value = lowBR
+        if live != lowBR:
+            logger = logging.getLogger(__name__)
+            logger.warning(
+                    'CA(%s) publish_type for live/lowBR (%s/%s); trying to fix...'
+                    % (self.name, live, lowBR))
+            value = yield self.__set_channel_publish_type_async('lowBR', live)
+
+        self.channels['live']['publish_type'] = live
+        self.channels['lowBR']['publish_type'] = value
+
+
+    def write_live_status_async(self, publish_type):
+        """task version of write_live_status, using `async_client`."""
+        (live, lowBR) = yield [
+                self.__set_channel_publish_type_async('live', publish_type),
+                self.__set_channel_publish_type_async('lowBR', publish_type)]
+        self.channels['live']['publish_type'] = live
+        self.channels['lowBR']['publish_type'] = lowBR
+        raise Return(publish_type)
+
+
     def write_live_status(self, publish_type):
         """set capture agent live status for both 'live' and 'lowBR' channels."""
         self.channels['live']['publish_type'] = \
@@ -205,6 +383,28 @@ class CaLocation(object):
         return utils.clean_name(name)
 
 
+    def copy(self, cas=None):
+        """
+        location with copies of its capture agents.
+
+        :param: cas: dict to add copied capture agents to, keyed by
+            id() of the original
+        """
+        cas = {} if cas is None else cas
+        loc = object.__new__(self.__class__)
+        loc.__dict__.update(self.__dict__)
+        for attr in ('_primary_ca', '_secondary_ca'):
+            ca = getattr(self, attr)
+            if ca is not None:
+                cas[id(ca)] = ca.copy()
+                setattr(loc, attr, cas[id(ca)])
+        loc.experimental_cas = []
+        for ca in self.experimental_cas:
+            cas[id(ca)] = ca.copy()
+            loc.experimental_cas.append(cas[id(ca)])
+        return loc
+
+
     @property
     def id(self):
         return self._id
@@ -252,6 +452,45 @@ class CaLocation(object):
         return None
 
 
+    def switch_active_livestream(self, active_device, delay=2, pause=1):
+        """
+        switch live stream of location to `active_device`.
+
+        streaming device is started before the other is stopped, and `delay`
+        secs are given for the start to settle; toggling from secondary to
+        primary also stops secondary for `pause` secs and starts it again as
+        backup, so akamai detects the switch for sure.
+
+        :param: active_device: 'primary' or 'secondary'
+        :return: location active_livestream after devices are re-synced
+        """
+        if active_device == 'primary':
+            # start primary streaming
+            self.primary_ca.write_live_status('6')
+            time.sleep(delay)
+            # stop backup streaming so akamai detect that for sure
+            self.secondary_ca.write_live_status('0')
+            time.sleep(pause)
+            # start backup streaming again
+            self.secondary_ca.write_live_status('6')
+        elif active_device == 'secondary':
+            # make sure secondary is streaming
+            self.secondary_ca.write_live_status('6')
+            time.sleep(delay)
+            # stop streaming primary
+            self.primary_ca.write_live_status('0')
+            time.sleep(pause)
+        else:
+            raise ValueError(
+                    'active_device must be "primary" or "secondary"; got (%s)'
+                    % active_device)
+
+        # make sure we have the device status
+        self.primary_ca.sync_live_status()
+        self.secondary_ca.sync_live_status()
+        return self.active_livestream
+
+
     def __repr__(self):
         return self._id
 
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""background poller of capture agents live status, for redunlive."""
+from collections import namedtuple
+import copy
+import logging
+import threading
+
+import arrow
+
+from cadash.redunlive.data_masseuse import prep_redunlive_data
+
+
+def location_state(loc):
+    """json-able live status of location `loc`, to detect changes."""
+    def ca_state(ca):
+        if ca is None:
+            return None
+        return {
+                'name': ca.name,
+                'health': ca.health,
+                'channels': copy.deepcopy(ca.channels)}
+
+    return {
+            'id': loc.id,
+            'active_livestream': loc.active_livestream,
+            'primary': ca_state(loc.primary_ca),
+            'secondary': ca_state(loc.secondary_ca)}
+
+
+def version_of(t):
+    """time `t` (arrow) as an int token, microsecs since epoch."""
+    return t.timestamp * 1000000 + t.microsecond
+
+
+class Snapshot(namedtuple(
+        'Snapshot', ['locations', 'taken_at', 'states', 'changed_at'])):
+    """immutable view of all locations live status at time `taken_at`.
+
+    `locations` is a tuple of CaLocation objects sorted by id; the poller
+    never touches them after the snapshot is published. `states` maps
+    location id to its location_state(), as of `taken_at`. `changed_at` maps
+    location id to the time its state was first seen as it is now.
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, locations, taken_at, states=None, changed_at=None,
+                previous=None):
+        """create instance; compute `states` and `changed_at` if not given.
+
+        `changed_at` of locations whose state is the same as in snapshot
+        `previous` is carried over from it.
+        """
+        if states is None:
+            states = dict([(loc.id, location_state(loc)) for loc in locations])
+        if changed_at is None:
+            changed_at = dict([(loc_id, taken_at) for loc_id in states])
+            if previous is not None:
+                for loc_id, state in states.items():
+                    if previous.states.get(loc_id) == state:
+                        changed_at[loc_id] = previous.changed_at[loc_id]
+        return super(Snapshot, cls).__new__(
+                cls, locations, taken_at, states, changed_at)
+
+    @property
+    def version(self):
+        """token of this snapshot, for clients to ask for later changes."""
+        return version_of(self.taken_at)
+
+    def changed_since(self, since):
+        """locations whose state changed after version `since`."""
+        return [loc for loc in self.locations
+                if version_of(self.changed_at[loc.id]) > since]
+
+    def get_location(self, loc_id):
+        """return location with id `loc_id`, or None."""
+        for loc in self.locations:
+            if loc.id == loc_id:
+                return loc
+        return None
+
+
+class LiveStatusPoller(object):
+    """refresh live status of all capture agents in a background thread.
+
+    each poll cycle builds a brand-new set of locations/capture agents and
+    publishes them as a new Snapshot, so views can render the latest
+    snapshot without any device traffic. poller is disabled when
+    app.config['REDUNLIVE_POLL_INTERVAL'] is 0.
+
+    thread starts on the app's first request, so only processes serving
+    requests poll devices: not manage.py commands, and not a gunicorn
+    master that loads the app before forking its workers.
+    """
+
+    def __init__(self, app=None):
+        """create instance."""
+        self._app = None
+        self._interval = 0
+        self._snapshot = None
+        self._thread = None
+        self._wakeup = threading.Event()
+        self._stopped = None
+        if app is not None:
+            self.init_app(app)
+
+
+    def init_app(self, app):
+        """init poller with configs from app; start thread on first request."""
+        self.stop()
+        self._app = app
+        self._interval = app.config['REDUNLIVE_POLL_INTERVAL']
+        self._snapshot = None
+        app.extensions['redunlive_poller'] = self
+        if self._interval > 0:
+            app.before_first_request(self.start)
+
+
+    @property
+    def enabled(self):
+        return self._interval > 0
+
+
+    @property
+    def snapshot(self):
+        """latest published snapshot, or None if no poll cycle finished yet."""
+        return self._snapshot
+
+
+    def poll_once(self):
+        """pull ca_stats, sync all devices and publish a new snapshot."""
+        with self._app.app_context():
+            data = prep_redunlive_data()
+        locations = tuple(
+                sorted(data['all_locations'].values(), key=lambda t: t.id))
+        return self.publish(Snapshot(
+                locations=locations, taken_at=arrow.utcnow(),
+                previous=self._snapshot))
+
+
+    def publish(self, snapshot):
+        """make `snapshot` the latest."""
+        self._snapshot = snapshot
+        return snapshot
+
+
+    def refresh(self):
+        """wake up poller thread to start a new poll cycle right away."""
+        self._wakeup.set()
+
+
+    def start(self):
+        """start poller thread, if not already running."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+                target=self._run, args=(self._stopped,),
+                name='redunlive-poller')
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def stop(self):
+        """signal poller thread to stop after current poll cycle."""
+        if self._stopped is not None:
+            self._stopped.set()
+            self._wakeup.set()
+        self._thread = None
+
+
+    def _run(self, stopped):
+        logger = logging.getLogger(__name__)
+        logger.info('redunlive poller started, interval(%ss)' % self._interval)
+        while not stopped.is_set():
+            try:
+                self.poll_once()
+            except Exception as e:
+                logger.error('redunlive poll cycle failed. error: %s' % e)
+            self._wakeup.wait(self._interval)
+            self._wakeup.clear()
+        logger.info('redunlive poller stopped')
@@ -1,20 +1,24 @@
 # -*- coding: utf-8 -*-
 """redunlive section."""
-import json
 import logging
-import time
 
 from flask import Blueprint
 from flask import current_app
 from flask import flash
+from flask import jsonify
 from flask import render_template
 from flask import request
+from flask import url_for
 from flask_login import login_required
 
 from cadash import __version__ as app_version
-from cadash.utils import pull_data
+from cadash.compat import string_types
 from cadash.utils import requires_roles
-from cadash.redunlive.data_masseuse import map_redunlive_ca_loc
+from cadash.redunlive.data_masseuse import bulk_switch_live_stream
+from cadash.redunlive.data_masseuse import prep_redunlive_data
+from cadash.redunlive.data_masseuse import switch_live_stream
+from cadash.redunlive.jobs import LocationBusyError
+from cadash.redunlive.poller import version_of
 
 required_groups = ['deadmin']
 
@@ -24,17 +28,6 @@ blueprint = Blueprint(
         url_prefix='/redunlive')
 
 
-def prep_redunlive_data():
-    """read and parse data for redunlive."""
-    json_text = pull_data(
-            current_app.config['CA_STATS_JSON_URL'],
-            creds={
-                'user': current_app.config['CA_STATS_USER'],
-                'pwd': current_app.config['CA_STATS_PASSWD']
-                })
-    return map_redunlive_ca_loc(json.loads(json_text))
-
-
 @blueprint.route('/', methods=['GET', 'POST'])
 @login_required
 @requires_roles(required_groups)
@@ -44,48 +37,183 @@ def home():
     logger = logging.getLogger(__name__)
     logger.info('----- this is a log message from app: %s' % __name__)
 
+    poller = current_app.extensions['redunlive_poller']
+    jobs = current_app.extensions['redunlive_jobs']
+
+    # form submitted: switch-over runs in background, page polls for it
+    if request.method == 'POST':
+        if current_app.config['ENV'] == 'dev' \
+                and 'loc_id' in request.form.keys():
+            flash('form input loc-id %s' % request.form['loc_id'])
+            logger.debug('request.form loc-id is %s' % (request.form['loc_id']))
+
+        loc_id = request.form['loc_id']
+        active_device = request.form['active_device']
+        try:
+            job = jobs.submit(
+                    _switch_job, args=(loc_id, active_device),
+                    description='switch %s to %s' % (loc_id, active_device),
+                    target=loc_id)
+        except LocationBusyError as e:
+            if request.is_xhr:
+                return _busy_response(e)
+            flash('%s is already switching; try again later' % loc_id,
+                  'danger')
+        else:
+            if request.is_xhr:
+                return jsonify(job.to_dict()), 202
+            flash('switching %s to %s...' % (loc_id, active_device), 'info')
+
+    # serve from latest poller snapshot, if any and not older than last
+    # switch-over; no device traffic
+    snapshot = poller.snapshot
+    if snapshot is not None and (
+            jobs.last_finished_at is None or
+            jobs.last_finished_at < snapshot.taken_at):
+        return _render_home(snapshot.locations, last_update=snapshot.taken_at)
+
     # init location-ca list
     data = prep_redunlive_data()
     locations = sorted(data['all_locations'].values(), key=lambda t: t.id)
+    return _render_home(locations)
 
-    if current_app.config['ENV'] == 'dev' \
-            and 'loc_id' in request.form.keys():
-        flash('form input loc-id %s' % request.form['loc_id'])
-        logger.debug('request.form loc-id is %s' % (request.form['loc_id']))
 
-    # form submitted
-    if request.method == 'POST':
-        # get location to toggle
-        location = data['all_locations'][request.form['loc_id']]
+@blueprint.route('/bulk', methods=['POST'])
+@login_required
+@requires_roles(required_groups)
+def bulk_switch():
+    """switch live stream of many locations at once, in background.
+
+    expects json {"loc_ids": [...], "active_device": "primary|secondary"};
+    returns the job, whose result is the list of per-location results.
+    """
+    body = request.get_json(silent=True) or {}
+    loc_ids = body.get('loc_ids')
+    active_device = body.get('active_device')
+    if not isinstance(loc_ids, list) or not loc_ids:
+        return jsonify({'message': 'missing list of "loc_ids"'}), 400
+    if not all([isinstance(l, string_types) for l in loc_ids]):
+        return jsonify({'message': '"loc_ids" must be location ids'}), 400
+    if active_device not in ('primary', 'secondary'):
+        return jsonify({
+            'message': '"active_device" must be "primary" or "secondary"'}), 400
+
+    # dedup, but keep order
+    seen = set()
+    loc_ids = [l for l in loc_ids if not (l in seen or seen.add(l))]
+
+    try:
+        job = current_app.extensions['redunlive_jobs'].submit(
+                _bulk_switch_job, args=(loc_ids, active_device),
+                description='switch %i locations to %s' % (
+                    len(loc_ids), active_device),
+                target=loc_ids)
+    except LocationBusyError as e:
+        return _busy_response(e)
+    response = jsonify(job.to_dict())
+    response.status_code = 202
+    response.headers['Location'] = url_for(
+            'redunlive.job_status', job_id=job.id)
+    return response
+
+
+@blueprint.route('/updates', methods=['GET'])
+@login_required
+@requires_roles(required_groups)
+def updates():
+    """live status changes, per location, as json.
+
+    `since` is the version of the latest update the page has (0 for none).
+    answers right away, with no device traffic: the page polls about once
+    per REDUNLIVE_POLL_INTERVAL. if the poller snapshot is newer than
+    `since`, returns its version, ids of all locations and, for each
+    location changed after `since`, its live status and re-rendered html
+    row; otherwise returns version `since` and no locations.
+    """
+    poller = current_app.extensions['redunlive_poller']
+    if not poller.enabled:
+        return jsonify({'message': 'live updates need the redunlive poller'}), 503
+    try:
+        since = int(request.args.get('since', 0))
+    except ValueError:
+        return jsonify({'message': '"since" must be a version number'}), 400
+
+    snapshot = poller.snapshot
+    if snapshot is None or snapshot.version <= since:
+        return jsonify({'version': since, 'ids': None, 'locations': []})
+
+    changed = snapshot.changed_since(since)
+    switching = _switching([loc.id for loc in changed])
+    return jsonify({
+        'version': snapshot.version,
+        'ids': sorted(snapshot.states),
+        'locations': [{
+            'id': loc.id,
+            'state': snapshot.states[loc.id],
+            'html': render_template(
+                'redunlive/location_row.html', loc=loc,
+                last_update=snapshot.taken_at, switching=switching)}
+            for loc in changed]})
+
+
+@blueprint.route('/jobs/<job_id>', methods=['GET'])
+@login_required
+@requires_roles(required_groups)
+def job_status(job_id):
+    """status of a switch-over job, as json."""
+    job = current_app.extensions['redunlive_jobs'].get(job_id)
+    if job is None:
+        return jsonify({'message': 'job not found (%s)' % job_id}), 404
+    return jsonify(job.to_dict())
+
+
+def _switch_job(loc_id, active_device):
+    """run switch-over; runs in background, within app context."""
+    active = switch_live_stream(loc_id, active_device)
+
+    # snapshot is stale now
+    poller = current_app.extensions['redunlive_poller']
+    if poller.enabled:
+        poller.refresh()
+    return active
+
+
+def _bulk_switch_job(loc_ids, active_device):
+    """run bulk switch-over; runs in background, within app context."""
+    results = bulk_switch_live_stream(loc_ids, active_device)
+
+    poller = current_app.extensions['redunlive_poller']
+    if poller.enabled:
+        poller.refresh()
+    return results
+
+
+def _switching(loc_ids):
+    """map of location id, of `loc_ids`, to its switch-over job running."""
+    return current_app.extensions['redunlive_jobs'].running(loc_ids)
+
+
+def _busy_response(error):
+    """409 response, for a location already switching."""
+    response = jsonify({
+        'message': str(error),
+        'loc_id': error.location,
+        'job_id': error.job_id})
+    response.status_code = 409
+    if error.job_id:
+        response.headers['Location'] = url_for(
+                'redunlive.job_status', job_id=error.job_id)
+    return response
 
-        if location.active_livestream is None:
-            pass  # do not start/stop if no active streaming!
-        else:
-            # toggling from backup to primary requires a start over
-            if request.form['active_device'] == 'primary':
-                # start primary streaming
-                location.primary_ca.write_live_status('6')
-                time.sleep(2)
-                # stop backup streaming so akamai detect that for sure
-                location.secondary_ca.write_live_status('0')
-                time.sleep(1)
-                # start backup streaming again
-                location.secondary_ca.write_live_status('6')
-            else:
-                # make sure secondary is streaming
-                location.secondary_ca.write_live_status('6')
-                time.sleep(2)
-                # stop streaming primary
-                location.primary_ca.write_live_status('0')
-                time.sleep(1)
-
-            # make sure we have the device status
-            location.primary_ca.sync_live_status()
-            location.secondary_ca.sync_live_status()
-        # end -- there is active livestreaming
 
+def _render_home(locations, last_update=None):
     return render_template(
-            'redunlive/home.html', version=app_version, locations=locations)
+            'redunlive/home.html', version=app_version,
+            locations=locations, last_update=last_update,
+            since=version_of(last_update) if last_update else 0,
+            switching=_switching([l.id for l in locations]),
+            live_updates=current_app.extensions['redunlive_poller'].enabled,
+            poll_interval=current_app.config['REDUNLIVE_POLL_INTERVAL'])
 
 # @blueprint.route('/logout/')
 # def logout():
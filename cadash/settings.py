@@ -20,24 +20,99 @@ class Config(object):
             os.environ.get('DATABASE_PWD', 'password'))
     LOG_CONFIG = os.environ.get('LOG_CONFIG', 'logging.yaml')
 
+    # /metrics endpoint, with per-device latency/errors of epipearl calls;
+    # off by default. served to logged in users, or to scrapers that send
+    # header "Authorization: Bearer <METRICS_TOKEN>". metrics are per
+    # process: scrape each gunicorn worker, not a load balancer
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'false').lower() == 'true'
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+    # per-request phase timings (db, http, devices, render) in Server-Timing
+    # header; and last TIMING_WINDOW requests per endpoint kept in memory,
+    # served at /metrics/slowest as /metrics is. off by default, but in dev
+    TIMING_ENABLED = os.environ.get('TIMING_ENABLED', 'false').lower() == 'true'
+    TIMING_WINDOW = 100
+
     # app in-memory cache
     CACHE_TYPE = 'simple'  # Can be "memcached", "redis", etc.
+    # inventory lookups (select lists) are cached per table version;
+    # max age (secs) just frees memory, entries are never stale
+    LOOKUP_CACHE_TIMEOUT = 24 * 3600
+
+    # rest list endpoints are always paginated; default and max records
+    # per page
+    API_PAGE_SIZE = 100
+    API_MAX_PAGE_SIZE = 1000
 
     # ca_stats creds to pull info on all capture agents
     CA_STATS_JSON_URL = 'http://ca_stats_fake_url.com'
     CA_STATS_USER = 'ca_stats_fake_user'
     CA_STATS_PASSWD = 'ca_stats_fake_passwd'
+    # ca_stats json is cached (secs), then revalidated with conditional gets
+    CA_STATS_TTL = int(os.environ.get('CA_STATS_TTL', 30))
+    CA_STATS_CONNECT_TIMEOUT = 3.05
+    CA_STATS_READ_TIMEOUT = float(os.environ.get('CA_STATS_READ_TIMEOUT', 10))
 
     # epipearl creds (to talk to capture agents) mandatory
     EPIPEARL_USER = 'epipearl_fake_user'
     EPIPEARL_PASSWD = 'epipearl_fake_passwd'
 
+    # max number of devices synced concurrently, and deadline (secs) to sync
+    EPIPEARL_SYNC_WORKERS = int(os.environ.get('EPIPEARL_SYNC_WORKERS', 16))
+    EPIPEARL_SYNC_TIMEOUT = float(os.environ.get('EPIPEARL_SYNC_TIMEOUT', 10))
+
+    # epipearl clients are reused across requests; dropped when idle (secs)
+    EPIPEARL_CLIENT_MAX_IDLE = int(os.environ.get('EPIPEARL_CLIENT_MAX_IDLE', 300))
+    EPIPEARL_CLIENT_POOL_SIZE = 4
+
+    # consecutive failures before giving up on a device for a while (secs);
+    # backoff doubles on each failed probe, up to max
+    EPIPEARL_BREAKER_THRESHOLD = 3
+    EPIPEARL_BREAKER_BACKOFF = int(os.environ.get('EPIPEARL_BREAKER_BACKOFF', 30))
+    EPIPEARL_BREAKER_MAX_BACKOFF = 300
+
+    # redunlive background poller interval (secs); 0 disables the poller
+    REDUNLIVE_POLL_INTERVAL = 0
+
+    # switch-over runs as background job; secs for device start to settle,
+    # and secs that backup is kept stopped
+    REDUNLIVE_SWITCH_DELAY = 2
+    REDUNLIVE_SWITCH_PAUSE = 1
+    REDUNLIVE_JOB_WORKERS = 4
+    # bulk switch-over runs all locations at once, one thread each; max
+    # number of threads, in case of a huge batch
+    REDUNLIVE_BULK_MAX_PARALLEL = int(
+            os.environ.get('REDUNLIVE_BULK_MAX_PARALLEL', 64))
+    # finished jobs are kept for status queries (secs)
+    REDUNLIVE_JOB_TTL = 3600
+    # locks on locations of a running job expire after (secs), in case the
+    # worker running it dies
+    REDUNLIVE_JOB_TIMEOUT = 600
+
     # ldap info is mandatory
     LDAP_HOST = 'fake_ldap_server.fake.com'
     LDAP_BASE_SEARCH = 'dc=fake,dc=com'
     LDAP_BIND_DN = 'dn=fake_super_user,dc=fake,dc=com'
     LDAP_BIND_PASSWD = 'passw0rd'
 
+    # ldap connections are pooled, and reused by logins; dropped when idle
+    # (secs), and checked before reuse when idle for over check interval (secs)
+    LDAP_POOL_SIZE = 4
+    LDAP_POOL_MAX_IDLE = int(os.environ.get('LDAP_POOL_MAX_IDLE', 300))
+    LDAP_POOL_CHECK_INTERVAL = 30
+
+    # ldap groups of users are cached (secs); refreshed in background once
+    # older than ttl, and fetched while user waits once older than max stale
+    LDAP_GROUPS_TTL = int(os.environ.get('LDAP_GROUPS_TTL', 300))
+    LDAP_GROUPS_MAX_STALE = 24 * 3600
+
+    # logged in users expire after session ttl (secs); each process keeps up
+    # to local size users for local ttl (secs), so logouts and group changes
+    # take up to local ttl to reach all processes
+    USER_SESSION_TTL = 24 * 3600
+    USER_SESSION_LOCAL_TTL = 5
+    USER_SESSION_LOCAL_SIZE = 1024
+
 
     def __init__(self, environment='prod', login_disabled=False):
         """create instance."""
@@ -59,6 +134,10 @@ class Config(object):
             # epipearl creds (to talk to capture agents) mandatory
             self.EPIPEARL_USER = os.environ.get('EPIPEARL_USER', 'user2')
             self.EPIPEARL_PASSWD = os.environ.get('EPIPEARL_PASSWD', 'pwd2')
+            self.REDUNLIVE_POLL_INTERVAL = int(
+                    os.environ.get('REDUNLIVE_POLL_INTERVAL', 0))
+            self.TIMING_ENABLED = os.environ.get(
+                    'TIMING_ENABLED', 'true').lower() == 'true'
 
             # ldap info is mandatory
             self.LDAP_HOST = os.environ.get('LDAP_HOST', 'ho.com')
@@ -69,9 +148,13 @@ class Config(object):
         elif env == 'test':
             self.ENV = 'test'
             self.TESTING = True
+            self.DEBUG_TB_ENABLED = False  # dev only
             self.SQLALCHEMY_DATABASE_URI = 'sqlite://'
             self.CACHE_TYPE = 'simple'  # Can be "memcached", "redis", etc.
             self.WTF_CSRF_ENABLED = False  # Allows form testing
+            self.CA_STATS_TTL = 0
+            self.REDUNLIVE_SWITCH_DELAY = 0
+            self.REDUNLIVE_SWITCH_PAUSE = 0
 
             if login_disabled:
                 # disabled login_required for unit tests
@@ -90,6 +173,10 @@ class Config(object):
             self.CACHE_REDIS_HOST = 'localhost'
             self.CACHE_REDIS_PORT = 6379
 
+            # redunlive pages are served from poller snapshots
+            self.REDUNLIVE_POLL_INTERVAL = int(
+                    os.environ.get('REDUNLIVE_POLL_INTERVAL', 30))
+
             # ca_stats creds is mandatory
             assert 'CA_STATS_JSON_URL' in os.environ.keys(), 'missing env var "CA_STATS_JSON_URL"'
             assert 'CA_STATS_USER' in os.environ.keys(), 'missing env var "CA_STATS_USER"'
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""per-request phase timings: db, outbound http, device sync, template render.
+
+timings are sent back as `Server-Timing` header, and kept in a rolling
+in-memory table per endpoint, per process.
+"""
+from collections import deque
+from contextlib import contextmanager
+import threading
+import time
+
+from flask import before_render_template
+from flask import g
+from flask import has_request_context
+from flask import request
+from flask import template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+def record_phase(name, secs):
+    """add `secs` to phase `name` of current request, if timed."""
+    if has_request_context():
+        timing = getattr(g, '_timing', None)
+        if timing is not None:
+            timing[name] = timing.get(name, 0) + secs
+
+
+@contextmanager
+def phase(name):
+    """time block as phase `name` of current request, if timed."""
+    start = time.time()
+    try:
+        yield
+    finally:
+        record_phase(name, time.time() - start)
+
+
+class RequestTimer(object):
+    """time requests and their phases, when app.config['TIMING_ENABLED']."""
+
+    def __init__(self, app=None):
+        """create instance."""
+        self._window = 100
+        self._stats = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+
+    def init_app(self, app):
+        """register request hooks in app, if timing enabled."""
+        self._window = app.config['TIMING_WINDOW']
+        self._stats = {}
+        app.extensions['request_timer'] = self
+        if not app.config['TIMING_ENABLED']:
+            return
+
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        before_render_template.connect(self._before_render, app)
+        template_rendered.connect(self._after_render, app)
+        _listen_db_events()
+
+
+    def slowest(self, count=10):
+        """
+        endpoints sorted by p95 request time, slowest first.
+
+        :return: list of dicts with endpoint, count, and avg/p95/max total
+            time and avg time per phase, all in millisecs; over the last
+            `TIMING_WINDOW` requests of each endpoint
+        """
+        with self._lock:
+            stats = [(k, list(v)) for k, v in self._stats.items()]
+
+        table = []
+        for endpoint, samples in stats:
+            totals = sorted([s['total'] for s in samples])
+            phases = {}
+            for s in samples:
+                for name, secs in s.items():
+                    if name != 'total':
+                        phases[name] = phases.get(name, 0) + secs
+            table.append({
+                'endpoint': endpoint,
+                'count': len(samples),
+                'avg_ms': _ms(sum(totals) / len(totals)),
+                'p95_ms': _ms(totals[int(0.95 * (len(totals) - 1))]),
+                'max_ms': _ms(totals[-1]),
+                'phases_avg_ms': dict(
+                    [(k, _ms(v / len(samples))) for k, v in phases.items()])})
+        table.sort(key=lambda t: t['p95_ms'], reverse=True)
+        return table[:count]
+
+
+    def _before_request(self):
+        g._timing = {}
+        g._timing_start = time.time()
+
+
+    def _after_request(self, response):
+        timing = getattr(g, '_timing', None)
+        if timing is None:
+            return response
+        timing['total'] = time.time() - g._timing_start
+
+        response.headers['Server-Timing'] = ', '.join([
+            '%s;dur=%.1f' % (name, secs * 1000)
+            for name, secs in sorted(timing.items())])
+
+        endpoint = request.endpoint or 'unknown'
+        with self._lock:
+            if endpoint not in self._stats:
+                self._stats[endpoint] = deque(maxlen=self._window)
+            self._stats[endpoint].append(timing)
+        return response
+
+
+    def _before_render(self, sender, template, context, **extra):
+        if hasattr(g, '_timing'):
+            # stack, as templates may be rendered while rendering another
+            g.setdefault('_timing_render_starts', []).append(time.time())
+
+
+    def _after_render(self, sender, template, context, **extra):
+        starts = getattr(g, '_timing_render_starts', None)
+        if starts:
+            start = starts.pop()
+            # nested renders are part of the outermost one
+            if not starts:
+                record_phase('render', time.time() - start)
+
+
+_db_events_lock = threading.Lock()
+_db_events_listening = []
+
+
+def _listen_db_events():
+    """time cursor executions of all sqlalchemy engines, once per process."""
+    with _db_events_lock:
+        if _db_events_listening:
+            return
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        _db_events_listening.append(True)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('_timing_start', []).append(time.time())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('_timing_start')
+    if starts:
+        record_phase('db', time.time() - starts.pop())
+
+
+def _ms(secs):
+    return round(secs * 1000, 1)
@@ -4,12 +4,18 @@ from flask_login import UserMixin
 
 
 class BaseUser(UserMixin):
-    """base user of the app."""
+    """base user of the app.
+
+    groups are a frozenset; decisions of is_in_any_group are memoized per
+    set of groups asked, for the lifetime of the instance, and forgotten
+    when groups change.
+    """
 
     def __init__(self, username):
         """init user instance."""
         self._usr = username
-        self._grp = []
+        self._grp = frozenset()
+        self._in_any = {}
 
     @property
     def username(self):
@@ -26,16 +32,24 @@ class BaseUser(UserMixin):
         """True if user belongs to `group`."""
         return group in self._grp
 
+    def is_in_any_group(self, groups):
+        """True if user belongs to any group in frozenset `groups`."""
+        try:
+            return self._in_any[groups]
+        except KeyError:
+            decision = not self._grp.isdisjoint(groups)
+            self._in_any[groups] = decision
+            return decision
+
     def place_in_groups(self, groups):
         """add user to list `groups`. prevents duplicates."""
-        self._grp = list(set(self._grp + groups))
+        self._grp = self._grp.union(groups)
+        self._in_any = {}
 
     def remove_from_group(self, group):
         """remove single `group` from groups list."""
-        try:
-            self._grp.remove(group)
-        except ValueError:  # group not present in _grp
-            pass
+        self._grp = self._grp.difference([group])
+        self._in_any = {}
 
     def __repr__(self):
         """represent instance as a unique string."""
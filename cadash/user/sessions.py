@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""logged in users, in app cache (redis in prod) and a per-process lru."""
+import json
+import logging
+import time
+
+from cadash.user.models import BaseUser
+from cadash.utils import LruCache
+
+# bump when encoding changes; users of other versions must login again
+SESSION_VERSION = 1
+
+
+def encode_user(user, expires_at):
+    """compact json of `user`: [version, username, expires_at, groups]."""
+    return json.dumps(
+            [SESSION_VERSION, user.username, int(expires_at),
+             sorted(user.groups)],
+            separators=(',', ':'))
+
+
+def decode_user(data):
+    """return (user, expires_at) from `data`; None if not a valid encoding."""
+    try:
+        (version, username, expires_at, groups) = json.loads(data)
+    except (TypeError, ValueError):
+        return None
+    if version != SESSION_VERSION:
+        return None
+    user = BaseUser(username)
+    user.place_in_groups(groups)
+    return (user, expires_at)
+
+
+class UserSessionStore(object):
+    """
+    logged in users, by user id.
+
+    users are kept in app cache, shared by workers, until the session
+    expires; and in a per-process lru for `local_ttl` secs, so most requests
+    need no round trip to the app cache. so a logout, or a change of groups,
+    takes up to `local_ttl` secs to reach other processes.
+    """
+
+    def __init__(self, cache, groups, app=None):
+        """create instance.
+
+        `cache` is a flask_cache.Cache, `groups` an LdapGroupCache.
+        """
+        self._cache = cache
+        self._groups = groups
+        self._ttl = 0
+        self._local = LruCache()
+        if app is not None:
+            self.init_app(app)
+
+
+    def init_app(self, app):
+        """init store with configs from app."""
+        self._ttl = app.config['USER_SESSION_TTL']
+        self._local = LruCache(
+                size=app.config['USER_SESSION_LOCAL_SIZE'],
+                ttl=app.config['USER_SESSION_LOCAL_TTL'])
+        app.extensions['user_sessions'] = self
+
+
+    def save(self, user):
+        """keep logged in `user` for the session ttl."""
+        expires_at = time.time() + self._ttl
+        self._cache.set(
+                self._key(user.get_id()), encode_user(user, expires_at),
+                timeout=self._ttl)
+        self._local.set(user.get_id(), (user, expires_at))
+
+
+    def load(self, user_id):
+        """logged in user with `user_id`, or None."""
+        entry = self._local.get(user_id)
+        if entry is None:
+            entry = self._load_shared(user_id)
+            if entry is None:
+                return None
+            self._local.set(user_id, entry)
+
+        (user, expires_at) = entry
+        if time.time() >= expires_at:
+            self._local.delete(user_id)
+            return None
+        return user
+
+
+    def revoke(self, user_id):
+        """log out user with `user_id`."""
+        self._cache.delete(self._key(user_id))
+        self._local.delete(user_id)
+
+
+    def clear_local(self):
+        self._local.clear()
+
+
+    def _load_shared(self, user_id):
+        data = self._cache.get(self._key(user_id))
+        if data is None:
+            return None
+        entry = decode_user(data)
+        if entry is None:
+            logger = logging.getLogger(__name__)
+            logger.info(
+                    'dropping session of user(%s) in unknown encoding'
+                    % user_id)
+            return None
+
+        # groups may have changed in ldap since login; never waits on ldap
+        (user, expires_at) = entry
+        groups = self._groups.fetch_groups(user.username, block=False)
+        if groups is not None and set(groups) != set(user.groups):
+            user = BaseUser(user.username)
+            user.place_in_groups(groups)
+        return (user, expires_at)
+
+
+    def _key(self, user_id):
+        return 'user_session:%s' % user_id
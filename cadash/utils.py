@@ -1,12 +1,17 @@
 # -*- coding: utf-8 -*-
 """Helper utilities and decorators."""
+from collections import OrderedDict
+import copy
+import itertools
 import os
+import json
 import logging
 import logging.config
 import platform
 import re
 import sys
-import yaml
+import threading
+import time
 
 from flask import current_app
 from flask import flash
@@ -19,6 +24,8 @@ import requests
 from requests.auth import HTTPBasicAuth
 
 from cadash import __version__
+from cadash.compat import basestring
+from cadash.timing import phase
 from cadash.user.models import BaseUser
 
 
@@ -41,14 +48,28 @@ def setup_logging(
             which is the full path to the yaml file with configs for logs
     :param: default_level: log level for basic config, default=INFO
     """
-    if os.path.exists(app.config['LOG_CONFIG']):
-        with open(app.config['LOG_CONFIG'], 'rt') as f:
-            config = yaml.load(f.read())
-        logging.config.dictConfig(config)
+    path = app.config['LOG_CONFIG']
+    if os.path.exists(path):
+        # dictConfig may change the config it is given
+        logging.config.dictConfig(copy.deepcopy(_load_log_config(path)))
     else:
         logging.basicConfig(level=default_level)
 
 
+# parsed log configs, per (path, mtime); apps are created once per test
+_log_configs = {}
+
+
+def _load_log_config(path):
+    key = (path, os.path.getmtime(path))
+    if key not in _log_configs:
+        # only needed for log config; slow to import
+        import yaml
+        with open(path, 'rt') as f:
+            _log_configs[key] = yaml.load(f.read())
+    return _log_configs[key]
+
+
 def clean_name(name):
     """
     clean `name` from non_alpha.
@@ -58,32 +79,194 @@ def clean_name(name):
     return re.sub('[^0-9a-zA-Z]+', '_', name.strip()).lower()
 
 
-def pull_data(url, creds=None):
+# versions of bodies fetched by CachedFetchers, unique per process
+_fetched_versions = itertools.count(1)
+
+
+class CachedFetcher(object):
+    """
+    fetch text files from urls, with a ttl cache.
+
+    all fetches go through a pooled requests.Session, with connect/read
+    timeouts. once `ttl` secs are past, cached entries are revalidated with
+    a conditional get (ETag/If-Modified-Since); if the url is unavailable,
+    the stale entry is served. the parsed json of an entry is cached too,
+    and must be treated as read-only by callers. each body fetched gets a
+    new version, so callers can cache what they derive from it.
+    """
+
+    def __init__(self, ttl=0, connect_timeout=3.05, read_timeout=10):
+        """create instance."""
+        self.ttl = ttl
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._session = requests.Session()
+        self._entries = {}
+        self._lock = threading.Lock()
+
+
+    def init_app(self, app):
+        """init fetcher with ca_stats configs from app."""
+        self.clear()
+        self.ttl = app.config['CA_STATS_TTL']
+        self.connect_timeout = app.config['CA_STATS_CONNECT_TIMEOUT']
+        self.read_timeout = app.config['CA_STATS_READ_TIMEOUT']
+        app.extensions['ca_stats'] = self
+
+
+    def get_text(self, url, creds=None, ttl=None):
+        """return text from `url`, or None if unavailable and not cached."""
+        entry = self._fetch(url, creds, ttl)
+        return entry['text'] if entry is not None else None
+
+
+    def get_json(self, url, creds=None, ttl=None):
+        """return parsed json from `url`, or None if unavailable and not cached."""
+        entry = self._fetch(url, creds, ttl)
+        return _entry_json(entry) if entry is not None else None
+
+
+    def get_versioned_json(self, url, creds=None, ttl=None):
+        """
+        return (parsed json, version) from `url`.
+
+        version is the same as long as the body is, revalidations included;
+        returns (None, None) if unavailable and not cached.
+        """
+        entry = self._fetch(url, creds, ttl)
+        if entry is None:
+            return (None, None)
+        return (_entry_json(entry), entry['version'])
+
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+
+
+    def _fetch(self, url, creds, ttl):
+        ttl = self.ttl if ttl is None else ttl
+        key = (url, creds['user'] if creds else None)
+        entry = self._entries.get(key)
+        now = time.time()
+        if entry is not None and now - entry['fetched_at'] < ttl:
+            return entry
+
+        headers = {
+                'User-Agent': default_useragent(),
+                'Accept-Encoding': 'gzip, deflate',
+                'Accept': 'text/html, text/*'
+                }
+        au = None
+        if creds is not None:
+            if 'user' in creds and 'pwd' in creds:
+                au = HTTPBasicAuth(creds['user'], creds['pwd'])
+                headers.update({'X-REQUESTED-AUTH': 'Basic'})
+        if entry is not None:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        logger = logging.getLogger(__name__)
+        try:
+            with phase('http'):
+                response = self._session.get(
+                        url, headers=headers, auth=au,
+                        timeout=(self.connect_timeout, self.read_timeout))
+            response.raise_for_status()
+        except requests.RequestException as e:
+            if entry is not None:
+                logger.warning(
+                        'data from url(%s) is unavailable; serving data from '
+                        '%is ago. Error: %s' % (url, now - entry['fetched_at'], e))
+                return entry
+            logger.warning('data from url(%s) is unavailable. Error: %s' % (url, e))
+            return None
+
+        if response.status_code == 304 and entry is not None:
+            entry['fetched_at'] = now
+            return entry
+
+        entry = {
+                'text': response.text,
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'fetched_at': now,
+                'version': next(_fetched_versions)}
+        with self._lock:
+            self._entries[key] = entry
+        return entry
+
+
+def _entry_json(entry):
+    if 'json' not in entry:
+        entry['json'] = json.loads(entry['text'])
+    return entry['json']
+
+
+class LruCache(object):
+    """
+    small thread-safe in-process cache, least recently used dropped first.
+
+    entries older than `ttl` secs are not served.
+    """
+
+    def __init__(self, size=128, ttl=0):
+        """create instance."""
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def get(self, key):
+        """value of `key`, or None if missing or expired."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or now - entry[0] >= self.ttl:
+                return None
+            self._entries[key] = entry
+            return entry[1]
+
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time(), value)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+    def clear(self):
+        with self._lock:
+            self._entries = OrderedDict()
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# fetcher for ad-hoc calls to pull_data; no ttl, but conditional gets
+_default_fetcher = CachedFetcher()
+
+
+def pull_data(url, creds=None, fetcher=None):
     """
     get text file from `url`.
 
     reads a text file from given url
     if basic auth needed, pass args creds['user'] and creds['pwd']
+    if `fetcher` (a CachedFetcher) not given, a module-wide one is used.
     """
-    headers = {
-            'User-Agent': default_useragent(),
-            'Accept-Encoding': 'gzip, deflate',
-            'Accept': 'text/html, text/*'
-            }
-    au = None
-    if creds is not None:
-        if 'user' in creds and 'pwd' in creds:
-            au = HTTPBasicAuth(creds['user'], creds['pwd'])
-            headers.update({'X-REQUESTED-AUTH': 'Basic'})
-
-    try:
-        response = requests.get(url, headers=headers, auth=au)
-    except requests.HTTPError as e:
-        logger = logging.getLogger(__name__)
-        logger.warning('data from url(%s) is unavailable. Error: %s' % (url, e))
-        return None
-    else:
-        return response.text
+    fetcher = fetcher or _default_fetcher
+    return fetcher.get_text(url, creds=creds)
 
 
 def default_useragent():
@@ -119,14 +302,15 @@ def default_useragent():
         '%s/%s' % (p_system, p_release)])
 
 
-def fetch_ldap_user(usr, pwd, cli):
+def fetch_ldap_user(usr, pwd, cli, groups=None):
     """fetch user in ldap, and the groups user belongs to.
 
     returns a BaseUser object or None if not authenticated or unknown
+    groups are fetched by `groups` (e.g. an LdapGroupCache), or `cli`.
     """
     if cli.is_authenticated(usr, pwd):
         u = BaseUser(usr)
-        groups = cli.fetch_groups(usr)
+        groups = (groups or cli).fetch_groups(usr)
         u.place_in_groups(groups)
         return u
     else:
@@ -135,18 +319,37 @@ def fetch_ldap_user(usr, pwd, cli):
 
 def is_authorized_by_groups(user, groups):
     """return True if `user` in any group of list `groups`."""
-    for g in groups:
-        if user.is_in_group(g):
-            return True
-    return False
+    if not user.is_authenticated:
+        return False
+    if not isinstance(groups, frozenset):
+        groups = frozenset(groups)
+    return user.is_in_any_group(groups)
+
+
+def compile_roles(roles):
+    """frozenset of groups in `roles`; group names or lists of group names."""
+    groups = set()
+    for r in roles:
+        if isinstance(r, basestring):
+            groups.add(r)
+        else:
+            groups.update(r)
+    return frozenset(groups)
 
 
 def requires_roles(*roles):
+    """view only for users in any group of `roles`, unless login disabled.
+
+    `roles` are group names, or lists of group names; compiled once, when
+    the view is decorated.
+    """
+    groups = compile_roles(roles)
+
     def wrapper(f):
         @wraps(f)
         def wrapped(*args, **kwargs):
             if not current_app.config.get('LOGIN_DISABLED'):
-                if not is_authorized_by_groups(current_user, *roles):
+                if not is_authorized_by_groups(current_user, groups):
                     flash('You need to login, or do not have credentials to access this page', 'info')
                     return redirect(url_for('public.home', next=request.url))
             return f(*args, **kwargs)
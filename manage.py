@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 """Management script."""
+import json
 import os
 from glob import glob
 from subprocess import call
@@ -11,6 +12,7 @@ from flask_script.commands import Clean, ShowUrls
 
 from cadash.app import create_app
 from cadash.database import db
+from cadash.inventory import bulk
 from cadash.settings import Config
 from cadash.user.models import BaseUser
 
@@ -36,6 +38,49 @@ def test():
     return exit_code
 
 
+@manager.option('-f', '--file', dest='path', default=None,
+                help='json batch, ca_stats json list, or csv file')
+@manager.option('-k', '--kind', dest='kind', default=None,
+                help='kind of records in csv file (vendors, locations, '
+                     'clusters, cas, roles)')
+@manager.option('-s', '--ca-stats', dest='ca_stats', action='store_true',
+                default=False, help='import from configured ca_stats url')
+@manager.option('-c', '--cluster', dest='cluster', default=None,
+                help='mh cluster of roles imported from ca_stats')
+@manager.option('-n', '--dry-run', dest='dry_run', action='store_true',
+                default=False, help='check and report only')
+def import_inventory(path, kind, ca_stats, cluster, dry_run):
+    """Bulk import (upsert) inventory records."""
+    if ca_stats:
+        data = app.extensions['ca_stats'].get_json(
+                app.config['CA_STATS_JSON_URL'],
+                creds={
+                    'user': app.config['CA_STATS_USER'],
+                    'pwd': app.config['CA_STATS_PASSWD']})
+        batch = bulk.batch_from_ca_stats(data, cluster=cluster)
+    elif path is None:
+        print('missing --file or --ca-stats')
+        return 1
+    elif path.endswith('.csv'):
+        if kind is None:
+            print('missing --kind of csv rows')
+            return 1
+        with open(path, 'r') as f:
+            batch = {kind: bulk.rows_from_csv(f.read())}
+    else:
+        with open(path, 'r') as f:
+            data = json.load(f)
+        if isinstance(data, list):
+            batch = bulk.batch_from_ca_stats(data, cluster=cluster)
+        else:
+            batch = data
+
+    report = bulk.import_inventory(batch, commit=not dry_run)
+    print(json.dumps(report, indent=4, sort_keys=True))
+    errors = sum([len(r['errors']) for r in report.values()])
+    return 1 if errors else 0
+
+
 class Lint(Command):
     """Lint and check code style with flake8 and isort."""
 
@@ -0,0 +1,39 @@
+"""add updated_at to inventory tables
+
+databases created by `db.create_all()` before inventory etags have no
+`updated_at` column; `manage.py db upgrade` adds it, set to `created_at` for
+existing rows. databases created from the current models already have it,
+and are marked as migrated with `manage.py db stamp head`.
+
+Revision ID: 3f1c2b9d7e41
+Revises: None
+Create Date: 2026-10-17 10:12:31.416204
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2b9d7e41'
+down_revision = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+TABLES = ('location', 'role', 'ca', 'vendor', 'mhcluster')
+
+
+def upgrade():
+    for table in TABLES:
+        # nullable first: existing rows are backfilled before the constraint
+        op.add_column(table, sa.Column('updated_at', sa.DateTime(), nullable=True))
+        op.execute('UPDATE %s SET updated_at = created_at' % table)
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.alter_column(
+                    'updated_at', existing_type=sa.DateTime(), nullable=False,
+                    server_default=sa.func.now())
+
+
+def downgrade():
+    for table in TABLES:
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_column('updated_at')
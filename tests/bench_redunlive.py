@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""benchmarks of redunlive against a fleet of fake epiphan-pearls.
+
+run from project root:
+
+    python -m tests.bench_redunlive --sizes 10,100 --output bench.json
+    python -m tests.bench_redunlive --compare bench.json --tolerance 0.2
+
+reports p50/p95 latency and throughput for
+- map_redunlive_ca_loc: parse ca_stats and sync all devices
+- sync_live_status: a single device
+- redunlive view: GET /redunlive/, ca_stats fetched from the fleet
+
+with --compare, exits 1 if any p95 is slower than baseline by more than
+--tolerance (a fraction, 0.2 is 20%).
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import logging
+import sys
+import time
+
+from mock import patch
+from webtest import TestApp
+
+from cadash.app import create_app
+from cadash.ldap import LdapClient
+from cadash.redunlive.data_masseuse import map_redunlive_ca_loc
+from cadash.redunlive.data_masseuse import set_epipearl_client
+from cadash.redunlive.models import CaptureAgent
+from cadash.settings import Config
+
+from tests.fake_pearl import FakePearlFleet
+
+
+def percentile(samples, pct):
+    """nearest-rank percentile of `samples`, a sorted list."""
+    return samples[min(len(samples) - 1, int(pct * len(samples)))]
+
+
+def measure(fn, repeat):
+    """call `fn` `repeat` times; return p50/p95 in millisecs and calls/sec."""
+    samples = []
+    start = time.time()
+    for i in range(repeat):
+        t = time.time()
+        fn()
+        samples.append(time.time() - t)
+    elapsed = time.time() - start
+    samples.sort()
+    return {
+            'repeat': repeat,
+            'p50_ms': round(percentile(samples, 0.50) * 1000, 2),
+            'p95_ms': round(percentile(samples, 0.95) * 1000, 2),
+            'throughput': round(repeat / elapsed, 2) if elapsed else None}
+
+
+def make_app(fleet):
+    """cadash app, in test env, pointed at `fleet`."""
+    config = Config(environment='test', login_disabled=True)
+    config.CA_STATS_JSON_URL = fleet.ca_stats_url
+    config.TIMING_ENABLED = False
+    with patch.object(LdapClient, 'is_authenticated', return_value=True):
+        return create_app(config)
+
+
+def bench_size(size, repeat, latency, jitter, failure_rate):
+    """run all benchmarks against a fleet of `size` devices."""
+    config = Config(environment='test')
+    fleet = FakePearlFleet(
+            size, user=config.EPIPEARL_USER, passwd=config.EPIPEARL_PASSWD,
+            delay=latency, jitter=jitter, failure_rate=failure_rate)
+    try:
+        app = make_app(fleet)
+        data = fleet.ca_stats()
+        results = {}
+        with app.test_request_context():
+            results['map_redunlive_ca_loc'] = measure(
+                    lambda: map_redunlive_ca_loc(data), repeat)
+
+            ca = CaptureAgent('FAKE000000', fleet.addresses[0])
+            ca.channels['live']['channel'] = '1'
+            ca.channels['lowBR']['channel'] = '2'
+            set_epipearl_client(ca)
+            results['sync_live_status'] = measure(ca.sync_live_status, repeat)
+
+        testapp = TestApp(app)
+        results['redunlive_view'] = measure(
+                lambda: testapp.get('/redunlive/'), repeat)
+        results['device_requests'] = fleet.request_count
+        return results
+    finally:
+        fleet.stop()
+
+
+def compare(current, baseline, tolerance):
+    """list of (size, bench, baseline p95, current p95) that regressed."""
+    regressions = []
+    for size, benches in current.items():
+        for name, stats in benches.items():
+            base = baseline.get(size, {}).get(name)
+            if not isinstance(stats, dict) or not isinstance(base, dict):
+                continue
+            if stats['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+                regressions.append(
+                        (size, name, base['p95_ms'], stats['p95_ms']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+            description='benchmark redunlive against fake epiphan-pearls.')
+    parser.add_argument(
+            '--sizes', default='10,100,1000',
+            help='comma separated number of devices (default: %(default)s)')
+    parser.add_argument(
+            '--repeat', type=int, default=20,
+            help='calls per benchmark (default: %(default)s)')
+    parser.add_argument(
+            '--latency', type=float, default=0.01,
+            help='device response time, in secs (default: %(default)s)')
+    parser.add_argument(
+            '--jitter', type=float, default=0.005,
+            help='max random extra response time, in secs (default: %(default)s)')
+    parser.add_argument(
+            '--failure-rate', type=float, default=0,
+            help='chance a device drops a request (default: %(default)s)')
+    parser.add_argument('--output', help='write results as json to file')
+    parser.add_argument('--compare', help='baseline json, from --output')
+    parser.add_argument(
+            '--tolerance', type=float, default=0.2,
+            help='allowed p95 slowdown vs baseline (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    # app logs every device call, and every failure of a flaky fleet
+    logging.disable(logging.WARNING)
+
+    results = {}
+    for size in [int(s) for s in args.sizes.split(',')]:
+        results[str(size)] = bench_size(
+                size, args.repeat, args.latency, args.jitter, args.failure_rate)
+        for name in ('map_redunlive_ca_loc', 'sync_live_status', 'redunlive_view'):
+            stats = results[str(size)][name]
+            print('%5i devices  %-22s p50 %9.2fms  p95 %9.2fms  %8.2f/s' % (
+                size, name, stats['p50_ms'], stats['p95_ms'], stats['throughput']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for size, name, base, now in regressions:
+            print('REGRESSION %s devices %s: p95 %.2fms -> %.2fms' % (
+                size, name, base, now))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""benchmarks of app startup, each sample in a fresh python process.
+
+run from project root:
+
+    python -m tests.bench_startup --repeat 10 --output startup.json
+    python -m tests.bench_startup --compare startup.json --tolerance 0.2
+
+reports p50/p95, per environment (test and prod), of
+- import: import of cadash.app, with all extensions and blueprints
+- create_app: app factory
+- first_request: GET / on a new app
+- total: all of the above, as a gunicorn worker boot plus first hit
+
+with --compare, exits 1 if any p95 is slower than baseline by more than
+--tolerance (a fraction, 0.2 is 20%).
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+from tests.bench_redunlive import compare
+from tests.bench_redunlive import percentile
+
+CHILD = '''
+import json
+import time
+import warnings
+warnings.simplefilter('ignore')
+start = time.time()
+import cadash.app
+from cadash.settings import Config
+imported = time.time()
+app = cadash.app.create_app(Config(environment=%r))
+created = time.time()
+# bundles are built once per deploy, not per worker; nor into the tree here
+app.config['ASSETS_DEBUG'] = True
+app.test_client().get('/')
+done = time.time()
+print(json.dumps({
+    'import': imported - start,
+    'create_app': created - imported,
+    'first_request': done - created,
+    'total': done - start}))
+'''
+
+# mandatory settings of prod, faked; nothing is contacted at startup
+PROD_ENV = {
+        'CA_STATS_JSON_URL': 'http://ca_stats_fake_url.com',
+        'CA_STATS_USER': 'user',
+        'CA_STATS_PASSWD': 'passwd',
+        'EPIPEARL_USER': 'user',
+        'EPIPEARL_PASSWD': 'passwd',
+        'LDAP_HOST': 'fake_ldap_server.fake.com',
+        'LDAP_BASE_SEARCH': 'dc=fake,dc=com',
+        'LDAP_BIND_DN': 'dn=fake_super_user,dc=fake,dc=com',
+        'LDAP_BIND_PASSWD': 'passw0rd',
+        'REDUNLIVE_POLL_INTERVAL': '0'}
+
+PHASES = ('import', 'create_app', 'first_request', 'total')
+
+
+def sample(environment):
+    """timings of one startup in a new process, in secs."""
+    env = dict(os.environ)
+    env.update(PROD_ENV)
+    child = subprocess.Popen(
+            [sys.executable, '-c', CHILD % environment], env=env,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    (out, err) = child.communicate()
+    if child.returncode != 0:
+        raise RuntimeError(
+                'startup of %s app failed:\n%s' % (environment, err.decode('utf-8')))
+    return json.loads(out.decode('utf-8').strip().splitlines()[-1])
+
+
+def bench_environment(environment, repeat):
+    """p50/p95 in millisecs, per phase, of `repeat` startups."""
+    samples = [sample(environment) for i in range(repeat)]
+    results = {}
+    for phase in PHASES:
+        secs = sorted([s[phase] for s in samples])
+        results[phase] = {
+                'repeat': repeat,
+                'p50_ms': round(percentile(secs, 0.50) * 1000, 2),
+                'p95_ms': round(percentile(secs, 0.95) * 1000, 2)}
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+            description='benchmark app startup, in fresh processes.')
+    parser.add_argument(
+            '--environments', default='test,prod',
+            help='comma separated environments (default: %(default)s)')
+    parser.add_argument(
+            '--repeat', type=int, default=10,
+            help='startups per environment (default: %(default)s)')
+    parser.add_argument('--output', help='write results as json to file')
+    parser.add_argument('--compare', help='baseline json, from --output')
+    parser.add_argument(
+            '--tolerance', type=float, default=0.2,
+            help='allowed p95 slowdown vs baseline (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    results = {}
+    for environment in args.environments.split(','):
+        results[environment] = bench_environment(environment, args.repeat)
+        for phase in PHASES:
+            stats = results[environment][phase]
+            print('%-5s %-14s p50 %9.2fms  p95 %9.2fms' % (
+                environment, phase, stats['p50_ms'], stats['p95_ms']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for environment, phase, base, now in regressions:
+            print('REGRESSION %s %s: p95 %.2fms -> %.2fms' % (
+                environment, phase, base, now))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
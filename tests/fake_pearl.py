@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""local http server that fakes the epiphan-pearl admin api, for tests.
+
+FakePearl is a single device on its own port; FakePearlFleet is many
+of them, each on its own port, plus their ca_stats json, for benchmarks.
+"""
+import base64
+import json
+import random
+import socket
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from BaseHTTPServer import HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qsl
+    from urlparse import urlsplit
+except ImportError:  # python 3
+    from http.server import BaseHTTPRequestHandler
+    from http.server import HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qsl
+    from urllib.parse import urlsplit
+
+
+class FakePearlHandler(BaseHTTPRequestHandler):
+    """answer get_params.cgi and set_params.cgi for /admin/channel<N>/."""
+
+    # keep-alive, so clients can pipeline requests
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.owner.connection_count += 1
+        self.server.owner.connections.append(self.connection)
+        self.served = 0
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        segments = [s for s in parts.path.split('/') if s]
+        (device, segments) = self.server.owner.route(segments)
+        self.device = device
+        if device is None:
+            if segments is not None:
+                # not a device; e.g. ca_stats of fleet
+                return self._reply(200, segments, 'application/json')
+            return self._reply(404, 'no such device')
+
+        device.request_count += 1
+        self.served += 1
+        delay = device.delay
+        if device.jitter:
+            delay += random.uniform(0, device.jitter)
+        if delay:
+            time.sleep(delay)
+        if device.failure_rate and random.random() < device.failure_rate:
+            # device drops the connection, as an unreachable pearl would
+            self.close_connection = True
+            return
+
+        if self.headers.get('Authorization') != device.auth_header:
+            return self._reply(401, 'unauthorized')
+
+        if len(segments) != 3 or segments[0] != 'admin' or \
+                not segments[1].startswith('channel'):
+            return self._reply(404, 'not found')
+        channel = segments[1][len('channel'):]
+        if channel not in device.channels:
+            return self._reply(404, 'no such channel')
+
+        params = parse_qsl(parts.query, keep_blank_values=True)
+        if segments[2] == 'get_params.cgi':
+            body = '\n'.join(
+                    ['%s = %s' % (k, device.channels[channel].get(k, ''))
+                     for k, v in params])
+            return self._reply(200, body)
+        if segments[2] == 'set_params.cgi':
+            device.channels[channel].update(dict(params))
+            return self._reply(201, '')
+        return self._reply(404, 'not found')
+
+    def _reply(self, status, body, content_type='text/plain'):
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        device = getattr(self, 'device', None)
+        if device is not None and device.keepalive_requests and \
+                self.served >= device.keepalive_requests:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class FakeDevice(object):
+    """state and behavior of a fake epiphan-pearl.
+
+    `channels` maps channel number to a dict of params, e.g.
+    {'1': {'publish_type': '0'}}; every response takes `delay` secs plus a
+    random jitter of up to `jitter` secs; `failure_rate` is the chance
+    (0 to 1) that the device drops a connection without answering; if
+    `keepalive_requests`, the device closes a connection after answering
+    that many requests on it.
+    """
+
+    def __init__(self, channels=None, user='user', passwd='passwd', delay=0,
+                 jitter=0, failure_rate=0, keepalive_requests=None):
+        """create instance."""
+        self.channels = channels or {}
+        self.delay = delay
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.keepalive_requests = keepalive_requests
+        self.request_count = 0
+        self.auth_header = 'Basic %s' % base64.b64encode(
+                ('%s:%s' % (user, passwd)).encode('utf-8')).decode('ascii')
+
+
+class _Serving(object):
+    """local http server in a background thread."""
+
+    def _serve(self):
+        self.connection_count = 0
+        self.connections = []
+        self._server = _ThreadingHTTPServer(('127.0.0.1', 0), FakePearlHandler)
+        self._server.owner = self
+        self._thread = threading.Thread(
+                target=self._server.serve_forever, kwargs={'poll_interval': 0.05})
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def host(self):
+        return '127.0.0.1:%i' % self._server.server_address[1]
+
+    def drop_connections(self):
+        """close all open connections, as a device does with idle ones."""
+        connections, self.connections = self.connections, []
+        for conn in connections:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class FakePearl(FakeDevice, _Serving):
+    """a fake epiphan-pearl, listening on localhost in a background thread."""
+
+    def __init__(self, channels=None, user='user', passwd='passwd', delay=0,
+                 jitter=0, failure_rate=0, keepalive_requests=None):
+        """create instance and start serving."""
+        super(FakePearl, self).__init__(
+                channels, user, passwd, delay, jitter, failure_rate,
+                keepalive_requests)
+        self._serve()
+
+    @property
+    def address(self):
+        """host:port of fake pearl, as in ca_stats `address`."""
+        return self.host
+
+    @property
+    def url(self):
+        return 'http://%s' % self.address
+
+    def route(self, segments):
+        return (self, segments)
+
+
+# channel layout of fleet devices, as in ca_stats
+DEFAULT_LAYOUT = {
+        '1': {'name': 'MergedLive', 'publish_type': '0'},
+        '2': {'name': 'MergedLive_LowBR', 'publish_type': '0'}}
+
+
+class FakePearlFleet(_Serving):
+    """
+    `size` fake epiphan-pearls, each on its own local port.
+
+    device N is a FakePearl, in `devices`, with ca_stats address
+    '127.0.0.1:<port>'. devices are paired as primary/secondary of `size`/2
+    rooms; secondaries stream, primaries do not. the fleet also serves
+    their ca_stats json at `ca_stats_url`.
+
+    `layout` maps channel number to ca_stats channel info (name and
+    publish_type); other kwargs are as in FakeDevice, for all devices.
+    """
+
+    def __init__(self, size, layout=None, user='user', passwd='passwd',
+                 delay=0, jitter=0, failure_rate=0):
+        """create instance and start serving."""
+        self.layout = layout or DEFAULT_LAYOUT
+        self.devices = []
+        try:
+            for i in range(size):
+                streaming = '6' if i % 2 else '0'
+                channels = dict([
+                    (chan, {'publish_type': streaming if 'live' in
+                            info['name'].lower() else info.get('publish_type', '0')})
+                    for chan, info in self.layout.items()])
+                self.devices.append(FakePearl(
+                    channels, user, passwd, delay, jitter, failure_rate))
+            self._serve()
+        except Exception:
+            self._stop_devices()
+            raise
+        self._ca_stats = json.dumps(self.ca_stats())
+
+    @property
+    def addresses(self):
+        return [d.address for d in self.devices]
+
+    @property
+    def ca_stats_url(self):
+        return 'http://%s/ca_stats.json' % self.host
+
+    @property
+    def request_count(self):
+        return sum([d.request_count for d in self.devices])
+
+    @property
+    def device_connection_count(self):
+        """connections opened to all devices."""
+        return sum([d.connection_count for d in self.devices])
+
+    def ca_stats(self):
+        """list of ca_stats entries for all devices in fleet."""
+        entries = []
+        for i, address in enumerate(self.addresses):
+            entries.append({
+                'location': 'Fake Room %04i' % (i // 2),
+                'role': 'Secondary' if i % 2 else 'Primary',
+                'address': address,
+                'ca_attributes': {
+                    'serial_number': 'FAKE%06i' % i,
+                    'channels': self.layout}})
+        return entries
+
+    def route(self, segments):
+        if segments == ['ca_stats.json']:
+            return (None, self._ca_stats)
+        return (None, None)
+
+    def stop(self):
+        self._stop_devices()
+        super(FakePearlFleet, self).stop()
+
+    def _stop_devices(self):
+        # in parallel: each server takes up to a poll interval to shut down
+        threads = [threading.Thread(target=d.stop) for d in self.devices]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
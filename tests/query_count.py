@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""count sql queries, to catch n+1 loading in tests."""
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+
+class QueryCounter(object):
+    """count of cursor executions; statements kept for failure messages."""
+
+    def __init__(self):
+        """create instance."""
+        self.statements = []
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+
+@contextmanager
+def count_queries(engine):
+    """count queries run by `engine` within block."""
+    counter = QueryCounter()
+    event.listen(engine, 'before_cursor_execute', counter)
+    try:
+        yield counter
+    finally:
+        event.remove(engine, 'before_cursor_execute', counter)
+
+
+def assert_constant_queries(db, fetch, grow):
+    """
+    assert `fetch()` runs the same number of queries before and after `grow()`.
+
+    session is emptied before each fetch, so lazy loads cannot be served
+    from objects already in the identity map.
+    """
+    db.session.remove()
+    with count_queries(db.engine) as before:
+        fetch()
+
+    grow()
+    db.session.remove()
+    with count_queries(db.engine) as after:
+        fetch()
+
+    assert after.count == before.count, \
+        'queries grew from %i to %i:\n%s' % (
+                before.count, after.count, '\n'.join(after.statements))
+    return after.count
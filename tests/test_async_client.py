@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""Tests for non-blocking epipearl client, against local fake pearls."""
+import os
+import socket
+import threading
+import time
+
+from mock import patch
+import pytest
+
+from cadash.metrics import registry
+from cadash.redunlive.async_client import AsyncEpipearl
+from cadash.redunlive.async_client import EventLoop
+from cadash.redunlive.async_client import HttpStatusError
+from cadash.redunlive.async_client import Return
+from cadash.redunlive.client import CircuitBreaker
+from cadash.redunlive.client import CircuitOpenError
+from cadash.redunlive.models import CaptureAgent
+
+from tests.fake_pearl import FakePearl
+
+
+def make_ca(pearl, loop, passwd='passwd'):
+    ca = CaptureAgent('SN%s' % pearl.address, pearl.address)
+    ca.channels['live']['channel'] = '1'
+    ca.channels['lowBR']['channel'] = '2'
+    ca.async_client = AsyncEpipearl(pearl.url, 'user', passwd, loop=loop)
+    return ca
+
+
+class TestAsyncEpipearl(object):
+
+    def setup(self):
+        self.pearl = FakePearl(channels={
+            '1': {'publish_type': '6'},
+            '2': {'publish_type': '0'}})
+        self.loop = EventLoop()
+        self.client = AsyncEpipearl(
+                self.pearl.url, 'user', 'passwd', loop=self.loop)
+
+    def teardown(self):
+        self.loop.close()
+        self.pearl.stop()
+
+
+    def test_get_params(self):
+        response = self.loop.run_until_complete(
+                self.client.get_params('1', {'publish_type': ''}))
+        assert response == {'publish_type': '6'}
+
+
+    def test_get_params_batch_is_pipelined(self):
+        response = self.loop.run_until_complete(
+                self.client.get_params_batch(['1', '2'], {'publish_type': ''}))
+        assert response == [{'publish_type': '6'}, {'publish_type': '0'}]
+        assert self.pearl.request_count == 2
+        assert self.pearl.connection_count == 1
+
+
+    def test_get_params_batch_http_error(self):
+        with pytest.raises(HttpStatusError) as e:
+            self.loop.run_until_complete(
+                    self.client.get_params_batch(['1', '99'], {'publish_type': ''}))
+        assert e.value.status_code == 404
+
+
+    def test_set_params(self):
+        ok = self.loop.run_until_complete(
+                self.client.set_params('2', {'publish_type': '6'}))
+        assert ok is True
+        assert self.pearl.channels['2']['publish_type'] == '6'
+
+
+    def test_http_error(self):
+        with pytest.raises(HttpStatusError) as e:
+            self.loop.run_until_complete(
+                    self.client.get_params('99', {'publish_type': ''}))
+        assert e.value.status_code == 404
+
+
+    def test_bad_credentials(self):
+        client = AsyncEpipearl(self.pearl.url, 'user', 'wrong', loop=self.loop)
+        with pytest.raises(HttpStatusError) as e:
+            self.loop.run_until_complete(
+                    client.get_params('1', {'publish_type': ''}))
+        assert e.value.status_code == 401
+
+
+    def test_timeout(self):
+        self.pearl.delay = 1
+        client = AsyncEpipearl(
+                self.pearl.url, 'user', 'passwd', loop=self.loop, timeout=0.2)
+        with pytest.raises(socket.timeout):
+            self.loop.run_until_complete(
+                    client.get_params('1', {'publish_type': ''}))
+
+
+    def test_task_returns_value(self):
+        def both_channels():
+            (live, lowbr) = yield [
+                    self.client.get_params('1', {'publish_type': ''}),
+                    self.client.get_params('2', {'publish_type': ''})]
+            raise Return((live['publish_type'], lowbr['publish_type']))
+
+        result = self.loop.run_until_complete(both_channels())
+        assert result == ('6', '0')
+
+
+    def test_host_name_resolved_off_loop(self):
+        port = self.pearl.address.split(':')[1]
+        client = AsyncEpipearl(
+                'http://localhost:%s' % port, 'user', 'passwd', loop=self.loop)
+        lookups = []
+        getaddrinfo = socket.getaddrinfo
+
+        def lookup(*args):
+            lookups.append((args[0], threading.current_thread()))
+            return getaddrinfo(*args)
+
+        with patch('cadash.redunlive.async_client.socket.getaddrinfo',
+                   side_effect=lookup):
+            response = self.loop.run_until_complete(
+                    client.get_params('1', {'publish_type': ''}))
+        assert response == {'publish_type': '6'}
+        assert [host for (host, thread) in lookups] == ['localhost']
+        assert lookups[0][1] is not threading.current_thread()
+
+
+    def test_file_descriptors_past_select_limit(self):
+        # select() fails on fds past FD_SETSIZE (1024)
+        fds = [os.dup(0) for i in range(1100)]
+        try:
+            response = self.loop.run_until_complete(
+                    self.client.get_params('1', {'publish_type': ''}))
+        finally:
+            for fd in fds:
+                os.close(fd)
+        assert response == {'publish_type': '6'}
+
+
+    def test_dead_device_opens_circuit(self):
+        address = self.pearl.address
+        self.pearl.stop()
+        client = AsyncEpipearl(
+                'http://%s' % address, 'user', 'passwd', loop=self.loop,
+                breaker=CircuitBreaker(address, threshold=1, backoff=60))
+        with pytest.raises(socket.error):
+            self.loop.run_until_complete(
+                    client.get_params('1', {'publish_type': ''}))
+        assert client.breaker.state == CircuitBreaker.OPEN
+
+        start = time.time()
+        with pytest.raises(CircuitOpenError):
+            self.loop.run_until_complete(
+                    client.get_params('1', {'publish_type': ''}))
+        assert time.time() - start < 0.05
+
+
+    def test_http_error_is_not_a_failure(self):
+        with pytest.raises(HttpStatusError):
+            self.loop.run_until_complete(
+                    self.client.get_params('99', {'publish_type': ''}))
+        assert self.client.breaker.failures == 0
+
+
+    def test_calls_are_instrumented(self):
+        registry.clear()
+        self.loop.run_until_complete(
+                self.client.get_params_batch(['1', '2'], {'publish_type': ''}))
+        with pytest.raises(HttpStatusError):
+            self.loop.run_until_complete(
+                    self.client.set_params('99', {'publish_type': '6'}))
+
+        latency = registry.get('epipearl_call_duration_seconds')
+        assert latency.get(
+                device=self.pearl.address, op='get_params_batch')['count'] == 1
+        assert registry.get('epipearl_call_errors_total').get(
+                device=self.pearl.address, op='set_params',
+                error='HttpStatusError') == 1
+        assert registry.get('epipearl_last_success_timestamp_seconds').get(
+                device=self.pearl.address) > time.time() - 5
+
+
+class TestCaptureAgentAsync(object):
+
+    def setup(self):
+        self.loop = EventLoop()
+
+    def teardown(self):
+        self.loop.close()
+
+    def test_sync_converging_live_status(self):
+        pearl = FakePearl(channels={
+            '1': {'publish_type': '6'}, '2': {'publish_type': '6'}})
+        ca = make_ca(pearl, self.loop)
+
+        self.loop.run_until_complete(ca.sync_live_status_async())
+        assert ca.channels['live']['publish_type'] == '6'
+        assert ca.channels['lowBR']['publish_type'] == '6'
+        # both channels read in a single connection
+        assert pearl.connection_count == 1
+        pearl.stop()
+
+
+    def test_sync_diverging_live_status(self):
+        pearl = FakePearl(channels={
+            '1': {'publish_type': '0'}, '2': {'publish_type': '6'}})
+        ca = make_ca(pearl, self.loop)
+
+        self.loop.run_until_complete(ca.sync_live_status_async())
+        assert ca.channels['live']['publish_type'] == '0'
+        assert ca.channels['lowBR']['publish_type'] == '0'
+        assert pearl.channels['2']['publish_type'] == '0'
+        pearl.stop()
+
+
+    def test_sync_unreachable_device(self):
+        pearl = FakePearl(channels={
+            '1': {'publish_type': '6'}, '2': {'publish_type': '6'}})
+        ca = make_ca(pearl, self.loop, passwd='wrong')
+
+        self.loop.run_until_complete(ca.sync_live_status_async())
+        assert ca.channels['live']['publish_type'] == 'not available'
+        assert ca.channels['lowBR']['publish_type'] == 'not available'
+        pearl.stop()
+
+
+    def test_write_live_status(self):
+        pearl = FakePearl(channels={
+            '1': {'publish_type': '0'}, '2': {'publish_type': '0'}})
+        ca = make_ca(pearl, self.loop)
+
+        result = self.loop.run_until_complete(ca.write_live_status_async('6'))
+        assert result == '6'
+        assert ca.channels['live']['publish_type'] == '6'
+        assert pearl.channels['1']['publish_type'] == '6'
+        assert pearl.channels['2']['publish_type'] == '6'
+        pearl.stop()
+
+
+    def test_many_devices_in_one_loop(self):
+        pearls = [FakePearl(
+            channels={'1': {'publish_type': '6'}, '2': {'publish_type': '6'}},
+            delay=0.3) for i in range(20)]
+        cas = [make_ca(p, self.loop) for p in pearls]
+
+        start = time.time()
+        self.loop.run_until_complete(
+                [ca.sync_live_status_async() for ca in cas])
+        # 20 devices with 0.3s per request, all concurrent in a single thread
+        assert time.time() - start < 2
+        for ca in cas:
+            assert ca.channels['live']['publish_type'] == '6'
+        for p in pearls:
+            p.stop()
@@ -21,6 +21,14 @@ def test_dev_config():
     assert app.config['ENV'] == 'dev'
     assert app.config['DEBUG'] is True
     assert app.config['ASSETS_DEBUG'] is True
+    assert app.config['TIMING_ENABLED'] is True
+
+
+def test_metrics_and_timing_off_by_default():
+    """not exposed unless enabled; dev aside."""
+    config = Config(environment='test')
+    assert config.METRICS_ENABLED is False
+    assert config.TIMING_ENABLED is False
 
 
 def test_invalid_environment():
@@ -1,13 +1,26 @@
 # -*- coding: utf-8 -*-
 """Tests for `data_masseuse` module."""
+import copy
 import os
 import pytest
+import time
 
 import json
 import httpretty
+from flask import current_app
+from mock import patch
 
+from cadash.redunlive import data_masseuse
+from cadash.redunlive.models import CaptureAgent
 from cadash.redunlive.models import CaLocation
+from cadash.redunlive.data_masseuse import bulk_switch_live_stream
 from cadash.redunlive.data_masseuse import map_redunlive_ca_loc
+from cadash.redunlive.data_masseuse import prep_redunlive_data
+from cadash.redunlive.data_masseuse import TopologyCache
+from cadash.redunlive.data_masseuse import sync_all_live_status
+
+from tests.fake_pearl import FakePearl
+from tests.fake_pearl import FakePearlFleet
 
 data_filename = os.path.join(
         os.path.abspath(os.path.dirname(__file__)), 'ca_loc_shortmap.json')
@@ -152,3 +165,338 @@ class TestDataMasseuse(object):
         assert loc.primary_ca.channels['live']['channel'] == 'not available'
         assert loc.active_livestream == 'secondary'
 
+
+
+class TestTopologyCache(object):
+
+    def setup(self):
+        txt = open(data_filename, 'r')
+        self.json_data = json.loads(txt.read())
+        txt.close()
+        self.topology = TopologyCache()
+
+
+    def test_same_content_is_not_built_again(self):
+        with patch('cadash.redunlive.data_masseuse._parse_ca_item',
+                   wraps=data_masseuse._parse_ca_item) as parse:
+            (locations, cas) = self.topology.get(self.json_data, version=1)
+            assert parse.call_count == 4
+            self.topology.get(self.json_data, version=1)
+            assert parse.call_count == 4
+            # new version, or no version, same content: not parsed again
+            self.topology.get(copy.deepcopy(self.json_data), version=2)
+            assert parse.call_count == 4
+            self.topology.get(copy.deepcopy(self.json_data))
+            assert parse.call_count == 4
+
+        assert sorted(cas) == sorted(
+                [ca['ca_attributes']['serial_number'] for ca in self.json_data])
+        loc = locations['fake_room']
+        assert loc.primary_ca.channels['live'] == {
+                'channel': '3', 'publish_type': '0'}
+        assert cas[loc.primary_ca.serial_number] is loc.primary_ca
+
+
+    def test_changed_location_is_patched(self):
+        other = copy.deepcopy(self.json_data[0])
+        other['location'] = 'Other Room'
+        other['ca_attributes']['serial_number'] = 'ED7OTHER'
+        self.json_data.append(other)
+
+        with patch('cadash.redunlive.data_masseuse.CaLocation',
+                   wraps=data_masseuse.CaLocation) as new_loc:
+            self.topology.get(self.json_data, version=1)
+            assert new_loc.call_count == 2
+            cached = dict(self.topology._locations)
+
+            data = copy.deepcopy(self.json_data)
+            data[0]['ca_attributes']['channels']['3']['publish_type'] = '1'
+            (locations, cas) = self.topology.get(data, version=2)
+            assert new_loc.call_count == 3
+
+        assert self.topology._locations['other_room'] is cached['other_room']
+        assert self.topology._locations['fake_room'] is not cached['fake_room']
+        serial_number = data[0]['ca_attributes']['serial_number']
+        assert cas[serial_number].channels['live']['publish_type'] == '1'
+        assert sorted(cas) == sorted(
+                [ca['ca_attributes']['serial_number'] for ca in data])
+
+
+    def test_removed_location_is_dropped(self):
+        self.topology.get(self.json_data, version=1)
+        gone = CaLocation.clean_name(self.json_data[0]['location'])
+        data = [ca for ca in self.json_data
+                if CaLocation.clean_name(ca['location']) != gone]
+        (locations, cas) = self.topology.get(data, version=2)
+        assert gone not in locations
+        assert self.json_data[0]['ca_attributes']['serial_number'] not in cas
+
+
+    def test_clear(self):
+        with patch('cadash.redunlive.data_masseuse._parse_ca_item',
+                   wraps=data_masseuse._parse_ca_item) as parse:
+            self.topology.get(self.json_data, version=1)
+            self.topology.clear()
+            self.topology.get(self.json_data, version=1)
+            assert parse.call_count == 8
+
+
+    def test_copies_have_own_state(self):
+        (first, first_cas) = self.topology.get(self.json_data, version=1)
+        loc = first['fake_room']
+        loc.primary_ca.channels['live']['publish_type'] = '6'
+        loc.primary_ca.client = 'fake client'
+
+        (second, second_cas) = self.topology.get(self.json_data, version=1)
+        other = second['fake_room']
+        assert other is not loc
+        assert other.primary_ca is not loc.primary_ca
+        assert other.primary_ca.serial_number == loc.primary_ca.serial_number
+        assert other.primary_ca.channels['live']['publish_type'] == '0'
+        assert other.primary_ca.client is None
+
+
+    def test_only_locations_asked_for(self):
+        (locations, cas) = self.topology.get(
+                self.json_data, version=1, loc_ids=['fake_room'])
+        assert list(locations) == ['fake_room']
+        loc = locations['fake_room']
+        assert sorted(cas) == sorted([
+            ca.serial_number for ca in
+            [loc.primary_ca, loc.secondary_ca] + loc.experimental_cas
+            if ca is not None])
+
+
+    @pytest.mark.usefixtures('testapp')
+    def test_map_builds_fresh_objects(self):
+        with patch('cadash.redunlive.data_masseuse.sync_all_live_status'), \
+                patch.object(data_masseuse, '_topology', self.topology):
+            first = map_redunlive_ca_loc(self.json_data, version=1)
+            second = map_redunlive_ca_loc(self.json_data, version=1)
+
+        loc1 = first['all_locations']['fake_room']
+        loc2 = second['all_locations']['fake_room']
+        assert loc1 is not loc2
+        assert loc1.primary_ca is not loc2.primary_ca
+        assert loc1.primary_ca.serial_number == loc2.primary_ca.serial_number
+        assert loc2.primary_ca.channels['live']['channel'] == '3'
+
+
+@pytest.mark.usefixtures('testapp')
+class TestSyncAllLiveStatus(object):
+
+    def setup(self):
+        self.cas = []
+        for i in range(4):
+            ca = CaptureAgent('ABCD000%i' % i, 'fake%i.example.edu' % i)
+            ca.channels['live']['channel'] = '1'
+            ca.channels['lowBR']['channel'] = '2'
+            self.cas.append(ca)
+
+
+    def test_sync_is_concurrent(self):
+        def slow_sync():
+            time.sleep(0.5)
+
+        for ca in self.cas:
+            ca.sync_live_status = slow_sync
+
+        start = time.time()
+        not_synced = sync_all_live_status(self.cas, workers=4, timeout=5)
+        assert time.time() - start < 1.5
+        assert not_synced == []
+
+
+    def test_sync_past_deadline(self):
+        def slow_sync():
+            time.sleep(1)
+
+        self.cas[0].sync_live_status = slow_sync
+        for ca in self.cas[1:]:
+            ca.sync_live_status = lambda: None
+
+        not_synced = sync_all_live_status(self.cas, workers=2, timeout=0.2)
+        assert not_synced == [self.cas[0]]
+
+
+    def test_late_sync_is_dropped(self):
+        class SlowCaptureAgent(CaptureAgent):
+            def sync_live_status(self):
+                time.sleep(0.5)
+                self.channels['live']['publish_type'] = '6'
+                self.channels['lowBR']['publish_type'] = '6'
+
+        class FastCaptureAgent(CaptureAgent):
+            def sync_live_status(self):
+                self.channels['live']['publish_type'] = '6'
+                self.channels['lowBR']['publish_type'] = '6'
+
+        slow = SlowCaptureAgent('ABCD0010', 'slow.example.edu')
+        fast = FastCaptureAgent('ABCD0011', 'fast.example.edu')
+
+        not_synced = sync_all_live_status([slow, fast], workers=2, timeout=0.1)
+        assert not_synced == [slow]
+        assert fast.channels['live']['publish_type'] == '6'
+
+        time.sleep(0.8)
+        assert slow.channels['live']['publish_type'] == 'not available'
+        assert slow.channels['lowBR']['publish_type'] == 'not available'
+
+
+    def test_last_update_is_merged(self):
+        pearl = FakePearl(
+                channels={'1': {'publish_type': '6'},
+                          '2': {'publish_type': '6'}},
+                user=current_app.config['EPIPEARL_USER'],
+                passwd=current_app.config['EPIPEARL_PASSWD'])
+        try:
+            ca = CaptureAgent('ABCD0012', pearl.address)
+            ca.channels['live']['channel'] = '1'
+            ca.channels['lowBR']['channel'] = '2'
+            before = ca.last_update
+            data_masseuse.set_epipearl_client(ca)
+
+            assert sync_all_live_status([ca], workers=1, timeout=5) == []
+        finally:
+            pearl.stop()
+        assert ca.channels['live']['publish_type'] == '6'
+        assert ca.last_update > before
+
+
+@pytest.mark.usefixtures('testapp')
+class TestBulkSwitchLiveStream(object):
+
+    def setup(self):
+        # room0..room3 stream from secondary; room4 is not streaming
+        self.pearls = []
+        self.ca_stats = []
+        for i in range(5):
+            publish_type = '0' if i == 4 else '6'
+            for role, live in [('Primary', '0'), ('Secondary', publish_type)]:
+                pearl = FakePearl(
+                        channels={'1': {'publish_type': live},
+                                  '2': {'publish_type': live}},
+                        user=current_app.config['EPIPEARL_USER'],
+                        passwd=current_app.config['EPIPEARL_PASSWD'])
+                self.pearls.append(pearl)
+                self.ca_stats.append({
+                    'location': 'room%i' % i,
+                    'role': role,
+                    'address': pearl.address,
+                    'ca_attributes': {
+                        'serial_number': 'SN%s%i' % (role, i),
+                        'channels': {
+                            '1': {'name': 'live'},
+                            '2': {'name': 'live lowBR'}}}})
+
+    def teardown(self):
+        for pearl in self.pearls:
+            pearl.stop()
+
+
+    def test_bulk_switch_is_concurrent(self):
+        current_app.config['REDUNLIVE_SWITCH_DELAY'] = 0.3
+        loc_ids = ['room%i' % i for i in range(4)]
+
+        start = time.time()
+        with patch.object(current_app.extensions['ca_stats'],
+                          'get_versioned_json',
+                          return_value=(self.ca_stats, None)):
+            results = bulk_switch_live_stream(
+                    loc_ids, 'primary', max_parallel=4)
+        # 4 switch-overs of 0.3s each
+        assert time.time() - start < 0.9
+
+        assert [r['loc_id'] for r in results] == loc_ids
+        for r in results:
+            assert r['status'] == 'switched'
+            assert r['active_livestream'] == 'primary'
+        # primary devices streaming; secondary restarted as backup
+        for pearl in self.pearls[:8]:
+            assert pearl.channels['1']['publish_type'] == '6'
+            assert pearl.channels['2']['publish_type'] == '6'
+
+
+    def test_bulk_switch_per_location_results(self):
+        with patch.object(current_app.extensions['ca_stats'],
+                          'get_versioned_json',
+                          return_value=(self.ca_stats, None)):
+            results = bulk_switch_live_stream(
+                    ['room0', 'room4', 'no_such_room'], 'primary')
+
+        assert [r['status'] for r in results] == \
+                ['switched', 'skipped', 'failed']
+        assert results[2]['error'] == 'unknown location (no_such_room)'
+        # room4 untouched
+        assert self.pearls[8].channels['1']['publish_type'] == '0'
+
+
+    def test_bulk_switch_pool_sized_to_request(self):
+        current_app.config['REDUNLIVE_SWITCH_DELAY'] = 0
+        current_app.config['REDUNLIVE_SWITCH_PAUSE'] = 0
+        loc_ids = ['room%i' % i for i in range(5)]
+
+        with patch.object(current_app.extensions['ca_stats'],
+                          'get_versioned_json',
+                          return_value=(self.ca_stats, None)), \
+                patch('cadash.redunlive.data_masseuse.ThreadPool',
+                      wraps=data_masseuse.ThreadPool) as pool:
+            bulk_switch_live_stream(loc_ids, 'primary')
+            # room4 not streaming: no thread for it
+            assert pool.call_args_list[-1][1] == {'processes': 4}
+
+            bulk_switch_live_stream(loc_ids, 'secondary', max_parallel=2)
+            assert pool.call_args_list[-1][1] == {'processes': 2}
+
+
+    def test_bulk_switch_invalid_device(self):
+        with pytest.raises(ValueError):
+            bulk_switch_live_stream(['room0'], 'tertiary')
+
+
+@pytest.mark.usefixtures('testapp')
+class TestFakePearlFleet(object):
+
+    def setup(self):
+        self.fleet = None
+
+    def teardown(self):
+        if self.fleet is not None:
+            self.fleet.stop()
+
+
+    def start_fleet(self, size, **kwargs):
+        self.fleet = FakePearlFleet(
+                size, user=current_app.config['EPIPEARL_USER'],
+                passwd=current_app.config['EPIPEARL_PASSWD'], **kwargs)
+        current_app.config['CA_STATS_JSON_URL'] = self.fleet.ca_stats_url
+
+
+    def test_fleet_locations(self):
+        self.start_fleet(10, delay=0.01, jitter=0.01)
+
+        data = prep_redunlive_data()
+        assert len(data['all_locations']) == 5
+        assert len(data['all_cas']) == 10
+        for loc in data['all_locations'].values():
+            assert loc.primary_ca is not None
+            assert loc.secondary_ca is not None
+            assert loc.active_livestream == 'secondary'
+        # one read per channel, per device
+        assert self.fleet.request_count == 20
+        # each device its own address, and its own connection
+        assert len(set([ca.address for ca in data['all_cas'].values()])) == 10
+        assert self.fleet.device_connection_count == 10
+        for device in self.fleet.devices:
+            assert device.request_count == 2
+
+
+    def test_fleet_failing_devices(self):
+        self.start_fleet(4, failure_rate=1)
+
+        data = prep_redunlive_data()
+        assert len(data['all_cas']) == 4
+        for ca in data['all_cas'].values():
+            assert ca.channels['live']['publish_type'] == 'not available'
+        for loc in data['all_locations'].values():
+            assert loc.active_livestream is None
@@ -4,6 +4,7 @@
 See: http://webtest.readthedocs.org/
 """
 import os
+import threading
 
 import httpretty
 from flask import url_for
@@ -96,6 +97,18 @@ class TestRedunlive(object):
         # toggle active_device from secondary to primary
         res = form.submit()
 
+        # switch-over runs in background; page shows it in progress
+        jobs = testapp_login_disabled.app.extensions['redunlive_jobs']
+        assert 'switch fake_room to primary' in res
+        job = jobs.get(res.html.find(class_='redunlive-job')[
+            'data-job-url'].rsplit('/', 1)[-1])
+        assert job.wait(5)
+
+        res = testapp_login_disabled.get('/redunlive/jobs/%s' % job.id)
+        assert res.json['state'] == 'done'
+        assert res.json['result'] == 'primary'
+
+        res = testapp_login_disabled.get('/redunlive/')
         radio = res.forms['fake_room']['active_device']
         assert radio.value == 'primary'
 
@@ -103,6 +116,77 @@ class TestRedunlive(object):
         httpretty.reset()
 
 
+    def test_bulk_switch(self, testapp_login_disabled):
+        httpretty.enable()
+        self.register_uri_for_http()
+
+        res = testapp_login_disabled.post_json(
+                '/redunlive/bulk',
+                {'loc_ids': ['fake_room', 'fake_room'], 'active_device': 'primary'})
+        assert res.status_code == 202
+        assert res.headers['Location'].endswith('/redunlive/jobs/%s' % res.json['id'])
+
+        job = testapp_login_disabled.app.extensions['redunlive_jobs'].get(
+                res.json['id'])
+        assert job.wait(5)
+        res = testapp_login_disabled.get(res.headers['Location'])
+        assert res.json['state'] == 'done'
+        assert res.json['result'] == [{
+            'loc_id': 'fake_room', 'status': 'switched',
+            'active_livestream': 'primary', 'error': None}]
+
+        httpretty.disable()
+        httpretty.reset()
+
+
+    def test_bulk_switch_bad_request(self, testapp_login_disabled):
+        res = testapp_login_disabled.post_json(
+                '/redunlive/bulk', {'loc_ids': [], 'active_device': 'primary'},
+                expect_errors=True)
+        assert res.status_code == 400
+        res = testapp_login_disabled.post_json(
+                '/redunlive/bulk', {'loc_ids': ['fake_room']},
+                expect_errors=True)
+        assert res.status_code == 400
+        for loc_ids in ([{'id': 'fake_room'}], [['fake_room']], [1]):
+            res = testapp_login_disabled.post_json(
+                    '/redunlive/bulk',
+                    {'loc_ids': loc_ids, 'active_device': 'primary'},
+                    expect_errors=True)
+            assert res.status_code == 400
+
+
+    def test_switch_location_busy(self, testapp_login_disabled):
+        """a location with a job running, in any worker, is not switched."""
+        jobs = testapp_login_disabled.app.extensions['redunlive_jobs']
+        release = threading.Event()
+        job = jobs.submit(release.wait, args=(5,), target='fake_room')
+
+        res = testapp_login_disabled.post_json(
+                '/redunlive/bulk',
+                {'loc_ids': ['fake_room'], 'active_device': 'primary'},
+                expect_errors=True)
+        assert res.status_code == 409
+        assert res.json['loc_id'] == 'fake_room'
+        assert res.json['job_id'] == job.id
+        assert res.headers['Location'].endswith('/redunlive/jobs/%s' % job.id)
+
+        res = testapp_login_disabled.post(
+                '/redunlive/',
+                {'loc_id': 'fake_room', 'active_device': 'primary'},
+                xhr=True, expect_errors=True)
+        assert res.status_code == 409
+
+        release.set()
+        assert job.wait(5)
+
+
+    def test_job_status_not_found(self, testapp_login_disabled):
+        res = testapp_login_disabled.get(
+                '/redunlive/jobs/fake_job_id', expect_errors=True)
+        assert res.status_code == 404
+
+
     def register_uri_for_http(self):
         """register uri's for a normal request of redunlive homepage."""
         # pull info on all locations and cas via ca_stats
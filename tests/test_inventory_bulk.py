@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""tests bulk import of inventory records."""
+import json
+import os
+import time
+
+import pytest
+
+from cadash.inventory.bulk import batch_from_ca_stats
+from cadash.inventory.bulk import import_inventory
+from cadash.inventory.bulk import rows_from_csv
+from cadash.inventory.errors import InvalidImportDataError
+from cadash.inventory.models import Ca
+from cadash.inventory.models import Location
+from cadash.inventory.models import MhCluster
+from cadash.inventory.models import Role
+from cadash.inventory.models import Vendor
+
+from tests.query_count import count_queries
+
+data_filename = os.path.join(
+        os.path.abspath(os.path.dirname(__file__)), 'ca_loc_shortmap.json')
+
+
+def fleet_batch(size):
+    """batch with `size` locations, each with a primary ca."""
+    return {
+        'vendors': [{'name': 'epiphan', 'model': 'pearl'}],
+        'clusters': [
+            {'name': 'prod', 'admin_host': 'admin.fake.test', 'env': 'prod'}],
+        'locations': [{'name': 'room %i' % i} for i in range(size)],
+        'cas': [{'name': 'ca%i' % i, 'address': 'ca%i.fake.test' % i,
+                 'serial_number': 'SN%i' % i, 'vendor': 'epiphan_pearl'}
+                for i in range(size)],
+        'roles': [{'ca': 'ca%i' % i, 'location': 'room %i' % i,
+                   'cluster': 'prod', 'name': 'primary'}
+                  for i in range(size)]}
+
+
+@pytest.mark.usefixtures('db')
+class TestBulkImport(object):
+
+    def test_import_batch(self, db):
+        report = import_inventory(fleet_batch(3))
+        for kind in ('vendors', 'clusters'):
+            assert report[kind]['created'] == 1
+        for kind in ('locations', 'cas', 'roles'):
+            assert report[kind]['created'] == 3
+            assert report[kind]['errors'] == []
+
+        ca = Ca.query.filter_by(name='ca1').first()
+        assert ca.vendor.name_id == 'epiphan_pearl'
+        assert ca.role.name == 'primary'
+        assert ca.location.name == 'room 1'
+        assert ca.mh_cluster.name == 'prod'
+
+
+    def test_import_is_upsert(self, db):
+        import_inventory(fleet_batch(3))
+        updated_at = Ca.query.filter_by(name='ca0').first().updated_at
+
+        batch = fleet_batch(4)
+        batch['cas'][0]['address'] = 'new-ca0.fake.test'
+        batch['clusters'][0]['env'] = 'stage'
+        report = import_inventory(batch)
+
+        assert report['vendors']['unchanged'] == 1
+        assert report['clusters']['updated'] == 1
+        assert report['locations'] == {
+                'created': 1, 'updated': 0, 'unchanged': 3, 'errors': []}
+        assert report['cas'] == {
+                'created': 1, 'updated': 1, 'unchanged': 2, 'errors': []}
+        assert report['roles']['unchanged'] == 3
+        assert report['roles']['created'] == 1
+
+        ca = Ca.query.filter_by(name='ca0').first()
+        assert ca.address == 'new-ca0.fake.test'
+        assert ca.updated_at > updated_at
+        assert MhCluster.query.filter_by(name='prod').first().env == 'stage'
+        assert Ca.query.count() == 4
+
+
+    def test_per_row_errors(self, db):
+        import_inventory(fleet_batch(2))
+
+        report = import_inventory({
+            'cas': [
+                {'name': 'ca9', 'address': 'ca9.fake.test',
+                 'vendor': 'epiphan_pearl'},
+                {'name': 'ca10', 'address': 'ca9.fake.test',
+                 'vendor': 'epiphan_pearl'},
+                {'name': 'ca11', 'address': 'ca0.fake.test',
+                 'vendor': 'epiphan_pearl'},
+                {'name': 'ca12', 'address': 'ca12.fake.test',
+                 'vendor': 'no_such_vendor'},
+                {'name': 'ca13', 'address': 'ca13.fake.test',
+                 'serial_number': 'SN1', 'vendor': 'epiphan_pearl'},
+                {'name': '', 'address': 'ca14.fake.test', 'vendor_id': 1},
+                'not a row'],
+            'roles': [
+                {'ca': 'ca9', 'location': 'room 0', 'cluster': 'prod',
+                 'name': 'primary'},
+                {'ca': 'ca9', 'location': 'room 1', 'cluster': 'prod',
+                 'name': 'tertiary'},
+                {'ca': 'ca99', 'location': 'room 1', 'cluster': 'prod',
+                 'name': 'experimental'},
+                {'ca': 'ca0', 'location': 'room 1', 'cluster': 'prod',
+                 'name': 'primary'}]})
+
+        assert report['cas']['created'] == 1
+        errors = dict([(e['row'], e['message'])
+                      for e in report['cas']['errors']])
+        assert errors[1] == 'duplicate ca address(ca9.fake.test) in batch'
+        assert errors[2] == 'duplicate ca address(ca0.fake.test)'
+        assert errors[3] == 'not in inventory: vendor(no_such_vendor)'
+        assert errors[4] == 'duplicate ca serial_number(SN1)'
+        assert 'empty value' in errors[5]
+        assert errors[6] == 'row must be an object'
+
+        assert report['roles']['created'] == 0
+        errors = dict([(e['row'], e['message'])
+                      for e in report['roles']['errors']])
+        assert 'already has ca with role(primary)' in errors[0]
+        assert 'invalid ca-role(tertiary)' in errors[1]
+        assert errors[2] == 'not in inventory: ca(ca99)'
+        assert 'already has a role(primary)' in errors[3]
+
+        assert Ca.query.filter_by(name='ca9').first().role is None
+
+
+    def test_dry_run(self, db):
+        report = import_inventory(fleet_batch(3), commit=False)
+        assert report['cas']['created'] == 3
+        assert Ca.query.count() == 0
+        assert Vendor.query.count() == 0
+
+
+    def test_invalid_batch(self, db):
+        with pytest.raises(InvalidImportDataError):
+            import_inventory([])
+        with pytest.raises(InvalidImportDataError):
+            import_inventory({'users': []})
+        with pytest.raises(InvalidImportDataError):
+            import_inventory({'cas': {}})
+
+
+    def test_csv(self, db):
+        rows = rows_from_csv(
+                u'name,admin_host,env\n'
+                u'prod,admin.fake.test,PROD\n'
+                u'dev,admin-dev.fake.test,nope\n')
+        report = import_inventory({'clusters': rows})
+        assert report['clusters']['created'] == 1
+        assert report['clusters']['errors'][0]['row'] == 1
+        assert MhCluster.query.filter_by(name='prod').first().env == 'prod'
+
+
+    def test_seed_from_ca_stats(self, db):
+        with open(data_filename, 'r') as f:
+            data = json.load(f)
+        MhCluster.create(name='prod', admin_host='admin.fake.test', env='prod')
+
+        report = import_inventory(batch_from_ca_stats(data, cluster='prod'))
+        assert report['vendors']['created'] == 1
+        assert report['locations']['created'] == 1
+        # two entries for ca named 'fake-epiphan033'
+        assert report['cas']['created'] == 3
+        assert report['cas']['errors'][0]['row'] == 1
+        assert report['roles']['created'] == 3
+
+        loc = Location.query.filter_by(name='Fake Room').first()
+        # role of duplicate ca entry (primary) is skipped too
+        assert sorted([r.name for r in loc.capture_agents]) == \
+            ['experimental', 'experimental', 'secondary']
+
+
+    def test_large_import_is_set_based(self, db):
+        start = time.time()
+        with count_queries(db.engine) as counter:
+            report = import_inventory(fleet_batch(2000))
+        assert report['roles']['created'] == 2000
+        assert Role.query.count() == 2000
+        # queries grow with chunks of rows, not with rows
+        assert counter.count < 100
+        assert time.time() - start < 10
+
+
+@pytest.mark.usefixtures('db', 'testapp_login_disabled')
+class TestImportResource(object):
+
+    def test_import_json(self, testapp_login_disabled):
+        res = testapp_login_disabled.post_json(
+                '/api/inventory/import', fleet_batch(2))
+        assert res.status_int == 200
+        assert res.json['cas']['created'] == 2
+        assert Role.query.count() == 2
+
+    def test_import_dry_run(self, testapp_login_disabled):
+        res = testapp_login_disabled.post_json(
+                '/api/inventory/import?dry_run=true', fleet_batch(2))
+        assert res.json['cas']['created'] == 2
+        assert Ca.query.count() == 0
+
+    def test_import_csv(self, testapp_login_disabled):
+        res = testapp_login_disabled.post(
+                '/api/inventory/import?kind=locations',
+                'name\nroom a\nroom b\n',
+                headers={'Content-Type': 'text/csv'})
+        assert res.json['locations']['created'] == 2
+
+        res = testapp_login_disabled.post(
+                '/api/inventory/import', 'name\nroom a\n',
+                headers={'Content-Type': 'text/csv'}, expect_errors=True)
+        assert res.status_int == 400
+
+    def test_import_ca_stats(self, testapp_login_disabled):
+        with open(data_filename, 'r') as f:
+            data = json.load(f)
+        res = testapp_login_disabled.post_json('/api/inventory/import', data)
+        assert res.json['cas']['created'] == 3
+        assert 'roles' not in res.json
+
+    def test_invalid_batch(self, testapp_login_disabled):
+        res = testapp_login_disabled.post_json(
+                '/api/inventory/import', {'users': []}, expect_errors=True)
+        assert res.status_int == 400
+        assert 'unknown kinds' in res.json['message']
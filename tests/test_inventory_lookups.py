@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""tests for cached inventory lookups."""
+import pytest
+
+from cadash.extensions import cache
+from cadash.inventory import bulk
+from cadash.inventory.lookups import get_select_list_for_clusters
+from cadash.inventory.lookups import get_select_list_for_locations
+from cadash.inventory.lookups import get_select_list_for_vendors
+from cadash.inventory.models import Location
+from cadash.inventory.models import Vendor
+
+from tests.factories import LocationFactory
+from tests.query_count import count_queries
+
+
+@pytest.mark.usefixtures('db', 'simple_db')
+class TestCachedLookups(object):
+
+    def test_second_call_from_cache(self, db):
+        first = get_select_list_for_locations()
+        with count_queries(db.engine) as counter:
+            assert get_select_list_for_locations() == first
+            assert counter.count == 0
+
+    def test_create_invalidates(self, db):
+        before = get_select_list_for_locations()
+        LocationFactory(name='new room')
+        db.session.commit()
+        after = get_select_list_for_locations()
+        assert len(after) == len(before) + 1
+        assert 'new_room' in [name for (i, name) in after]
+
+    def test_update_invalidates(self, db, simple_db):
+        get_select_list_for_vendors()
+        simple_db['vendor'].update(name='renamed', model='x')
+        assert (simple_db['vendor'].id, 'renamed_x') in \
+            get_select_list_for_vendors()
+
+    def test_delete_invalidates(self, db):
+        before = get_select_list_for_clusters()
+        location = Location.create(name='to be deleted')
+        get_select_list_for_locations()
+        location.delete()
+        assert 'to_be_deleted' not in \
+            [name for (i, name) in get_select_list_for_locations()]
+        # other tables keep their version
+        with count_queries(db.engine) as counter:
+            assert get_select_list_for_clusters() == before
+            assert counter.count == 0
+
+    def test_rollback_does_not_invalidate(self, db):
+        get_select_list_for_vendors()
+        Vendor(name='rolled', model='back').save(commit=False)
+        db.session.flush()
+        db.session.rollback()
+        with count_queries(db.engine) as counter:
+            get_select_list_for_vendors()
+            assert counter.count == 0
+
+    def test_bulk_import_invalidates(self, db):
+        get_select_list_for_locations()
+        bulk.import_inventory({'locations': [{'name': 'bulk room'}]})
+        assert 'bulk_room' in \
+            [name for (i, name) in get_select_list_for_locations()]
+
+    def test_evicted_version_not_stale(self, db):
+        get_select_list_for_locations()
+        cache.delete('table_version:location')
+        LocationFactory(name='after eviction')
+        db.session.commit()
+        cache.delete('table_version:location')
+        assert 'after_eviction' in \
+            [name for (i, name) in get_select_list_for_locations()]
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 """Tests for `models` in redunlive webapp."""
 import datetime as dt
+from mock import patch
 import pytest
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.exc import SQLAlchemyError
@@ -29,6 +30,7 @@ from tests.factories import CaFactory
 from tests.factories import LocationFactory
 from tests.factories import MhClusterFactory
 from tests.factories import VendorFactory
+from tests.query_count import count_queries
 
 @pytest.mark.usefixtures('db', 'simple_db')
 class TestCaptureAgentModel(object):
@@ -132,6 +134,14 @@ class TestLocationModel(object):
         assert bool(loc.created_at)
         assert isinstance(loc.created_at, dt.datetime)
 
+    def test_updated_at_server_default(self, db):
+        """rows inserted outside the orm get updated_at from the database."""
+        db.session.execute(
+                "INSERT INTO location (name, created_at) "
+                "VALUES ('room Z', '2016-01-01 00:00:00')")
+        loc = Location.query.filter_by(name='room Z').first()
+        assert isinstance(loc.updated_at, dt.datetime)
+
     def test_name_id(self):
         """test name_id is populated."""
         loc = Location.create(name='room A')
@@ -267,6 +277,67 @@ class TestMhClusterModel(object):
             c.update(env='BriteClass')
 
 
+@pytest.mark.usefixtures('db', 'simple_db')
+class TestUniqueConstraints(object):
+    """unique fields checked in a single query, and on integrity errors."""
+
+    def unique_checks(self, statements, table):
+        return [q for q in statements
+                if q.startswith('SELECT') and 'FROM %s ' % table in q + ' ']
+
+    def test_single_query_for_all_unique_fields(self, db, simple_db):
+        with count_queries(db.engine) as counter:
+            Ca.create(name='fake-epiphan', address='fake-epiphan.blah.net',
+                      serial_number='XYZ', vendor_id=simple_db['vendor'].id)
+        assert len(self.unique_checks(counter.statements, 'ca')) == 1
+
+        with count_queries(db.engine) as counter:
+            MhCluster.create(
+                    name='fake-cluster', admin_host='fake-cluster.blah.net',
+                    env='dev')
+        assert len(self.unique_checks(counter.statements, 'mhcluster')) == 1
+
+    def test_no_query_for_unchanged_unique_fields(self, db, simple_db):
+        ca = Ca.get_by_id(simple_db['ca'][0].id)
+        with count_queries(db.engine) as counter:
+            ca._check_constraints(name=ca.name, address=ca.address)
+        assert counter.count == 0
+
+    def test_duplicate_serial_number_in_batch_query(self, simple_db):
+        """other fields unique; still report the taken one."""
+        with pytest.raises(DuplicateCaptureAgentSerialNumberError):
+            Ca.create(name='fake-epiphan', address='fake-epiphan.blah.net',
+                      serial_number=simple_db['ca'][3].serial_number,
+                      vendor_id=simple_db['vendor'].id)
+
+    def test_integrity_error_mapped_to_duplicate_error(self, db, simple_db):
+        """concurrent write took the name after checks passed."""
+        with patch.object(Ca, 'check_unique', return_value=True):
+            ca = Ca(name=simple_db['ca'][1].name, address='fake-epiphan.blah.net',
+                    vendor_id=simple_db['vendor'].id)
+        with pytest.raises(DuplicateCaptureAgentNameError) as e:
+            ca.save()
+        assert 'duplicate ca name(%s)' % simple_db['ca'][1].name in str(e.value)
+
+        # session usable after rollback
+        assert Ca.query.count() == 5
+
+    def test_integrity_error_on_update(self, db, simple_db):
+        loc = Location.get_by_id(simple_db['room'][1].id)
+        loc.name = simple_db['room'][2].name
+        with pytest.raises(DuplicateLocationNameError):
+            loc.save()
+        assert Location.get_by_id(simple_db['room'][1].id).name == \
+            simple_db['room'][1].name
+
+    def test_integrity_error_not_unique_reraised(self, db, simple_db):
+        ca = Ca(name='fake-epiphan', address='fake-epiphan.blah.net',
+                vendor_id=simple_db['vendor'].id)
+        ca.address = None
+        with pytest.raises(IntegrityError):
+            ca.save()
+
+
 @pytest.mark.usefixtures('db', 'simple_db')
 class TestRelationship(object):
     """test for relationship role."""
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""tests number of queries of inventory lists does not grow with rows."""
+import pytest
+
+from cadash.inventory.models import Role
+
+from tests.factories import CaFactory
+from tests.factories import LocationFactory
+from tests.factories import MhClusterFactory
+from tests.factories import VendorFactory
+from tests.query_count import assert_constant_queries
+
+
+LIST_URLS = [
+        '/inventory/ca/list',
+        '/inventory/vendor/list',
+        '/inventory/cluster/list',
+        '/inventory/location/list',
+        '/inventory/role/list',
+        '/api/inventory/cas',
+        '/api/inventory/vendors',
+        '/api/inventory/clusters',
+        '/api/inventory/locations',
+        '/api/inventory/roles',
+]
+
+
+@pytest.mark.usefixtures('db', 'simple_db', 'testapp_login_disabled')
+class TestInventoryListQueries(object):
+
+    def grow(self, db):
+        """add locations, each with a primary ca of a new vendor."""
+        cluster = MhClusterFactory()
+        for i in range(5):
+            vendor = VendorFactory()
+            db.session.commit()
+            ca = CaFactory(vendor_id=vendor.id)
+            location = LocationFactory()
+            db.session.commit()
+            Role.create(
+                    ca=ca, location=location, cluster=cluster, name='primary')
+
+
+    @pytest.mark.parametrize('url', LIST_URLS)
+    def test_list_queries_constant(self, db, testapp_login_disabled, url):
+        count = assert_constant_queries(
+                db,
+                lambda: testapp_login_disabled.get(url),
+                lambda: self.grow(db))
+        assert count <= 2
+
+
+    def test_role_list_profile(self, db):
+        # role list page renders `form` as login form for anonymous users,
+        # so check what it renders from roles
+        def fetch():
+            return [(r.name, r.ca.name_id, r.location.name_id, r.cluster.name_id)
+                    for r in Role.query_for('list').all()]
+
+        count = assert_constant_queries(db, fetch, lambda: self.grow(db))
+        assert count == 1
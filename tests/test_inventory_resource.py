@@ -19,6 +19,8 @@ from cadash.inventory.models import MhCluster
 from cadash.inventory.models import Role
 from cadash.inventory.models import Vendor
 
+from tests.query_count import count_queries
+
 
 @pytest.mark.usefixtures('db', 'simple_db', 'testapp')
 class TestCaResourceAuthenticated(object):
@@ -405,3 +407,167 @@ class TestRoleResource(object):
         assert res.status_int == 204
         assert simple_db['ca'][2].role is None
 
+
+
+@pytest.mark.usefixtures('db', 'simple_db', 'testapp_login_disabled')
+class TestResourceListPagination(object):
+    """keyset pagination, filters and fields in list resources."""
+
+    def test_pages_follow_link_header(self, testapp_login_disabled, simple_db):
+        """walk all pages of ca list, 2 at a time."""
+        url = '/api/inventory/cas?limit=2'
+        ids = []
+        pages = 0
+        while url:
+            res = testapp_login_disabled.get(url)
+            json_data = json.loads(res.body)
+            assert len(json_data) <= 2
+            ids.extend([c['id'] for c in json_data])
+            pages += 1
+            link = res.headers.get('Link')
+            url = link[1:link.index('>')] if link else None
+        assert pages == 3
+        assert ids == sorted([c.id for c in simple_db['ca']])
+
+    def test_after(self, testapp_login_disabled, simple_db):
+        """list starts after given key."""
+        after = simple_db['ca'][2].id
+        res = testapp_login_disabled.get('/api/inventory/cas?after=%i' % after)
+        json_data = json.loads(res.body)
+        assert [c['id'] for c in json_data] == \
+            [c.id for c in simple_db['ca'][3:]]
+        assert 'Link' not in res.headers
+
+    def test_default_page_size(self, testapp_login_disabled, simple_db):
+        """paged even without page args; page size capped by config."""
+        testapp_login_disabled.app.config['API_PAGE_SIZE'] = 2
+        res = testapp_login_disabled.get('/api/inventory/locations')
+        assert len(json.loads(res.body)) == 2
+        assert 'after=%i' % simple_db['room'][1].id in res.headers['Link']
+
+        testapp_login_disabled.app.config['API_MAX_PAGE_SIZE'] = 3
+        res = testapp_login_disabled.get('/api/inventory/locations?limit=100')
+        assert len(json.loads(res.body)) == 3
+
+    def test_invalid_limit(self, testapp_login_disabled):
+        res = testapp_login_disabled.get(
+                '/api/inventory/cas?limit=0', expect_errors=True)
+        assert res.status_int == 400
+        res = testapp_login_disabled.get(
+                '/api/inventory/cas?limit=abc', expect_errors=True)
+        assert res.status_int == 400
+
+    def test_fields(self, testapp_login_disabled, simple_db):
+        """only requested fields are returned."""
+        res = testapp_login_disabled.get('/api/inventory/cas?fields=id,name')
+        json_data = json.loads(res.body)
+        assert len(json_data) == 5
+        for c in json_data:
+            assert sorted(c.keys()) == ['id', 'name']
+
+    def test_unknown_fields(self, testapp_login_disabled):
+        res = testapp_login_disabled.get(
+                '/api/inventory/cas?fields=id,password', expect_errors=True)
+        assert res.status_int == 400
+        assert 'password' in res.body
+
+    def test_ca_filters(self, testapp_login_disabled, simple_db):
+        """filter cas by vendor, location, cluster, role and env."""
+        def ca_ids(query):
+            res = testapp_login_disabled.get('/api/inventory/cas?%s' % query)
+            return [c['id'] for c in json.loads(res.body)]
+
+        all_ids = [c.id for c in simple_db['ca']]
+        assert ca_ids('vendor_id=%i' % simple_db['vendor'].id) == all_ids
+        assert ca_ids('vendor_id=999999') == []
+        assert ca_ids('location_id=%i' % simple_db['room'][0].id) == \
+            all_ids[:3]
+        assert ca_ids('cluster_id=%i' % simple_db['cluster'][1].id) == []
+        assert ca_ids('role=primary') == [simple_db['ca'][2].id]
+        assert ca_ids('role=experimental&limit=1') == [simple_db['ca'][0].id]
+        assert ca_ids('env=dev') == all_ids[:3]
+        assert ca_ids('env=prod') == []
+
+    def test_role_filters(self, testapp_login_disabled, simple_db):
+        res = testapp_login_disabled.get(
+                '/api/inventory/roles?name=experimental&fields=ca_id')
+        assert json.loads(res.body) == [
+                {'ca_id': simple_db['ca'][0].id},
+                {'ca_id': simple_db['ca'][1].id}]
+
+        res = testapp_login_disabled.get(
+                '/api/inventory/roles?limit=1&after=%i' % simple_db['ca'][0].id)
+        assert [r['ca_id'] for r in json.loads(res.body)] == \
+            [simple_db['ca'][1].id]
+        assert 'after=%i' % simple_db['ca'][1].id in res.headers['Link']
+
+
+@pytest.mark.usefixtures('db', 'simple_db', 'testapp_login_disabled')
+class TestResourceConditionalGet(object):
+    """weak etags and 304s."""
+
+    def test_not_modified(self, db, testapp_login_disabled):
+        res = testapp_login_disabled.get('/api/inventory/cas')
+        etag = res.headers['ETag']
+        assert etag.startswith('W/"')
+        assert 'Last-Modified' in res.headers
+
+        with count_queries(db.engine) as counter:
+            res = testapp_login_disabled.get(
+                    '/api/inventory/cas', headers={'If-None-Match': etag})
+        assert res.status_int == 304
+        assert res.body == ''
+        assert res.headers['ETag'] == etag
+        # single aggregate query, no list query
+        assert counter.count == 1
+
+    def test_etag_per_url(self, testapp_login_disabled):
+        res = testapp_login_disabled.get('/api/inventory/cas')
+        res2 = testapp_login_disabled.get('/api/inventory/cas?limit=2')
+        assert res.headers['ETag'] != res2.headers['ETag']
+
+        res3 = testapp_login_disabled.get(
+                '/api/inventory/cas?limit=2',
+                headers={'If-None-Match': res.headers['ETag']})
+        assert res3.status_int == 200
+
+    def test_etag_non_ascii_url(self, testapp_login_disabled):
+        # raw utf-8, as sent by some clients; webtest would escape it
+        client = testapp_login_disabled.app.test_client()
+        res = client.get(
+                '/api/inventory/cas',
+                query_string='fields=id&x=\xc3\xa9t\xc3\xa9')
+        assert res.status_code == 200
+        assert res.headers['ETag'].startswith('W/"')
+
+    def test_etag_changes_on_update(self, testapp_login_disabled, simple_db):
+        url = '/api/inventory/cas/%i' % simple_db['ca'][1].id
+        etag = testapp_login_disabled.get(url).headers['ETag']
+
+        # ca marshals vendor name_id
+        simple_db['vendor'].update(name='other_vendor')
+        res = testapp_login_disabled.get(url, headers={'If-None-Match': etag})
+        assert res.status_int == 200
+        assert res.json['vendor_name_id'].startswith('other_vendor')
+        assert res.headers['ETag'] != etag
+
+    def test_etag_changes_on_delete(self, testapp_login_disabled, simple_db):
+        etag = testapp_login_disabled.get('/api/inventory/roles').headers['ETag']
+        simple_db['ca'][2].role.delete()
+        res = testapp_login_disabled.get(
+                '/api/inventory/roles', headers={'If-None-Match': etag})
+        assert res.status_int == 200
+        assert len(res.json) == 2
+
+    def test_updated_at(self, simple_db):
+        ca = simple_db['ca'][0]
+        created = ca.updated_at
+        assert created is not None
+        ca.update(address='new-address.fake.test')
+        assert ca.updated_at > created
+
+    def test_not_found_has_no_etag(self, testapp_login_disabled):
+        res = testapp_login_disabled.get(
+                '/api/inventory/cas/999999', expect_errors=True)
+        assert res.status_int == 404
+        assert 'ETag' not in res.headers
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""tests for pooled ldap client."""
+import threading
+
+from ldap3.core.exceptions import LDAPBindError
+from ldap3.core.exceptions import LDAPPasswordIsMandatoryError
+from ldap3.core.exceptions import LDAPSocketReceiveError
+from mock import patch
+import pytest
+
+from cadash.extensions import cache
+from cadash.ldap import LdapClient
+from cadash.ldap import LdapGroupCache
+from cadash.public.views import load_user
+from cadash.user.models import BaseUser
+
+
+class FakeEntry(object):
+
+    def __init__(self, cn):
+        self.cn = cn
+
+    def entry_get_attributes_dict(self):
+        return {'cn': [self.cn]}
+
+
+class FakeConnection(object):
+    """ldap3 connection to a fake server, with counts of tls handshakes."""
+
+    instances = []
+    searches = []
+    passwords = {}
+    groups = {}
+    lock = threading.Lock()
+
+    def __init__(self, server, user=None, password=None):
+        self.user = user
+        self.password = password
+        self.closed = True
+        self.bound = False
+        self.tls_count = 0
+        self.broken = False
+        self.entries = []
+        with self.lock:
+            self.instances.append(self)
+
+    def open(self):
+        self.closed = False
+
+    def start_tls(self):
+        self.tls_count += 1
+
+    def bind(self):
+        if self.broken:
+            raise LDAPSocketReceiveError('connection reset')
+        self.bound = self.passwords.get(self.user) == self.password
+        return self.bound
+
+    def rebind(self, user=None, password=None, read_server_info=True):
+        self.user = user
+        self.password = password
+        try:
+            return self.bind()
+        except LDAPSocketReceiveError:
+            # as ldap3 does
+            raise LDAPBindError('Unable to rebind as a different user, '
+                                'furthermore the server abruptly closed the '
+                                'connection')
+
+    def search(self, base, search_filter, search_scope=None, attributes=None):
+        if self.broken:
+            raise LDAPSocketReceiveError('connection reset')
+        self.searches.append((search_filter, attributes))
+        uid = search_filter.split('memberUid=')[-1].rstrip(')')
+        self.entries = [FakeEntry(g) for g in self.groups.get(uid, [])]
+        return True
+
+    def unbind(self):
+        self.closed = True
+
+
+@pytest.yield_fixture(scope='function')
+def ldap_cli(app):
+    """ldap client of fake server."""
+    service = app.config['LDAP_BIND_DN']
+    base = app.config['LDAP_BASE_SEARCH']
+    FakeConnection.instances = []
+    FakeConnection.searches = []
+    FakeConnection.passwords = {
+            service: app.config['LDAP_BIND_PASSWD'],
+            'uid=alice,ou=People,%s' % base: 'secret'}
+    FakeConnection.groups = {'alice': ['can_bow', 'can_rollover']}
+    with patch('ldap3.Connection', FakeConnection):
+        cli = LdapClient()
+        cli.init_app(app)
+        yield cli
+
+
+class TestLdapConnectionPool(object):
+
+    def test_logins_reuse_tls_connection(self, ldap_cli):
+        for i in range(5):
+            assert ldap_cli.is_authenticated('alice', 'secret')
+            assert ldap_cli.fetch_groups('alice') == ['can_bow', 'can_rollover']
+        assert len(FakeConnection.instances) == 1
+        assert FakeConnection.instances[0].tls_count == 1
+
+    def test_connection_rebound_as_service_user(self, app, ldap_cli):
+        assert not ldap_cli.is_authenticated('alice', 'wrong')
+        conn = FakeConnection.instances[0]
+        assert conn.user == app.config['LDAP_BIND_DN']
+        assert conn.bound
+        assert ldap_cli.fetch_groups('alice') == ['can_bow', 'can_rollover']
+        assert len(FakeConnection.instances) == 1
+
+    def test_empty_password(self, ldap_cli):
+        with pytest.raises(LDAPPasswordIsMandatoryError):
+            ldap_cli.is_authenticated('alice', '')
+        assert FakeConnection.instances == []
+
+    def test_broken_connection_reconnects(self, ldap_cli):
+        ldap_cli.fetch_groups('alice')
+        FakeConnection.instances[0].broken = True
+        assert ldap_cli.is_authenticated('alice', 'secret')
+        assert ldap_cli.fetch_groups('alice') == ['can_bow', 'can_rollover']
+        assert len(FakeConnection.instances) == 2
+        assert FakeConnection.instances[0].closed
+        assert len(ldap_cli._pool) == 1
+
+    def test_broken_connection_reconnects_on_login(self, ldap_cli):
+        assert ldap_cli.is_authenticated('alice', 'secret')
+        FakeConnection.instances[0].broken = True
+        assert ldap_cli.is_authenticated('alice', 'secret')
+        assert len(FakeConnection.instances) == 2
+        assert FakeConnection.instances[0].closed
+
+    def test_service_rebind_failure_raised(self, app, ldap_cli):
+        assert ldap_cli.is_authenticated('alice', 'secret')
+        FakeConnection.passwords[app.config['LDAP_BIND_DN']] = 'changed'
+        # retried once on a new connection, whose bind fails too
+        with pytest.raises(LDAPBindError):
+            ldap_cli.is_authenticated('alice', 'secret')
+        assert len(FakeConnection.instances) == 2
+        assert len(ldap_cli._pool) == 0
+
+    def test_new_connection_failure_raised(self, ldap_cli):
+        FakeConnection.passwords = {}
+        # as before pooling: service bind failure logged; no groups
+        assert ldap_cli.fetch_groups('alice') == []
+        assert len(ldap_cli._pool) == 0
+
+    def test_idle_connection_dropped(self, ldap_cli):
+        ldap_cli.fetch_groups('alice')
+        ldap_cli._pool._max_idle = -1
+        ldap_cli.fetch_groups('alice')
+        assert len(FakeConnection.instances) == 2
+        assert FakeConnection.instances[0].closed
+
+    def test_idle_connection_checked(self, ldap_cli):
+        ldap_cli.fetch_groups('alice')
+        ldap_cli._pool._check_interval = -1
+        ldap_cli.fetch_groups('alice')
+        assert len(FakeConnection.instances) == 1
+        FakeConnection.instances[0].broken = True
+        ldap_cli.fetch_groups('alice')
+        assert len(FakeConnection.instances) == 2
+
+    def test_concurrent_logins(self, app, ldap_cli):
+        errors = []
+
+        def login():
+            try:
+                for i in range(20):
+                    assert ldap_cli.is_authenticated('alice', 'secret')
+                    assert ldap_cli.fetch_groups('alice')
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=login) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert errors == []
+        assert len(ldap_cli._pool) <= app.config['LDAP_POOL_SIZE']
+        assert len(FakeConnection.instances) <= 8
+
+
+@pytest.fixture(scope='function')
+def groups(app, ldap_cli):
+    """group cache of fake server."""
+    return LdapGroupCache(ldap_cli, cache, app)
+
+
+def group_searches():
+    return [s for s in FakeConnection.searches if 'memberUid' in s[0]]
+
+
+class TestLdapGroupCache(object):
+
+    def test_groups_cached(self, groups):
+        assert groups.fetch_groups('alice') == ['can_bow', 'can_rollover']
+        assert groups.fetch_groups('alice') == ['can_bow', 'can_rollover']
+        assert len(group_searches()) == 1
+        assert group_searches()[0][1] == ['cn']
+
+    def test_stale_groups_refreshed_in_background(self, groups):
+        groups.fetch_groups('alice')
+        FakeConnection.groups = {'alice': ['can_bow']}
+        groups._ttl = 0
+        with patch.object(groups, 'refresh_in_background') as refresh:
+            # stale served right away
+            assert groups.fetch_groups('alice') == ['can_bow', 'can_rollover']
+            refresh.assert_called_once_with('alice')
+        groups.refresh_in_background('alice').wait(5)
+        groups._ttl = 300
+        assert groups.fetch_groups('alice') == ['can_bow']
+        assert len(group_searches()) == 2
+
+    def test_failed_refresh_keeps_stale_groups(self, groups, ldap_cli):
+        groups.fetch_groups('alice')
+        FakeConnection.passwords = {}
+        ldap_cli._pool.clear()
+        with pytest.raises(LDAPBindError):
+            groups.refresh('alice')
+        groups._run_refresh('alice')
+        assert groups.fetch_groups('alice') == ['can_bow', 'can_rollover']
+
+    def test_expired_groups_fetched_while_waiting(self, groups):
+        groups.fetch_groups('alice')
+        FakeConnection.groups = {'alice': []}
+        groups._max_stale = 0
+        assert groups.fetch_groups('alice') == []
+
+    def test_no_block(self, groups):
+        assert groups.fetch_groups('alice', block=False) is None
+        groups.refresh_in_background('alice').wait(5)
+        assert groups.fetch_groups('alice', block=False) == \
+            ['can_bow', 'can_rollover']
+
+    def test_load_user_picks_up_group_changes(self, app, ldap_cli):
+        user = BaseUser('alice')
+        user.place_in_groups(['can_bow'])
+        sessions = app.extensions['user_sessions']
+        sessions.save(user)
+        sessions.clear_local()
+        groups = app.extensions['ldap_groups']
+        with patch.object(groups, '_cli', ldap_cli):
+            # groups not cached yet: user as logged in, fetch in background
+            assert load_user('alice').groups == ['can_bow']
+            groups.refresh_in_background('alice').wait(5)
+            sessions.clear_local()
+            assert sorted(load_user('alice').groups) == \
+                ['can_bow', 'can_rollover']
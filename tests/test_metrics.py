@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""Tests for in-process metrics registry."""
+from mock import patch
+import pytest
+
+from cadash.metrics import MetricsRegistry
+
+
+class TestMetricsRegistry(object):
+
+    def setup(self):
+        self.registry = MetricsRegistry()
+
+
+    def test_counter(self):
+        c = self.registry.counter('fake_total', 'fake count', ('device',))
+        c.inc(device='a')
+        c.inc(2, device='a')
+        c.inc(device='b')
+        assert c.get(device='a') == 3
+        text = self.registry.render()
+        assert '# TYPE fake_total counter' in text
+        assert 'fake_total{device="a"} 3' in text
+        assert 'fake_total{device="b"} 1' in text
+
+
+    def test_same_name_same_metric(self):
+        c = self.registry.counter('fake_total', 'fake count', ('device',))
+        assert self.registry.counter('fake_total', 'fake count', ('device',)) is c
+        with pytest.raises(ValueError):
+            self.registry.gauge('fake_total', 'fake count', ('device',))
+
+
+    def test_wrong_labels(self):
+        c = self.registry.counter('fake_total', 'fake count', ('device',))
+        with pytest.raises(ValueError):
+            c.inc(room='a')
+
+
+    def test_histogram(self):
+        h = self.registry.histogram(
+                'fake_seconds', 'fake latency', ('op',), buckets=(0.1, 1))
+        for value in (0.05, 0.5, 0.5, 5):
+            h.observe(value, op='get')
+        lines = self.registry.render().splitlines()
+        assert 'fake_seconds_bucket{op="get",le="0.1"} 1' in lines
+        assert 'fake_seconds_bucket{op="get",le="1"} 3' in lines
+        assert 'fake_seconds_bucket{op="get",le="+Inf"} 4' in lines
+        assert 'fake_seconds_sum{op="get"} 6.05' in lines
+        assert 'fake_seconds_count{op="get"} 4' in lines
+
+
+    def test_label_values_escaped(self):
+        g = self.registry.gauge('fake_ts', 'fake timestamp', ('device',))
+        g.set(1, device='a"b')
+        assert 'fake_ts{device="a\\"b"} 1' in self.registry.render()
+
+
+    def test_metrics_disabled_by_default(self, testapp):
+        res = testapp.get('/metrics', expect_errors=True)
+        assert res.status_code == 404
+
+
+    def test_metrics_endpoint_with_token(self, app, testapp):
+        app.config['METRICS_ENABLED'] = True
+        app.config['METRICS_TOKEN'] = 'fake-token'
+        res = testapp.get('/metrics', expect_errors=True)
+        assert res.status_code == 401
+        res = testapp.get(
+                '/metrics', headers={'Authorization': 'Bearer wrong'},
+                expect_errors=True)
+        assert res.status_code == 401
+
+        res = testapp.get(
+                '/metrics', headers={'Authorization': 'Bearer fake-token'})
+        assert res.content_type == 'text/plain'
+        assert '# TYPE epipearl_call_duration_seconds histogram' in res
+
+
+    @patch('cadash.ldap.LdapClient.is_authenticated', return_value=True)
+    @patch('cadash.ldap.LdapClient.fetch_groups', return_value=[])
+    def test_metrics_endpoint_logged_in(
+            self, mock_groups, mock_auth, app, testapp):
+        app.config['METRICS_ENABLED'] = True
+        assert testapp.get('/metrics', expect_errors=True).status_code == 401
+
+        form = testapp.get('/').forms['loginForm']
+        form['username'] = 'fake'
+        form['password'] = 'example'
+        form.submit().follow()
+        res = testapp.get('/metrics')
+        assert '# TYPE epipearl_call_duration_seconds histogram' in res
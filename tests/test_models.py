@@ -41,3 +41,12 @@ class TestBaseUser:
         assert self.user.is_in_group('can_edit')
         assert self.user.is_in_group('can_read')
         assert len(self.user.groups) == 2
+
+    def test_in_any_group(self):
+        """belong to any of a set of groups; decision memoized."""
+        assert self.user.is_in_any_group(frozenset(['potty_trained', 'can_edit']))
+        assert not self.user.is_in_any_group(frozenset(['potty_trained']))
+        self.user.place_in_groups(['potty_trained'])
+        assert self.user.is_in_any_group(frozenset(['potty_trained']))
+        self.user.remove_from_group('potty_trained')
+        assert not self.user.is_in_any_group(frozenset(['potty_trained']))
@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+"""Tests for long-lived epipearl clients, against local fake pearls."""
+import socket
+import threading
+import time
+
+from mock import patch
+import pytest
+import requests
+
+from cadash.metrics import registry
+from cadash.redunlive.client import CircuitBreaker
+from cadash.redunlive.client import CircuitOpenError
+from cadash.redunlive.client import PearlClient
+from cadash.redunlive.client import PearlClientRegistry
+from cadash.redunlive.models import CaptureAgent
+
+from tests.fake_pearl import FakePearl
+
+
+class TestPearlClientRegistry(object):
+
+    def setup(self):
+        self.pearl = FakePearl(channels={'1': {'publish_type': '6'}})
+        self.registry = PearlClientRegistry(user='user', passwd='passwd')
+
+    def teardown(self):
+        self.registry.clear()
+        self.pearl.stop()
+
+
+    def test_client_is_reused(self):
+        client = self.registry.get('SN1', self.pearl.address)
+        assert self.registry.get('SN1', self.pearl.address) is client
+        assert len(self.registry) == 1
+
+
+    def test_connection_kept_alive_across_gets(self):
+        for i in range(3):
+            client = self.registry.get('SN1', self.pearl.address)
+            response = client.get_params(channel='1', params={'publish_type': ''})
+            assert response == {'publish_type': '6'}
+        assert self.pearl.request_count == 3
+        assert self.pearl.connection_count == 1
+
+
+    def test_address_change_invalidates_client(self):
+        client = self.registry.get('SN1', self.pearl.address)
+        other = FakePearl(channels={'1': {'publish_type': '0'}})
+        new_client = self.registry.get('SN1', other.address)
+        assert new_client is not client
+        assert new_client.url == other.url
+        assert new_client.get_params(
+                channel='1', params={'publish_type': ''}) == {'publish_type': '0'}
+        assert len(self.registry) == 1
+        other.stop()
+
+
+    def test_idle_client_is_evicted(self):
+        self.registry._max_idle = 0.1
+        client = self.registry.get('SN1', self.pearl.address)
+        time.sleep(0.2)
+        self.registry.evict_idle()
+        assert 'SN1' not in self.registry
+        assert self.registry.get('SN1', self.pearl.address) is not client
+
+
+    def test_invalidate(self):
+        self.registry.get('SN1', self.pearl.address)
+        self.registry.invalidate('SN1')
+        assert 'SN1' not in self.registry
+        # no-op for unknown serial_number
+        self.registry.invalidate('SN2')
+
+
+    def test_registered_in_app(self, app):
+        assert app.extensions['pearl_clients'] is not None
+        assert app.extensions['pearl_clients']._max_idle == \
+                app.config['EPIPEARL_CLIENT_MAX_IDLE']
+
+
+class TestCircuitBreaker(object):
+
+    def setup(self):
+        self.breaker = CircuitBreaker('fake', threshold=2, backoff=0.1)
+
+    def test_opens_after_threshold_failures(self):
+        self.breaker.record_failure()
+        assert self.breaker.state == CircuitBreaker.CLOSED
+        assert self.breaker.allow()
+        self.breaker.record_failure()
+        assert self.breaker.state == CircuitBreaker.OPEN
+        assert not self.breaker.allow()
+
+
+    def test_success_resets_failures(self):
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        assert self.breaker.state == CircuitBreaker.CLOSED
+
+
+    def test_half_open_single_probe_closes(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        time.sleep(0.15)
+        assert self.breaker.allow()
+        assert self.breaker.state == CircuitBreaker.HALF_OPEN
+        # only one probe at a time
+        assert not self.breaker.allow()
+        self.breaker.record_success()
+        assert self.breaker.state == CircuitBreaker.CLOSED
+        assert self.breaker.allow()
+
+
+    def test_failed_probe_doubles_backoff(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        time.sleep(0.15)
+        assert self.breaker.allow()
+        start = time.time()
+        self.breaker.record_failure()
+        assert self.breaker.state == CircuitBreaker.OPEN
+        assert self.breaker.retry_at - start == pytest.approx(0.2, abs=0.05)
+
+
+class TestPearlClientBreaker(object):
+
+    def setup(self):
+        self.pearl = FakePearl(channels={
+            '1': {'publish_type': '6'}, '2': {'publish_type': '6'}})
+
+    def teardown(self):
+        self.pearl.stop()
+
+
+    def test_http_error_is_not_a_failure(self):
+        client = PearlClient(self.pearl.url, 'user', 'wrong')
+        for i in range(5):
+            with pytest.raises(requests.HTTPError):
+                client.get_params(channel='1', params={'publish_type': ''})
+        assert client.breaker.state == CircuitBreaker.CLOSED
+
+
+    def test_dead_device_fails_fast(self):
+        address = self.pearl.address
+        self.pearl.stop()
+        client = PearlClient(
+                'http://%s' % address, 'user', 'passwd',
+                breaker=CircuitBreaker(address, threshold=2, backoff=60))
+        for i in range(2):
+            with pytest.raises(requests.ConnectionError):
+                client.get_params(channel='1', params={'publish_type': ''})
+        with pytest.raises(CircuitOpenError):
+            client.get_params(channel='1', params={'publish_type': ''})
+
+
+    def test_capture_agent_health(self):
+        ca = CaptureAgent('SN1', self.pearl.address)
+        ca.channels['live']['channel'] = '1'
+        ca.channels['lowBR']['channel'] = '2'
+        assert ca.health == 'unknown'
+
+        ca.client = PearlClient(
+                self.pearl.url, 'user', 'passwd',
+                breaker=CircuitBreaker(self.pearl.address, threshold=1))
+        ca.sync_live_status()
+        assert ca.health == 'closed'
+        assert ca.channels['live']['publish_type'] == '6'
+
+        self.pearl.stop()
+        # kept-alive connections outlive the fake pearl listener
+        ca.client.close()
+        ca.sync_live_status()
+        assert ca.health == 'open'
+        assert ca.channels['live']['publish_type'] == 'not available'
+        # open circuit: no call to device at all
+        start = time.time()
+        ca.sync_live_status()
+        assert time.time() - start < 0.05
+        assert ca.channels['lowBR']['publish_type'] == 'not available'
+
+
+class TestPearlClientMetrics(object):
+
+    def setup(self):
+        self.pearl = FakePearl(channels={'1': {'publish_type': '6'}})
+        registry.clear()
+
+    def teardown(self):
+        self.pearl.stop()
+
+
+    def test_calls_are_timed(self):
+        client = PearlClient(self.pearl.url, 'user', 'passwd')
+        client.get_params(channel='1', params={'publish_type': ''})
+        client.set_params(channel='1', params={'publish_type': '0'})
+
+        latency = registry.get('epipearl_call_duration_seconds')
+        h = latency.get(device=self.pearl.address, op='get_params')
+        assert h['count'] == 1
+        assert latency.get(device=self.pearl.address, op='set_params')['count'] == 1
+        assert registry.get('epipearl_last_success_timestamp_seconds').get(
+                device=self.pearl.address) > time.time() - 5
+
+
+    def test_errors_are_counted_by_type(self):
+        client = PearlClient(
+                self.pearl.url, 'user', 'wrong',
+                breaker=CircuitBreaker(self.pearl.address, threshold=1))
+        with pytest.raises(requests.HTTPError):
+            client.get_params(channel='1', params={'publish_type': ''})
+
+        errors = registry.get('epipearl_call_errors_total')
+        assert errors.get(
+                device=self.pearl.address, op='get_params', error='HTTPError') == 1
+        assert registry.get('epipearl_last_success_timestamp_seconds').get(
+                device=self.pearl.address) is None
+
+
+class _CountingSocket(object):
+    """socket that counts writes, i.e. round trips of pipelined requests."""
+
+    def __init__(self, sock, counter):
+        """create instance."""
+        self._sock = sock
+        self._counter = counter
+
+    def sendall(self, data):
+        self._counter.append(data)
+        return self._sock.sendall(data)
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
+
+
+class _NoPipelineServer(object):
+    """accepts connections, reads a request, and closes unanswered."""
+
+    def __init__(self):
+        """create instance and start serving."""
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.bind(('127.0.0.1', 0))
+        self._sock.listen(8)
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def address(self):
+        return self._sock.getsockname()
+
+    def _serve(self):
+        while True:
+            try:
+                (conn, addr) = self._sock.accept()
+            except socket.error:
+                return
+            conn.recv(4096)
+            conn.close()
+
+    def stop(self):
+        self._sock.close()
+
+
+class TestPearlClientBatch(object):
+
+    def setup(self):
+        self.pearl = FakePearl(channels={
+            '1': {'publish_type': '6'}, '2': {'publish_type': '0'}})
+        self.writes = []
+        create_connection = socket.create_connection
+
+        def counting_connection(*args, **kwargs):
+            return _CountingSocket(
+                    create_connection(*args, **kwargs), self.writes)
+
+        self.patcher = patch(
+                'cadash.redunlive.client.socket.create_connection',
+                side_effect=counting_connection)
+        self.patcher.start()
+
+    def teardown(self):
+        self.patcher.stop()
+        self.pearl.stop()
+
+
+    def test_batch_is_pipelined_on_one_connection(self):
+        client = PearlClient(self.pearl.url, 'user', 'passwd')
+        for i in range(3):
+            assert client.get_params_batch(
+                    ['1', '2'], {'publish_type': ''}) == [
+                            {'publish_type': '6'}, {'publish_type': '0'}]
+        # one write per batch, of both requests; one connection for all
+        assert len(self.writes) == 3
+        assert [w.count(b'GET ') for w in self.writes] == [2, 2, 2]
+        assert self.pearl.request_count == 6
+        assert self.pearl.connection_count == 1
+
+
+    def test_batch_http_error_keeps_pipeline(self):
+        client = PearlClient(self.pearl.url, 'user', 'passwd')
+        with pytest.raises(requests.HTTPError):
+            client.get_params_batch(['1', '99'], {'publish_type': ''})
+        assert client.get_params_batch(['2'], {'publish_type': ''}) == [
+                {'publish_type': '0'}]
+        assert self.pearl.connection_count == 1
+        assert client.breaker.state == CircuitBreaker.CLOSED
+
+
+    def test_batch_cut_short_reads_one_by_one(self):
+        # device closes connection after first response
+        self.pearl.keepalive_requests = 1
+        client = PearlClient(self.pearl.url, 'user', 'passwd')
+        assert client.get_params_batch(['1', '2'], {'publish_type': ''}) == [
+                {'publish_type': '6'}, {'publish_type': '0'}]
+        # pipeline, then one get_params on the session
+        assert self.pearl.connection_count == 2
+        assert self.pearl.request_count == 2
+
+
+    def test_batch_reopens_pipeline_closed_while_idle(self):
+        client = PearlClient(self.pearl.url, 'user', 'passwd')
+        client.get_params_batch(['1', '2'], {'publish_type': ''})
+        self.pearl.drop_connections()
+        assert client.get_params_batch(['1', '2'], {'publish_type': ''}) == [
+                {'publish_type': '6'}, {'publish_type': '0'}]
+        # batch written to dropped connection, then again to a new one
+        assert [w.count(b'GET ') for w in self.writes] == [2, 2, 2]
+        assert self.pearl.connection_count == 2
+        assert self.pearl.request_count == 4
+        assert client.breaker.failures == 0
+
+
+    def test_batch_dead_device(self):
+        address = self.pearl.address
+        self.pearl.stop()
+        client = PearlClient(
+                'http://%s' % address, 'user', 'passwd',
+                breaker=CircuitBreaker(address, threshold=1, backoff=60))
+        with pytest.raises(requests.ConnectionError):
+            client.get_params_batch(['1', '2'], {'publish_type': ''})
+        with pytest.raises(CircuitOpenError):
+            client.get_params_batch(['1', '2'], {'publish_type': ''})
+
+
+    def test_half_open_probe_to_device_that_does_not_pipeline(self):
+        client = PearlClient(
+                self.pearl.url, 'user', 'passwd',
+                breaker=CircuitBreaker(
+                    self.pearl.address, threshold=1, backoff=0.05))
+        client.breaker.record_failure()
+        time.sleep(0.1)
+
+        stub = _NoPipelineServer()
+        try:
+            # pipeline goes to a device that closes it unanswered
+            with patch.object(
+                    client, '_open_pipeline',
+                    side_effect=lambda: setattr(
+                        client, '_pipeline',
+                        socket.create_connection(stub.address))):
+                assert client.get_params_batch(
+                        ['1', '2'], {'publish_type': ''}) == [
+                                {'publish_type': '6'}, {'publish_type': '0'}]
+        finally:
+            stub.stop()
+        assert client.breaker.state == CircuitBreaker.CLOSED
+        assert client.breaker.allow()
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""Tests for redunlive background jobs."""
+import threading
+import time
+
+from flask import current_app
+import pytest
+
+from cadash.extensions import cache
+from cadash.redunlive.jobs import Job
+from cadash.redunlive.jobs import JobRunner
+from cadash.redunlive.jobs import LocationBusyError
+
+
+class TestJobRunner(object):
+
+    def test_job_runs_in_app_context(self, app):
+        runner = JobRunner(cache, app)
+        job = runner.submit(lambda: current_app.config['ENV'])
+        assert job.wait(5)
+        assert job.state == Job.DONE
+        assert job.result == 'test'
+        assert job.finished_at is not None
+        assert runner.last_finished_at == job.finished_at
+        assert runner.get(job.id) is job
+
+
+    def test_failed_job(self, app):
+        def boom():
+            raise ValueError('boom')
+
+        runner = JobRunner(cache, app)
+        job = runner.submit(boom, description='fail on purpose')
+        assert job.wait(5)
+        assert job.state == Job.FAILED
+        assert job.error == 'boom'
+        assert job.to_dict()['state'] == 'failed'
+
+
+    def test_jobs_run_in_parallel(self, app):
+        app.config['REDUNLIVE_JOB_WORKERS'] = 2
+        runner = JobRunner(cache, app)
+        barrier = threading.Event()
+        started = []
+
+        def wait_for_other():
+            started.append(1)
+            if len(started) == 2:
+                barrier.set()
+            return barrier.wait(2)
+
+        jobs = [runner.submit(wait_for_other, target='loc%s' % i)
+                for i in range(2)]
+        for job in jobs:
+            assert job.wait(5)
+            assert job.result is True
+
+
+    def test_active_jobs(self, app):
+        runner = JobRunner(cache, app)
+        release = threading.Event()
+        job = runner.submit(release.wait, args=(5,), target='fake_room')
+        assert [j.target for j in runner.active()] == ['fake_room']
+        release.set()
+        assert job.wait(5)
+        assert runner.active() == []
+
+
+    def test_finished_jobs_expire(self, app):
+        app.config['REDUNLIVE_JOB_TTL'] = 1
+        runner = JobRunner(cache, app)
+        job = runner.submit(lambda: None)
+        assert job.wait(5)
+        time.sleep(1.1)
+        runner.submit(lambda: None).wait(5)
+        assert runner.get(job.id) is None
+
+
+    def test_jobs_shared_between_runners(self, app):
+        """runners in other processes see jobs through app cache."""
+        runner = JobRunner(cache, app)
+        other = JobRunner(cache, app)
+        release = threading.Event()
+        job = runner.submit(release.wait, args=(5,), target='fake_room',
+                            description='switch fake_room')
+
+        seen = other.get(job.id)
+        assert seen is not job
+        assert seen.description == 'switch fake_room'
+        assert not seen.finished
+        assert other.running(['fake_room', 'other_room']).keys() == ['fake_room']
+        assert other.active() == []
+
+        release.set()
+        assert job.wait(5)
+        seen = other.get(job.id)
+        assert seen.state == Job.DONE
+        assert seen.result is True
+        assert seen.finished_at == job.finished_at
+        assert other.last_finished_at == job.finished_at
+        assert other.running(['fake_room']) == {}
+
+
+    def test_location_busy(self, app):
+        runner = JobRunner(cache, app)
+        other = JobRunner(cache, app)
+        release = threading.Event()
+        job = runner.submit(release.wait, args=(5,), target='fake_room')
+
+        with pytest.raises(LocationBusyError) as e:
+            other.submit(lambda: None, target=['other_room', 'fake_room'])
+        assert e.value.location == 'fake_room'
+        assert e.value.job_id == job.id
+        # all or nothing: other_room not left locked
+        assert other.submit(lambda: None, target='other_room').wait(5)
+
+        release.set()
+        assert job.wait(5)
+        assert other.submit(lambda: None, target='fake_room').wait(5)
+
+
+    def test_failed_job_releases_location(self, app):
+        def boom():
+            raise ValueError('boom')
+
+        runner = JobRunner(cache, app)
+        assert runner.submit(boom, target='fake_room').wait(5)
+        assert runner.running(['fake_room']) == {}
+        assert runner.submit(lambda: None, target='fake_room').wait(5)
@@ -1,9 +1,12 @@
 # -*- coding: utf-8 -*-
 """Tests for `models` in redunlive webapp."""
 import httpretty
+from mock import patch
 import pytest
+import requests
 from epipearl import Epipearl
 
+from cadash.redunlive.client import PearlClient
 from cadash.redunlive.models import CaptureAgent
 from cadash.redunlive.models import CaLocation
 
@@ -81,6 +84,64 @@ class TestCaptureAgentModel(object):
 
 
 
+class TestCaptureAgentBatchRead(object):
+
+    def setup(self):
+        p = CaptureAgent('ABCD1111', 'fake1.example.edu')
+        p.channels['live']['channel'] = '1'
+        p.channels['live']['publish_type'] = '0'
+        p.channels['lowBR']['channel'] = '2'
+        p.channels['lowBR']['publish_type'] = '0'
+        p.client = PearlClient(epiphan_url, 'user', 'passwd')
+        self.ca = p
+
+
+    @httpretty.activate
+    def test_batch_read_live_status(self):
+        httpretty.register_uri(
+                httpretty.GET, '%s/admin/channel1/get_params.cgi' % epiphan_url,
+                body='publish_type = 6')
+        httpretty.register_uri(
+                httpretty.GET, '%s/admin/channel2/get_params.cgi' % epiphan_url,
+                body='publish_type = 6')
+
+        self.ca.sync_live_status()
+        assert self.ca.channels['live']['publish_type'] == '6'
+        assert self.ca.channels['lowBR']['publish_type'] == '6'
+        paths = [r.path.split('?')[0] for r in httpretty.HTTPretty.latest_requests]
+        assert paths == [
+                '/admin/channel1/get_params.cgi',
+                '/admin/channel2/get_params.cgi']
+
+
+    @httpretty.activate
+    def test_batch_read_diverging_live_status(self):
+        httpretty.register_uri(
+                httpretty.GET, '%s/admin/channel1/get_params.cgi' % epiphan_url,
+                body='publish_type = 0')
+        httpretty.register_uri(
+                httpretty.GET, '%s/admin/channel2/get_params.cgi' % epiphan_url,
+                body='publish_type = 6')
+        httpretty.register_uri(
+                httpretty.GET, '%s/admin/channel2/set_params.cgi' % epiphan_url,
+                body='', status=201)
+
+        self.ca.sync_live_status()
+        assert self.ca.channels['live']['publish_type'] == '0'
+        assert self.ca.channels['lowBR']['publish_type'] == '0'
+
+
+    def test_batch_read_unreachable_device(self):
+        with patch.object(
+                PearlClient, 'get_params_batch',
+                side_effect=requests.ConnectionError('connection refused')):
+            with patch.object(PearlClient, 'get_params') as mock_get:
+                self.ca.sync_live_status()
+                # device is down: do not retry channels one by one
+                assert not mock_get.called
+        assert self.ca.channels['live']['publish_type'] == 'not available'
+        assert self.ca.channels['lowBR']['publish_type'] == 'not available'
+
 
 class TestCaLocationModel(object):
 
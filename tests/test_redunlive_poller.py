@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""Tests for redunlive background poller."""
+import json
+import os
+import time
+
+import arrow
+import httpretty
+from mock import patch
+
+from cadash.app import create_app
+from cadash.redunlive.models import CaLocation
+from cadash.redunlive.poller import LiveStatusPoller
+from cadash.redunlive.poller import Snapshot
+from cadash.settings import Config
+
+data_filename = os.path.join(
+        os.path.abspath(os.path.dirname(__file__)), 'ca_loc_shortmap.json')
+
+
+def get_json_data():
+    txt = open(data_filename, 'r')
+    raw_data = txt.read()
+    txt.close()
+    return raw_data
+
+
+def register_uri_for_http():
+    """register ca_stats and one get_params per ca channel."""
+    httpretty.register_uri(
+            httpretty.GET,
+            'http://ca_stats_fake_url.com',
+            body=get_json_data())
+    for ca in ['033', '017', '089', '088']:
+        for chan in ['3', '4']:
+            httpretty.register_uri(
+                    httpretty.GET,
+                    'http://fake-epiphan%s.dce.harvard.edu/admin/channel%s/get_params.cgi'
+                    % (ca, chan),
+                    body='publish_type = %s' % ('6' if ca == '017' else '0'))
+
+
+class TestLiveStatusPoller(object):
+
+    def test_disabled_by_default(self, app):
+        poller = app.extensions['redunlive_poller']
+        assert not poller.enabled
+        assert poller.snapshot is None
+
+
+    def test_started_by_first_request(self):
+        config = Config(environment='test')
+        config.REDUNLIVE_POLL_INTERVAL = 3600
+        with patch.object(LiveStatusPoller, 'poll_once') as poll_once:
+            app = create_app(config)
+            poller = app.extensions['redunlive_poller']
+            # not on app creation, as for manage.py commands
+            assert poller.enabled
+            assert poller._thread is None
+
+            app.test_client().get('/')
+            try:
+                assert poller._thread.is_alive()
+                thread = poller._thread
+                app.test_client().get('/')
+                assert poller._thread is thread
+                poller._thread.join(0.5)
+                assert poll_once.call_count == 1
+            finally:
+                poller.stop()
+
+
+    def test_poll_once_publishes_snapshot(self, app):
+        httpretty.enable()
+        register_uri_for_http()
+        poller = LiveStatusPoller(app)
+
+        snapshot = poller.poll_once()
+
+        assert isinstance(snapshot, Snapshot)
+        assert poller.snapshot is snapshot
+        assert len(snapshot.locations) == 1
+        loc = snapshot.get_location('fake_room')
+        assert isinstance(loc, CaLocation)
+        assert loc.active_livestream == 'secondary'
+        assert snapshot.get_location('no_such_room') is None
+
+        # a new cycle does not touch previous snapshot
+        assert poller.poll_once() is not snapshot
+        assert snapshot.get_location('fake_room') is loc
+
+        httpretty.disable()
+        httpretty.reset()
+
+
+    def test_view_renders_from_snapshot(self, testapp_login_disabled):
+        httpretty.enable()
+        register_uri_for_http()
+        poller = testapp_login_disabled.app.extensions['redunlive_poller']
+        poller.poll_once()
+
+        # no device traffic to render the page
+        httpretty.reset()
+        res = testapp_login_disabled.get('/redunlive/')
+
+        assert 'status as of' in res
+        assert 'fake_epiphan017' in res
+        radio = res.forms['fake_room']['active_device']
+        assert radio.value == 'secondary'
+
+        httpretty.disable()
+        httpretty.reset()
+
+
+class TestLiveStatusUpdates(object):
+
+    def test_updates_need_poller(self, testapp_login_disabled):
+        res = testapp_login_disabled.get('/redunlive/updates', expect_errors=True)
+        assert res.status_code == 503
+
+
+    def test_updates_only_for_changes(self, testapp_login_disabled):
+        app = testapp_login_disabled.app
+        poller = app.extensions['redunlive_poller']
+        # enabled, but no poller thread
+        poller._interval = 3600
+
+        httpretty.enable()
+        register_uri_for_http()
+        first = poller.poll_once()
+        httpretty.disable()
+        httpretty.reset()
+
+        # page without version gets all locations
+        res = testapp_login_disabled.get('/redunlive/updates')
+        assert res.json['version'] == first.version
+        assert res.json['ids'] == sorted(first.states)
+        assert sorted([l['id'] for l in res.json['locations']]) == \
+            sorted(first.states)
+
+        # nothing newer: answers right away, with no locations
+        start = time.time()
+        res = testapp_login_disabled.get(
+            '/redunlive/updates', {'since': first.version})
+        assert time.time() - start < 0.5
+        assert res.json['version'] == first.version
+        assert res.json['locations'] == []
+
+        # same status: newer version, but no locations
+        same = poller.publish(Snapshot(
+            locations=first.locations, taken_at=arrow.utcnow(),
+            previous=first))
+        res = testapp_login_disabled.get(
+            '/redunlive/updates', {'since': first.version})
+        assert res.json['version'] == same.version
+        assert res.json['locations'] == []
+
+        # 'fake_room' switched to primary
+        changed_states = json.loads(json.dumps(same.states))
+        changed_states['fake_room']['active_livestream'] = 'primary'
+        changed = poller.publish(Snapshot(
+            locations=same.locations, taken_at=arrow.utcnow(),
+            states=changed_states, previous=same))
+        res = testapp_login_disabled.get(
+            '/redunlive/updates', {'since': same.version})
+        assert res.json['version'] == changed.version
+        assert [l['id'] for l in res.json['locations']] == ['fake_room']
+        loc = res.json['locations'][0]
+        assert loc['state']['active_livestream'] == 'primary'
+        assert 'id="loc-fake_room"' in loc['html']
+
+
+    def test_updates_bad_version(self, testapp_login_disabled):
+        testapp_login_disabled.app.extensions['redunlive_poller']._interval = 3600
+        res = testapp_login_disabled.get(
+            '/redunlive/updates', {'since': 'yesterday'}, expect_errors=True)
+        assert res.status_code == 400
+
+
+class TestSnapshot(object):
+
+    def test_changed_at_carried_over(self):
+        first = Snapshot(
+            locations=(), taken_at=arrow.get(1000),
+            states={'a': {'x': 1}, 'b': {'x': 1}})
+        later = Snapshot(
+            locations=(), taken_at=arrow.get(2000),
+            states={'a': {'x': 1}, 'b': {'x': 2}, 'c': {'x': 1}},
+            previous=first)
+        assert later.changed_at == {
+            'a': arrow.get(1000), 'b': arrow.get(2000), 'c': arrow.get(2000)}
+        assert later.version == 2000 * 1000000
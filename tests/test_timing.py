@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""Tests for per-request phase timings."""
+import time
+
+from flask import render_template_string
+
+from cadash.app import create_app
+from cadash.extensions import db as _db
+from cadash.settings import Config
+from cadash.timing import phase
+from cadash.timing import RequestTimer
+
+
+def make_app(enabled=True):
+    config = Config(environment='test', login_disabled=True)
+    config.TIMING_ENABLED = enabled
+    config.METRICS_ENABLED = True
+    config.METRICS_TOKEN = 'fake-token'
+    app = create_app(config)
+
+    @app.route('/timed')
+    def timed():
+        with phase('http'):
+            time.sleep(0.1)
+        _db.session.execute('select 1')
+        return render_template_string('{{ 1 + 1 }}')
+
+    @app.route('/fast')
+    def fast():
+        return 'ok'
+
+    @app.route('/nested')
+    def nested():
+        def slow():
+            time.sleep(0.1)
+            return ''
+
+        return render_template_string(
+                '{{ slow() }}{{ inner() }}', slow=slow,
+                inner=lambda: render_template_string('{{ 2 + 2 }}'))
+
+    return app
+
+
+class TestRequestTimer(object):
+
+    def test_server_timing_header(self):
+        app = make_app()
+        with app.app_context():
+            _db.create_all()
+        res = app.test_client().get('/timed')
+
+        header = res.headers['Server-Timing']
+        phases = dict([p.split(';dur=') for p in header.split(', ')])
+        assert set(phases) == set(['db', 'http', 'render', 'total'])
+        assert float(phases['http']) >= 100
+        assert float(phases['total']) >= float(phases['http'])
+
+
+    def test_slowest_endpoints(self):
+        app = make_app()
+        client = app.test_client()
+        for i in range(3):
+            client.get('/timed')
+        client.get('/fast')
+
+        table = app.extensions['request_timer'].slowest()
+        assert [t['endpoint'] for t in table] == ['timed', 'fast']
+        assert table[0]['count'] == 3
+        assert table[0]['phases_avg_ms']['http'] >= 100
+        assert table[0]['max_ms'] >= table[0]['p95_ms']
+
+        res = client.get('/metrics/slowest?count=1')
+        assert res.status_code == 401
+        res = client.get(
+                '/metrics/slowest?count=1',
+                headers={'Authorization': 'Bearer fake-token'})
+        assert res.status_code == 200
+        assert b'"endpoint": "timed"' in res.data
+
+
+    def test_nested_render_timed_once(self):
+        app = make_app()
+        res = app.test_client().get('/nested')
+        assert res.data == b'4'
+
+        header = res.headers['Server-Timing']
+        phases = dict([p.split(';dur=') for p in header.split(', ')])
+        # outer render, including the inner one
+        assert 100 <= float(phases['render']) < 200
+
+
+    def test_disabled(self):
+        app = make_app(enabled=False)
+        res = app.test_client().get('/timed')
+        assert 'Server-Timing' not in res.headers
+        assert app.extensions['request_timer'].slowest() == []
+
+
+    def test_phase_outside_request_is_noop(self):
+        RequestTimer()
+        with phase('http'):
+            pass
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""tests for logged in user sessions."""
+import json
+import pickle
+import time
+
+from mock import patch
+import pytest
+
+from cadash.extensions import cache
+from cadash.user.models import BaseUser
+from cadash.user.sessions import decode_user
+from cadash.user.sessions import encode_user
+from cadash.user.sessions import UserSessionStore
+from cadash.utils import LruCache
+
+
+class FakeGroups(object):
+    """group cache that never knows groups of users."""
+
+    def fetch_groups(self, username, block=True):
+        return None
+
+
+def make_user(username='alice', groups=('can_bow', 'can_rollover')):
+    user = BaseUser(username)
+    user.place_in_groups(list(groups))
+    return user
+
+
+@pytest.fixture(scope='function')
+def sessions(app):
+    """session store, on app cache."""
+    return UserSessionStore(cache, FakeGroups(), app)
+
+
+class TestUserEncoding(object):
+
+    def test_roundtrip(self):
+        (user, expires_at) = decode_user(encode_user(make_user(), 1234.5))
+        assert user.username == 'alice'
+        assert sorted(user.groups) == ['can_bow', 'can_rollover']
+        assert expires_at == 1234
+
+    def test_compact(self):
+        user = make_user()
+        assert len(encode_user(user, time.time())) < len(pickle.dumps(user))
+
+    def test_unknown_encoding(self):
+        assert decode_user(json.dumps([0, 'alice', 0, []])) is None
+        assert decode_user('not json') is None
+        assert decode_user(make_user()) is None
+
+
+class TestUserSessionStore(object):
+
+    def test_save_load(self, sessions):
+        sessions.save(make_user())
+        sessions.clear_local()
+        user = sessions.load(u'alice')
+        assert sorted(user.groups) == ['can_bow', 'can_rollover']
+        assert sessions.load(u'bob') is None
+
+    def test_local_hit_skips_app_cache(self, sessions):
+        sessions.save(make_user())
+        with patch.object(cache, 'get') as get:
+            for i in range(10):
+                assert sessions.load(u'alice').username == 'alice'
+            assert get.call_count == 0
+
+    def test_expired_session(self, app, sessions):
+        sessions._ttl = -1
+        sessions.save(make_user())
+        assert sessions.load(u'alice') is None
+        sessions.clear_local()
+        assert sessions.load(u'alice') is None
+
+    def test_revoke_reaches_other_processes(self, app, sessions):
+        other = UserSessionStore(cache, FakeGroups(), app)
+        sessions.save(make_user())
+        assert other.load(u'alice') is not None
+        sessions.revoke(u'alice')
+        assert sessions.load(u'alice') is None
+        # other process still serves its local copy, for up to local ttl
+        assert other.load(u'alice') is not None
+        other._local.ttl = 0
+        assert other.load(u'alice') is None
+
+
+class TestLruCache(object):
+
+    def test_least_recently_used_dropped(self):
+        lru = LruCache(size=2, ttl=60)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        assert lru.get('a') == 1
+        lru.set('c', 3)
+        assert lru.get('b') is None
+        assert lru.get('a') == 1
+        assert lru.get('c') == 3
+        assert len(lru) == 2
+
+    def test_expired(self):
+        lru = LruCache(size=2, ttl=0)
+        lru.set('a', 1)
+        assert lru.get('a') is None
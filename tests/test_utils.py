@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""Tests for cached fetch of text files, and role checks, in `utils` module."""
+from flask_login import login_user
+import httpretty
+
+from cadash.user.models import BaseUser
+from cadash.utils import CachedFetcher
+from cadash.utils import compile_roles
+from cadash.utils import pull_data
+from cadash.utils import requires_roles
+
+URL = 'http://ca_stats_fake_url.com/ca_stats.json'
+
+
+class TestCachedFetcher(object):
+
+    def setup(self):
+        httpretty.enable()
+        self.requests = []
+        self.fetcher = CachedFetcher(ttl=60)
+
+    def teardown(self):
+        httpretty.disable()
+        httpretty.reset()
+
+
+    def register(self, status=200, body='[{"location": "fake room"}]',
+                 etag='"v1"'):
+        def callback(request, uri, headers):
+            self.requests.append(request)
+            if etag and request.headers.get('If-None-Match') == etag:
+                return (304, headers, '')
+            if etag:
+                headers['ETag'] = etag
+            return (status, headers, body)
+        httpretty.register_uri(httpretty.GET, URL, body=callback)
+
+
+    def test_fresh_entry_is_not_fetched_again(self):
+        self.register()
+        assert self.fetcher.get_text(URL) == '[{"location": "fake room"}]'
+        assert self.fetcher.get_text(URL) == '[{"location": "fake room"}]'
+        assert len(self.requests) == 1
+
+
+    def test_parsed_json_is_cached(self):
+        self.register()
+        data = self.fetcher.get_json(URL)
+        assert data == [{'location': 'fake room'}]
+        assert self.fetcher.get_json(URL) is data
+
+
+    def test_conditional_get_after_ttl(self):
+        self.register()
+        self.fetcher.ttl = 0
+        data = self.fetcher.get_json(URL)
+        assert self.fetcher.get_json(URL) is data
+        assert len(self.requests) == 2
+        assert self.requests[1].headers.get('If-None-Match') == '"v1"'
+
+
+    def test_version_changes_with_body(self):
+        self.register()
+        self.fetcher.ttl = 0
+        (data, version) = self.fetcher.get_versioned_json(URL)
+        assert data == [{'location': 'fake room'}]
+        # revalidated, not modified
+        assert self.fetcher.get_versioned_json(URL) == (data, version)
+
+        httpretty.reset()
+        self.register(body='[{"location": "other room"}]', etag='"v2"')
+        (data, new_version) = self.fetcher.get_versioned_json(URL)
+        assert data == [{'location': 'other room'}]
+        assert new_version != version
+
+
+    def test_serve_stale_on_error(self):
+        self.register()
+        self.fetcher.ttl = 0
+        assert self.fetcher.get_text(URL) == '[{"location": "fake room"}]'
+
+        httpretty.reset()
+        self.register(status=500, etag=None)
+        assert self.fetcher.get_text(URL) == '[{"location": "fake room"}]'
+
+
+    def test_unavailable_and_not_cached(self):
+        self.register(status=503, etag=None)
+        assert self.fetcher.get_text(URL) is None
+        assert self.fetcher.get_json(URL) is None
+
+
+    def test_cache_is_per_user(self):
+        self.register()
+        self.fetcher.get_text(URL, creds={'user': 'user1', 'pwd': 'pwd1'})
+        self.fetcher.get_text(URL, creds={'user': 'user2', 'pwd': 'pwd2'})
+        assert len(self.requests) == 2
+        assert self.requests[0].headers.get('Authorization').startswith('Basic')
+
+
+    def test_pull_data(self):
+        self.register(etag=None)
+        assert pull_data(URL) == '[{"location": "fake room"}]'
+
+
+    def test_registered_in_app(self, app):
+        assert app.extensions['ca_stats'].ttl == app.config['CA_STATS_TTL']
+
+
+class TestRequiresRoles(object):
+
+    def view(self):
+        @requires_roles(['deadmin'], 'can_rollover')
+        def protected():
+            return 'ok'
+        return protected
+
+    def test_compile_roles(self):
+        assert compile_roles((['deadmin', 'can_bow'], 'can_rollover')) == \
+            frozenset(['deadmin', 'can_bow', 'can_rollover'])
+
+    def test_anonymous_redirected(self, app):
+        assert self.view()().status_code == 302
+
+    def test_authorized_user(self, app):
+        user = BaseUser('alice')
+        user.place_in_groups(['can_bow', 'can_rollover'])
+        login_user(user)
+        assert self.view()() == 'ok'
+
+    def test_unauthorized_user(self, app):
+        user = BaseUser('alice')
+        user.place_in_groups(['can_bow'])
+        login_user(user)
+        assert self.view()().status_code == 302